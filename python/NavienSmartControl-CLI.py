@@ -96,6 +96,11 @@ if __name__ == "__main__":
         choices={"add", "delete"},
         help="Modify recirculation schedule. Requires scheduletime, scheduleday and schedulestate",
     )
+    parser.add_argument(
+        "-directconnect",
+        action="store_true",
+        help="Connect to the gateway's advertised server instead of the default server.",
+    )
     parser.add_argument(
         "-scheduletime", help="Modify schedule for given time in format HH:MM."
     )
@@ -126,7 +131,9 @@ if __name__ == "__main__":
 
         # Create a reference to the NavienSmartControl library.
         navienSmartControl = NavienSmartControl(
-            credentials["Username"], credentials["Password"]
+            credentials["Username"],
+            credentials["Password"],
+            directConnect=args.directconnect,
         )
 
         # Perform the login.
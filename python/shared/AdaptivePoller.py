@@ -0,0 +1,326 @@
+"""
+Adaptive polling engine for NavienSmartControl devices.
+
+Each device is polled at its own interval which is derived from the last STATE
+response. While the device is active (hot water flowing, gas burning or on
+demand recirculation running) it is polled at the minimum interval, while idle
+the interval backs off exponentially up to the maximum interval. TREND_MONTH
+data is only fetched when the day rolls over and TREND_YEAR data only when the
+month rolls over.
+"""
+
+# We order the devices by their next poll time on a heap.
+import heapq
+
+# We need the calendar date to detect day and month rollover.
+import datetime
+
+# We can run the polling loop on a thread.
+import threading
+
+# We need clocks for scheduling and for timestamping samples.
+import time
+
+from .NavienSmartControl import ControlType, DeviceKey, OnDemandFlag, gatewayKey
+from .StateSubscriptions import StateSubscriptions
+from .RingBuffer import RecentSamples
+
+
+class _PolledDevice:
+    """Polling state of a single device"""
+
+    def __init__(self, key, gatewayID, fetchTrends, interval):
+        self.key = key
+        self.gatewayID = gatewayID
+        self.fetchTrends = fetchTrends
+        self.interval = interval
+        self.nextPoll = time.monotonic()
+        self.lastState = None
+        self.lastError = None
+        self.trendMonthDate = None
+        self.trendYearMonth = None
+
+
+class AdaptivePoller:
+    """Polls devices at intervals that follow their activity"""
+
+    def __init__(
+        self,
+        navienSmartControl,
+        minInterval=10.0,
+        maxInterval=300.0,
+        backoffFactor=2.0,
+        recentSamples=0,
+        trendSync=None,
+    ):
+        """
+        Construct a new 'AdaptivePoller' object.
+
+        :param navienSmartControl: The connected NavienSmartControl object (or a RequestScheduler wrapping one) used to send the requests
+        :param minInterval: Poll interval in seconds while a device is active
+        :param maxInterval: Upper bound in seconds on the poll interval while a device is idle
+        :param backoffFactor: Factor the poll interval is multiplied by for each idle poll
+        :param recentSamples: Number of STATE samples per device to keep in ring buffers (0 to keep none)
+        :param trendSync: A TrendSync to fetch the trend month and year data through, so that it is kept and merged across restarts (None to fetch it directly)
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.backoffFactor = backoffFactor
+        self.devices = {}
+        self.schedule = []
+        self.subscriptions = StateSubscriptions(
+            navienSmartControl.bigHexToInt, self.reportError
+        )
+        self.stateListeners = [self.subscriptions.update]
+        self.recentSamples = None
+        if recentSamples > 0:
+            self.recentSamples = RecentSamples(recentSamples)
+            self.stateListeners.append(self.recentSamples.append)
+        self.trendSync = trendSync
+        self.trendListeners = []
+        self.errorListeners = []
+        self.condition = threading.Condition()
+        self.running = False
+
+    def addDevice(
+        self, gatewayID, currentControlChannel, deviceNumber, fetchTrends=True
+    ):
+        """
+        Start polling a device
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to, as raw bytes
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param fetchTrends: Also fetch the trend month and year data on rollover
+        :return: The DeviceKey of the device
+        """
+        key = DeviceKey(gatewayKey(gatewayID), currentControlChannel, deviceNumber)
+        device = _PolledDevice(key, gatewayID, fetchTrends, self.minInterval)
+        with self.condition:
+            self.devices[key] = device
+            heapq.heappush(self.schedule, (device.nextPoll, key))
+            self.condition.notify()
+        return key
+
+    def removeDevice(self, key):
+        """
+        Stop polling a device
+
+        :param key: The DeviceKey of the device
+        """
+        with self.condition:
+            self.devices.pop(key, None)
+        self.subscriptions.forget(key)
+        if self.recentSamples is not None:
+            self.recentSamples.forget(key)
+
+    def addStateListener(self, callback):
+        """
+        Register a callback for each STATE response
+
+        :param callback: Called with the DeviceKey, the sample timestamp and the parsed state response data
+        """
+        self.stateListeners.append(callback)
+
+    def subscribe(self, device, fields=None, callback=None):
+        """
+        Subscribe to changes of STATE fields, rather than to every STATE response
+
+        :param device: The DeviceKey of the device (None for every device)
+        :param fields: The names of the fields to watch, e.g. ["hotWaterCurrentTemperature", "powerStatus", "errorCD"] (None for every field)
+        :param callback: Called with the DeviceKey, the sample timestamp and a dictionary of field name to (old, new) values
+        :return: The Subscription, to pass to unsubscribe()
+        """
+        return self.subscriptions.subscribe(device, fields, callback)
+
+    def unsubscribe(self, subscription):
+        """
+        Cancel a subscription
+
+        :param subscription: The Subscription returned by subscribe()
+        """
+        self.subscriptions.unsubscribe(subscription)
+
+    def addTrendListener(self, callback):
+        """
+        Register a callback for each TREND_MONTH and TREND_YEAR response
+
+        :param callback: Called with the DeviceKey, the sample timestamp and the parsed trend response data
+        """
+        self.trendListeners.append(callback)
+
+    def addErrorListener(self, callback):
+        """
+        Register a callback for failed polls and for exceptions raised by the listeners and subscribers
+
+        :param callback: Called with the DeviceKey and the exception raised
+        """
+        self.errorListeners.append(callback)
+
+    def isActive(self, stateData):
+        """
+        Determine from a STATE response if a device is in use
+
+        :param stateData: The parsed state response data
+        :return: True while hot water is flowing, gas is burning or on demand is running
+        """
+        return (
+            self.navienSmartControl.bigHexToInt(stateData["hotWaterFlowRate"]) > 0
+            or self.navienSmartControl.bigHexToInt(stateData["gasInstantUse"]) > 0
+            or stateData["useOnDemand"]
+            in [OnDemandFlag.ON.value, OnDemandFlag.WARMUP.value]
+        )
+
+    def pollDevice(self, device):
+        """
+        Poll a single device and work out its next poll interval
+
+        :param device: The device to poll
+        """
+        try:
+            stateData = self.navienSmartControl.sendStateRequest(
+                device.gatewayID, device.key.channel, device.key.deviceNumber
+            )
+            timestamp = time.time()
+            if ControlType(stateData["controlType"]) != ControlType.STATE:
+                raise Exception(
+                    "Error: Unexpected "
+                    + ControlType(stateData["controlType"]).name
+                    + " response to state request"
+                )
+            active = self.isActive(stateData)
+        except Exception as e:
+            device.lastError = e
+            device.interval = min(
+                device.interval * self.backoffFactor, self.maxInterval
+            )
+            self.reportError(device.key, e)
+            return
+
+        device.lastState = stateData
+        device.lastError = None
+        if active:
+            device.interval = self.minInterval
+        else:
+            device.interval = min(
+                device.interval * self.backoffFactor, self.maxInterval
+            )
+        # Failures past this point are reported but don't count against the device's poll
+        self.notify(self.stateListeners, device.key, timestamp, stateData)
+
+        if device.fetchTrends:
+            try:
+                self.pollTrends(device)
+            except Exception as e:
+                self.reportError(device.key, e)
+
+    def notify(self, listeners, key, *args):
+        """
+        Call each listener, reporting the exceptions they raise without stopping the others
+
+        :param listeners: The callbacks to call
+        :param key: The DeviceKey of the device
+        :param args: The remaining arguments to pass to the callbacks
+        """
+        for callback in listeners:
+            try:
+                callback(key, *args)
+            except Exception as e:
+                self.reportError(key, e)
+
+    def reportError(self, key, e):
+        """
+        Pass an exception to the error listeners
+
+        :param key: The DeviceKey of the device
+        :param e: The exception raised
+        """
+        for callback in self.errorListeners:
+            callback(key, e)
+
+    def pollTrends(self, device):
+        """
+        Fetch the trend month and year data of a device if the day or month rolled over since the last fetch
+
+        :param device: The device to fetch the trends of
+        """
+        if self.trendSync is not None:
+            for trendData in self.trendSync.sync(
+                device.gatewayID, device.key.channel, device.key.deviceNumber
+            ):
+                self.notify(self.trendListeners, device.key, time.time(), trendData)
+            return
+        today = datetime.date.today()
+        if device.trendMonthDate != today:
+            trendData = self.navienSmartControl.sendTrendMonthRequest(
+                device.gatewayID, device.key.channel, device.key.deviceNumber
+            )
+            device.trendMonthDate = today
+            self.notify(self.trendListeners, device.key, time.time(), trendData)
+        if device.trendYearMonth != (today.year, today.month):
+            trendData = self.navienSmartControl.sendTrendYearRequest(
+                device.gatewayID, device.key.channel, device.key.deviceNumber
+            )
+            device.trendYearMonth = (today.year, today.month)
+            self.notify(self.trendListeners, device.key, time.time(), trendData)
+
+    def pollOnce(self):
+        """
+        Poll every device that is due
+
+        :return: Seconds until the next device is due (None if there are no devices)
+        """
+        while True:
+            with self.condition:
+                if not self.schedule:
+                    return None
+                nextPoll, key = self.schedule[0]
+                device = self.devices.get(key)
+                if (device is None) or (device.nextPoll != nextPoll):
+                    # Stale entry for a removed or rescheduled device
+                    heapq.heappop(self.schedule)
+                    continue
+                now = time.monotonic()
+                if nextPoll > now:
+                    return nextPoll - now
+                heapq.heappop(self.schedule)
+            self.pollDevice(device)
+            with self.condition:
+                # Unless pollNow() already rescheduled it while it was being polled
+                if (self.devices.get(key) is device) and (device.nextPoll == nextPoll):
+                    device.nextPoll = time.monotonic() + device.interval
+                    heapq.heappush(self.schedule, (device.nextPoll, key))
+
+    def pollNow(self, key):
+        """
+        Reset a device to the minimum interval and poll it on the next cycle (e.g. after a control request)
+
+        :param key: The DeviceKey of the device
+        """
+        with self.condition:
+            device = self.devices[key]
+            device.interval = self.minInterval
+            device.nextPoll = time.monotonic()
+            heapq.heappush(self.schedule, (device.nextPoll, key))
+            self.condition.notify()
+
+    def run(self):
+        """
+        Poll the devices until stop() is called
+        """
+        self.running = True
+        while self.running:
+            delay = self.pollOnce()
+            with self.condition:
+                if self.running:
+                    self.condition.wait(delay)
+
+    def stop(self):
+        """
+        Stop a running polling loop
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
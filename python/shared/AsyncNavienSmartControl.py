@@ -0,0 +1,326 @@
+"""
+asyncio client for the NavienSmartControl binary API.
+
+The framing, request encoding and response parsing are shared with the
+blocking client through NavienProtocol, only the socket handling differs. The
+REST login is still made with requests, so it is run in the default executor.
+"""
+
+# We use asyncio streams of bytes through a protocol.
+import asyncio
+
+# We keep the waiting requests of a connection in order.
+import collections
+
+from .NavienSmartControl import (
+    NavienSmartControl,
+    NavienProtocol,
+    ControlSorting,
+    ControlType,
+    DeviceControl,
+    OnOFFFlag,
+    gatewayKey,
+)
+
+
+class _GatewayStreamProtocol(asyncio.Protocol):
+    """Feeds received bytes into a NavienProtocol and resolves the waiting requests"""
+
+    def __init__(self, navienProtocol, timeout):
+        self.navienProtocol = navienProtocol
+        self.timeout = timeout
+        self.transport = None
+        self.waiters = collections.deque()
+        self.lock = asyncio.Lock()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.dispatch(self.navienProtocol.receiveData(data))
+
+    def dispatch(self, events):
+        """
+        Resolve the waiting requests with received events
+
+        :param events: List of ProtocolEvents
+        """
+        for event in events:
+            # Responses arrive in request order, anything else is dropped.
+            if self.waiters:
+                waiter = self.waiters.popleft()
+                if not waiter.done():
+                    waiter.set_result(event)
+
+    def connection_lost(self, exc):
+        self.navienProtocol.receiveData(b"")
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_exception(
+                    exc or ConnectionError("Error: Connection closed by the server.")
+                )
+
+    async def exchange(self, data):
+        """
+        Send bytes and wait for the next complete frame
+
+        :param data: The bytes to send
+        :return: The ProtocolEvent of the response frame
+        """
+        async with self.lock:
+            if (self.transport is None) or self.transport.is_closing():
+                raise ConnectionError("Error: Connection closed by the server.")
+            waiter = asyncio.get_running_loop().create_future()
+            self.waiters.append(waiter)
+            self.transport.write(data)
+            try:
+                event = await asyncio.wait_for(asyncio.shield(waiter), self.timeout)
+            except asyncio.TimeoutError:
+                # Take what was buffered as a complete frame so it can't be prepended to the next response
+                self.dispatch(self.navienProtocol.receiveTimeout())
+                if not waiter.done():
+                    # A late response would be taken for the answer to the next request, so give up on the connection
+                    self.waiters.remove(waiter)
+                    self.transport.close()
+                    raise TimeoutError(
+                        "Error: Timed out waiting for a response from the server."
+                    )
+                event = waiter.result()
+        if event.error is not None:
+            raise event.error
+        return event
+
+
+class AsyncNavienSmartControl:
+    """asyncio equivalent of the NavienSmartControl class"""
+
+    def __init__(self, userID, passwd, rateLimiter=None, timeout=30.0):
+        """
+        Construct a new 'AsyncNavienSmartControl' object.
+
+        :param userID: The user ID used to log in to the mobile application
+        :param passwd: The corresponding user's password
+        :param rateLimiter: Optional RateLimiter shared by login, connect and sendRequest
+        :param timeout: Seconds to wait for a response before the connection is given up
+        :return: returns nothing
+        """
+        # The blocking client provides the REST login and the response parsers.
+        self.navienSmartControl = NavienSmartControl(userID, passwd)
+        self.userID = userID
+        self.rateLimiter = rateLimiter
+        self.timeout = timeout
+        self.connections = {}
+
+    async def throttle(self, gatewayID=None):
+        """
+        Wait for the rate limiter without blocking the event loop
+
+        :param gatewayID: The gatewayID the request is for (None for login)
+        """
+        if self.rateLimiter is not None:
+            delay = self.rateLimiter.reserve(gatewayID)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    async def login(self):
+        """
+        Login to the REST API
+
+        :return: The gateway list
+        """
+        await self.throttle()
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.navienSmartControl.login
+        )
+
+    async def connect(self, gatewayID):
+        """
+        Connect to the binary API service
+
+        :param gatewayID: The gatewayID that we want to connect to
+        :return: The response data (normally a channel information response)
+        """
+        await self.throttle(gatewayID)
+        await self.disconnect(gatewayID)
+        navienProtocol = NavienProtocol(self.navienSmartControl.parseResponse)
+        transport, protocol = await asyncio.get_running_loop().create_connection(
+            lambda: _GatewayStreamProtocol(navienProtocol, self.timeout),
+            NavienSmartControl.navienServer,
+            NavienSmartControl.navienServerSocketPort,
+        )
+        self.connections[gatewayKey(gatewayID)] = protocol
+        event = await protocol.exchange(
+            navienProtocol.startHandshake(self.userID, gatewayID)
+        )
+        return event.response
+
+    async def disconnect(self, gatewayID=None):
+        """
+        Close the connection to a gateway
+
+        :param gatewayID: The gatewayID to disconnect from (None to close every connection)
+        """
+        if gatewayID is None:
+            protocols = list(self.connections.values())
+            self.connections.clear()
+        else:
+            protocols = [self.connections.pop(gatewayKey(gatewayID), None)]
+        for protocol in protocols:
+            if (protocol is not None) and (protocol.transport is not None):
+                protocol.transport.close()
+
+    async def sendRequest(
+        self,
+        gatewayID,
+        currentControlChannel,
+        deviceNumber,
+        controlSorting,
+        infoItem,
+        controlItem,
+        controlValue,
+        WeeklyDay,
+    ):
+        """
+        Main handler for sending a request to the binary API
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param controlSorting: Corresponds with the ControlSorting enum (info or control)
+        :param infoItem: Corresponds with the ControlType enum
+        :param controlItem: Corresponds with the ControlType enum when controlSorting is control
+        :param controlValue: Value being changed when controlling
+        :param WeeklyDay: WeeklyDay dictionary (values are ignored when not changing schedule, but must be present)
+        :return: Parsed response data
+        """
+        protocol = self.connections.get(gatewayKey(gatewayID))
+        if protocol is None:
+            raise Exception(
+                "Error: Not connected. Please connect() to the gateway first."
+            )
+        await self.throttle(gatewayID)
+        event = await protocol.exchange(
+            protocol.navienProtocol.sendRequest(
+                gatewayID,
+                currentControlChannel,
+                deviceNumber,
+                controlSorting,
+                infoItem,
+                controlItem,
+                controlValue,
+                WeeklyDay,
+            )
+        )
+        return event.response
+
+    # ----- Convenience methods for sending requests ----- #
+
+    async def sendInfoRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, infoItem
+    ):
+        """
+        Send an information request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param infoItem: Corresponds with the ControlType enum
+        :return: Parsed response data
+        """
+        return await self.sendRequest(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            ControlSorting.INFO.value,
+            ControlType(infoItem).value,
+            0x00,
+            0x00,
+            self.navienSmartControl.initWeeklyDay(),
+        )
+
+    async def sendStateRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send state request
+
+        :return: Parsed response data
+        """
+        return await self.sendInfoRequest(
+            gatewayID, currentControlChannel, deviceNumber, ControlType.STATE
+        )
+
+    async def sendTrendSampleRequest(
+        self, gatewayID, currentControlChannel, deviceNumber
+    ):
+        """
+        Send trend sample request
+
+        :return: Parsed response data
+        """
+        return await self.sendInfoRequest(
+            gatewayID, currentControlChannel, deviceNumber, ControlType.TREND_SAMPLE
+        )
+
+    async def sendTrendMonthRequest(
+        self, gatewayID, currentControlChannel, deviceNumber
+    ):
+        """
+        Send trend month request
+
+        :return: Parsed response data
+        """
+        return await self.sendInfoRequest(
+            gatewayID, currentControlChannel, deviceNumber, ControlType.TREND_MONTH
+        )
+
+    async def sendTrendYearRequest(
+        self, gatewayID, currentControlChannel, deviceNumber
+    ):
+        """
+        Send trend year request
+
+        :return: Parsed response data
+        """
+        return await self.sendInfoRequest(
+            gatewayID, currentControlChannel, deviceNumber, ControlType.TREND_YEAR
+        )
+
+    async def sendPowerControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, powerState
+    ):
+        """
+        Send device power control request
+
+        :param powerState: The power state as identified in the OnOFFFlag enum
+        :return: Parsed response data
+        """
+        return await self.sendRequest(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            ControlSorting.CONTROL.value,
+            ControlType.UNKNOWN.value,
+            DeviceControl.POWER.value,
+            OnOFFFlag(powerState).value,
+            self.navienSmartControl.initWeeklyDay(),
+        )
+
+    async def sendOnDemandControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData
+    ):
+        """
+        Send device on demand control request (the equivalent of pressing the HotButton)
+
+        :param channelData: The channel information, as taken by the blocking client
+        :return: Parsed response data
+        """
+        return await self.sendRequest(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            ControlSorting.CONTROL.value,
+            ControlType.UNKNOWN.value,
+            DeviceControl.ON_DEMAND.value,
+            OnOFFFlag.ON.value,
+            self.navienSmartControl.initWeeklyDay(),
+        )
@@ -0,0 +1,224 @@
+"""
+Per-gateway circuit breaker for NavienSmartControl.
+
+A CircuitBreaker is passed to NavienSmartControl, which reports the outcome of
+every connect() and sendRequest() call for a gateway to it. After a number of
+consecutive failures the gateway's circuit opens and further calls fail
+immediately with CircuitOpenError instead of waiting on a gateway that is
+offline. Once the cool-down has passed the circuit is half-open: a single
+probe call is let through, which closes the circuit again on success or
+reopens it on failure. Only connection errors, timeouts (both OSError) and
+ProtocolError count as failures of the gateway; any other exception leaves the
+circuit as it was.
+"""
+
+# We report outcomes through a context manager.
+import contextlib
+
+# We use Python enums.
+import enum
+
+# The breaker is shared between threads.
+import threading
+
+# We need a clock for the cool-down.
+import time
+
+from .NavienSmartControl import ProtocolError, gatewayKey
+
+# The exceptions that tell the gateway is failing (TimeoutError and ConnectionError are OSError)
+GATEWAY_FAILURES = (OSError, ProtocolError)
+
+
+class CircuitState(enum.Enum):
+    CLOSED = 0
+    OPEN = 1
+    HALF_OPEN = 2
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a gateway whose circuit is open"""
+
+    def __init__(self, gatewayID, retryAfter):
+        """
+        Construct a new 'CircuitOpenError' object.
+
+        :param gatewayID: The gatewayID of the open circuit
+        :param retryAfter: Seconds until the circuit lets a probe through
+        :return: returns nothing
+        """
+        super().__init__(
+            "Error: Gateway "
+            + gatewayID
+            + " is failing, retry in "
+            + str(round(retryAfter, 1))
+            + " seconds."
+        )
+        self.gatewayID = gatewayID
+        self.retryAfter = retryAfter
+
+
+class _GatewayCircuit:
+    """Failure counts and state of a single gateway"""
+
+    def __init__(self):
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.openedAt = None
+        self.probing = False
+
+
+class CircuitBreaker:
+    """Fails calls to a gateway fast after repeated failures"""
+
+    def __init__(self, failureThreshold=5, coolDown=30.0):
+        """
+        Construct a new 'CircuitBreaker' object.
+
+        :param failureThreshold: Consecutive failures after which a gateway's circuit opens
+        :param coolDown: Seconds an open circuit fails fast before letting a probe through
+        :return: returns nothing
+        """
+        self.failureThreshold = failureThreshold
+        self.coolDown = coolDown
+        self.lock = threading.Lock()
+        self.circuits = {}
+
+    def getCircuit(self, key):
+        """
+        Find or create the circuit of a gateway (caller must hold the lock)
+
+        :param key: The gatewayKey of the gateway
+        :return: The gateway's circuit
+        """
+        circuit = self.circuits.get(key)
+        if circuit is None:
+            circuit = _GatewayCircuit()
+            self.circuits[key] = circuit
+        return circuit
+
+    def allow(self, gatewayID):
+        """
+        Check whether a call to a gateway may go ahead
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        :return: True if the call is the half-open probe
+        """
+        key = gatewayKey(gatewayID)
+        with self.lock:
+            circuit = self.getCircuit(key)
+            if circuit.state == CircuitState.CLOSED:
+                return False
+            if circuit.state == CircuitState.OPEN:
+                retryAfter = circuit.openedAt + self.coolDown - time.monotonic()
+                if retryAfter > 0:
+                    raise CircuitOpenError(key, retryAfter)
+                circuit.state = CircuitState.HALF_OPEN
+            if circuit.probing:
+                # Only a single probe at a time, everything else keeps failing fast.
+                raise CircuitOpenError(key, 0)
+            circuit.probing = True
+            return True
+
+    def recordSuccess(self, gatewayID):
+        """
+        Record a successful call, closing the gateway's circuit
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        """
+        with self.lock:
+            circuit = self.getCircuit(gatewayKey(gatewayID))
+            circuit.state = CircuitState.CLOSED
+            circuit.failures = 0
+            circuit.probing = False
+
+    def recordFailure(self, gatewayID):
+        """
+        Record a failed call, opening the gateway's circuit when the threshold is reached or the probe failed
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        """
+        with self.lock:
+            circuit = self.getCircuit(gatewayKey(gatewayID))
+            circuit.failures += 1
+            if (circuit.state == CircuitState.HALF_OPEN) or (
+                circuit.failures >= self.failureThreshold
+            ):
+                circuit.state = CircuitState.OPEN
+                circuit.openedAt = time.monotonic()
+            circuit.probing = False
+
+    def endProbe(self, gatewayID):
+        """
+        Let the next call through a half-open circuit probe the gateway
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        """
+        with self.lock:
+            self.getCircuit(gatewayKey(gatewayID)).probing = False
+
+    @contextlib.contextmanager
+    def guard(self, gatewayID):
+        """
+        Context manager failing fast while the circuit is open and recording the outcome of its body
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        """
+        probe = self.allow(gatewayID)
+        try:
+            yield
+        except GATEWAY_FAILURES:
+            self.recordFailure(gatewayID)
+            raise
+        else:
+            self.recordSuccess(gatewayID)
+        finally:
+            # The body may have been interrupted without an outcome (e.g. KeyboardInterrupt or a bug in the caller)
+            if probe:
+                self.endProbe(gatewayID)
+
+    def call(self, gatewayID, function, *args):
+        """
+        Call a function through the gateway's circuit
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        :param function: The function to call
+        :param args: The arguments to pass to the function
+        :return: The function's result
+        """
+        with self.guard(gatewayID):
+            return function(*args)
+
+    def state(self, gatewayID):
+        """
+        Get the state of a gateway's circuit
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        :return: The CircuitState (an open circuit past its cool-down is reported as half-open)
+        """
+        with self.lock:
+            circuit = self.circuits.get(gatewayKey(gatewayID))
+            if circuit is None:
+                return CircuitState.CLOSED
+            if (circuit.state == CircuitState.OPEN) and (
+                time.monotonic() - circuit.openedAt >= self.coolDown
+            ):
+                return CircuitState.HALF_OPEN
+            return circuit.state
+
+    def states(self):
+        """
+        Snapshot of the circuits of every gateway seen so far
+
+        :return: Dictionary of gatewayKey to a dictionary of the state name and consecutive failures
+        """
+        with self.lock:
+            keys = list(self.circuits)
+        result = {}
+        for key in keys:
+            state = self.state(key)
+            result[key] = {
+                "state": state.name,
+                "failures": self.circuits[key].failures,
+            }
+        return result
@@ -0,0 +1,353 @@
+"""
+Columnar on-disk store for STATE samples.
+
+Each device gets a directory per (UTC) day holding one raw, fixed-width,
+little-endian file per field plus a timestamp column. Appends only extend the
+files, and a range query only reads the timestamp column of each day in range
+and then the slices of the requested columns, so months of samples come back
+quickly. NumPy is used to memory-map the columns when it is installed,
+otherwise the standard library array module is used.
+"""
+
+# We fall back to array when NumPy isn't installed.
+import array
+
+# We find the time range in the sorted timestamp column.
+import bisect
+
+# The store is partitioned by day.
+import datetime
+
+# We use os.path to build the partition paths.
+import os
+
+# The column files are little-endian whatever the platform.
+import sys
+
+# Appends may come from several threads.
+import threading
+
+# NumPy is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .NavienSmartControl import DeviceKey, gatewayKey
+
+# The column holding the sample timestamps (seconds since the epoch)
+TIMESTAMP_COLUMN = ("timestamp", "d")
+
+# The STATE fields stored by default, with their array typecodes
+STATE_COLUMNS = [
+    ("hotWaterSettingTemperature", "i"),
+    ("hotWaterCurrentTemperature", "i"),
+    ("hotWaterTemperature", "i"),
+    ("heatSettingTemperature", "i"),
+    ("currentWorkingFluidTemperature", "i"),
+    ("currentReturnWaterTemperature", "i"),
+    ("recirculationSettingTemperature", "i"),
+    ("recirculationCurrentTemperature", "i"),
+    ("hotWaterFlowRate", "i"),
+    ("gasInstantUse", "i"),
+    # A 4 byte counter that would go negative as a signed integer past 2^31
+    ("gasAccumulatedUse", "I"),
+    ("errorCD", "i"),
+    ("powerStatus", "i"),
+    ("heatStatus", "i"),
+    ("useOnDemand", "i"),
+    ("weeklyControl", "i"),
+]
+
+# NumPy equivalents of the array typecodes, fixed to little-endian
+NUMPY_TYPES = {"d": "<f8", "i": "<i4", "I": "<u4"}
+
+
+def fieldValue(value):
+    """
+    Turn a parsed STATE field into an integer
+
+    :param value: The field as parsed (an int, or little-endian bytes as converted by bigHexToInt)
+    :return: The integer value
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return int.from_bytes(value, "little")
+    return int(value or 0)
+
+
+def deviceDirectory(device):
+    """
+    Get the name of the directory holding the data of a device
+
+    :param device: The DeviceKey of the device
+    :return: The directory name
+    """
+    return (
+        gatewayKey(device.gatewayID)
+        + "_"
+        + str(device.channel)
+        + "_"
+        + str(device.deviceNumber)
+    )
+
+
+def parseDeviceDirectory(name):
+    """
+    Get the device a directory holds the data of
+
+    :param name: The directory name
+    :return: The DeviceKey of the device
+    """
+    gatewayID, channel, deviceNumber = name.split("_")
+    return DeviceKey(gatewayID, int(channel), int(deviceNumber))
+
+
+class ColumnarTable:
+    """A directory of equally long, fixed-width column files"""
+
+    def __init__(self, directory, columns):
+        """
+        Construct a new 'ColumnarTable' object.
+
+        :param directory: The directory holding the column files
+        :param columns: List of (name, typecode) tuples, the first being the sort column
+        :return: returns nothing
+        """
+        self.directory = directory
+        self.columns = columns
+        self.typecodes = dict(columns)
+
+    def columnPath(self, name):
+        """
+        Get the path of a column file
+
+        :param name: The column name
+        :return: The path
+        """
+        return os.path.join(self.directory, name + ".col")
+
+    def append(self, rows):
+        """
+        Append rows to the column files
+
+        :param rows: List of tuples with a value for each column
+        """
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # A row is either in every column or in none, so the columns stay aligned
+        rowCount = self.rowCount()
+        self.truncate(rowCount)
+        try:
+            for i, (name, typecode) in enumerate(self.columns):
+                values = array.array(typecode, [row[i] for row in rows])
+                if sys.byteorder == "big":
+                    values.byteswap()
+                with open(self.columnPath(name), "ab") as out_file:
+                    values.tofile(out_file)
+        except Exception:
+            self.truncate(rowCount)
+            raise
+
+    def truncate(self, rowCount):
+        """
+        Cut every column file down to a number of rows, dropping partially written rows
+
+        :param rowCount: The number of rows to keep
+        """
+        for name, typecode in self.columns:
+            path = self.columnPath(name)
+            size = rowCount * array.array(typecode).itemsize
+            if os.path.exists(path) and (os.path.getsize(path) > size):
+                with open(path, "r+b") as out_file:
+                    out_file.truncate(size)
+
+    def rowCount(self):
+        """
+        Count the complete rows (a row only counts once it was written to every column)
+
+        :return: The number of rows
+        """
+        counts = []
+        for name, typecode in self.columns:
+            path = self.columnPath(name)
+            if not os.path.exists(path):
+                return 0
+            counts.append(os.path.getsize(path) // array.array(typecode).itemsize)
+        return min(counts)
+
+    def readColumn(self, name, start=0, stop=None):
+        """
+        Read a slice of a column
+
+        :param name: The column name
+        :param start: The first row
+        :param stop: The row after the last (None for all rows)
+        :return: A NumPy array if NumPy is installed, otherwise an array.array
+        """
+        typecode = self.typecodes[name]
+        if stop is None:
+            stop = self.rowCount()
+        count = max(0, stop - start)
+        if numpy is not None:
+            if count == 0:
+                return numpy.empty(0, dtype=NUMPY_TYPES[typecode])
+            column = numpy.memmap(
+                self.columnPath(name),
+                dtype=NUMPY_TYPES[typecode],
+                mode="r",
+                offset=start * numpy.dtype(NUMPY_TYPES[typecode]).itemsize,
+                shape=(count,),
+            )
+            return numpy.array(column)
+        values = array.array(typecode)
+        with open(self.columnPath(name), "rb") as in_file:
+            in_file.seek(start * values.itemsize)
+            values.fromfile(in_file, count)
+        if sys.byteorder == "big":
+            values.byteswap()
+        return values
+
+    def range(self, start, end):
+        """
+        Find the rows whose sort column lies in a range
+
+        :param start: The first value (None for the first row)
+        :param end: The value after the last, exclusive (None for the last row)
+        :return: (first row, row after the last)
+        """
+        keys = self.readColumn(self.columns[0][0])
+        if numpy is not None:
+            first = 0 if start is None else int(numpy.searchsorted(keys, start, "left"))
+            last = (
+                len(keys) if end is None else int(numpy.searchsorted(keys, end, "left"))
+            )
+        else:
+            first = 0 if start is None else bisect.bisect_left(keys, start)
+            last = len(keys) if end is None else bisect.bisect_left(keys, end)
+        return first, last
+
+
+class ColumnarStateStore:
+    """Appends STATE samples per device and day into ColumnarTables and answers range queries"""
+
+    def __init__(self, root, columns=None, flushRows=1000):
+        """
+        Construct a new 'ColumnarStateStore' object.
+
+        :param root: The directory the store lives in
+        :param columns: List of (field name, typecode) tuples to store (defaults to STATE_COLUMNS)
+        :param flushRows: Number of buffered samples after which they are written to disk
+        :return: returns nothing
+        """
+        self.root = root
+        self.columns = [TIMESTAMP_COLUMN] + list(columns or STATE_COLUMNS)
+        self.flushRows = flushRows
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.pendingCount = 0
+
+    @staticmethod
+    def day(timestamp):
+        """
+        Get the partition a timestamp falls in
+
+        :param timestamp: Seconds since the epoch
+        :return: The UTC date
+        """
+        return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).date()
+
+    def table(self, device, day):
+        """
+        Get the table of a device and day
+
+        :param device: The DeviceKey of the device
+        :param day: The UTC date
+        :return: The ColumnarTable
+        """
+        return ColumnarTable(
+            os.path.join(self.root, deviceDirectory(device), day.isoformat()),
+            self.columns,
+        )
+
+    def append(self, device, timestamp, stateData):
+        """
+        Buffer a STATE sample (has the signature of an AdaptivePoller state listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        row = (timestamp,) + tuple(
+            fieldValue(stateData.get(name)) for name, typecode in self.columns[1:]
+        )
+        with self.lock:
+            self.pending.setdefault((device, self.day(timestamp)), []).append(row)
+            self.pendingCount += 1
+            flush = self.pendingCount >= self.flushRows
+        if flush:
+            self.flush()
+
+    def flush(self):
+        """
+        Write the buffered samples to disk
+
+        Samples stay buffered until they were written, so after a failed write (e.g. a full disk) the next flush retries them.
+        """
+        with self.lock:
+            for key in list(self.pending):
+                device, day = key
+                rows = self.pending[key]
+                self.table(device, day).append(rows)
+                del self.pending[key]
+                self.pendingCount -= len(rows)
+
+    def devices(self):
+        """
+        List the devices with stored samples
+
+        :return: List of DeviceKey
+        """
+        devices = []
+        if os.path.isdir(self.root):
+            for name in sorted(os.listdir(self.root)):
+                devices.append(parseDeviceDirectory(name))
+        return devices
+
+    def query(self, device, start, end, fields=None):
+        """
+        Read the samples of a device in a time range
+
+        :param device: The DeviceKey of the device
+        :param start: The earliest timestamp
+        :param end: The latest timestamp, exclusive
+        :param fields: The field names to read (None for every stored field)
+        :return: Dictionary of "timestamp" and each field to a NumPy array (array.array without NumPy)
+        """
+        self.flush()
+        if fields is None:
+            fields = [name for name, typecode in self.columns[1:]]
+        names = ["timestamp"] + list(fields)
+        parts = {name: [] for name in names}
+        day = self.day(start)
+        while day <= self.day(end):
+            table = self.table(device, day)
+            if table.rowCount() > 0:
+                first, last = table.range(start, end)
+                if last > first:
+                    for name in names:
+                        parts[name].append(table.readColumn(name, first, last))
+            day += datetime.timedelta(days=1)
+        result = {}
+        for name in names:
+            typecode = dict(self.columns)[name]
+            if numpy is not None:
+                result[name] = (
+                    numpy.concatenate(parts[name])
+                    if parts[name]
+                    else numpy.empty(0, dtype=NUMPY_TYPES[typecode])
+                )
+            else:
+                result[name] = array.array(typecode)
+                for part in parts[name]:
+                    result[name].extend(part)
+        return result
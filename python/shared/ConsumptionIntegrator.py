@@ -0,0 +1,182 @@
+"""
+Streaming estimate of the gas and hot water consumption of devices.
+
+The gasAccumulatedUse counter of a STATE response only moves in steps of
+0.1 m3, while gasInstantUse and hotWaterFlowRate are reported in every STATE
+response. The integrator integrates both rates between successive samples with
+the trapezoidal rule, converts the integrated heat to gas volume through the
+heating value of the gas and re-anchors the gas estimate to the counter
+whenever it changes, so the estimate never runs further than one counter step
+ahead. The totalGasAccumulateSum of a TREND_SAMPLE response is a separate
+counter, so it gets an estimate of its own anchored to it.
+"""
+
+# The devices may be fed from several polling threads.
+import threading
+
+from .NavienSmartControl import ControlType
+
+# kcal released per m3 of gas, a typical value for natural gas
+DEFAULT_HEATING_VALUE = 9500.0
+
+
+class _CounterAnchor:
+    """The last reading of a gas counter and the heat integrated since"""
+
+    def __init__(self):
+        self.counter = None
+        self.counterGas = 0.0
+        self.heatSinceCounter = 0.0
+
+
+class _DeviceConsumption:
+    """Integration state of a single device"""
+
+    def __init__(self):
+        self.timestamp = None
+        self.gasRate = 0.0
+        self.flowRate = 0.0
+        # The STATE gasAccumulatedUse and the TREND_SAMPLE totalGasAccumulateSum counters
+        self.stateAnchor = _CounterAnchor()
+        self.trendAnchor = _CounterAnchor()
+        self.heat = 0.0
+        self.hotWater = 0.0
+
+
+class ConsumptionIntegrator:
+    """Integrates the gas usage and hot water flow of each device between samples"""
+
+    def __init__(
+        self, navienSmartControl, heatingValue=DEFAULT_HEATING_VALUE, maxGap=900.0
+    ):
+        """
+        Construct a new 'ConsumptionIntegrator' object.
+
+        :param navienSmartControl: The NavienSmartControl object (or a RequestScheduler wrapping one) used to convert the fields
+        :param heatingValue: The heating value of the gas in kcal per m3
+        :param maxGap: Samples further apart than this many seconds are not integrated over
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.heatingValue = heatingValue
+        self.maxGap = maxGap
+        self.lock = threading.Lock()
+        self.devices = {}
+
+    def anchor(self, anchor, counter):
+        """
+        Re-anchor a gas estimate to its counter if it changed (caller must hold the lock)
+
+        :param anchor: The _CounterAnchor of the counter
+        :param counter: The raw counter value (in 0.1 m3)
+        """
+        if counter != anchor.counter:
+            anchor.counter = counter
+            anchor.counterGas = counter / 10.0
+            anchor.heatSinceCounter = 0.0
+
+    def estimate(self, anchor):
+        """
+        Estimate the reading of a counter (caller must hold the lock)
+
+        :param anchor: The _CounterAnchor of the counter
+        :return: The estimated reading in m3, capped at the next counter step
+        """
+        return min(
+            anchor.counterGas + anchor.heatSinceCounter / self.heatingValue,
+            anchor.counterGas + 0.1,
+        )
+
+    def update(self, device, timestamp, stateData):
+        """
+        Integrate a STATE sample (has the signature of an AdaptivePoller state listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        gasRate = self.navienSmartControl.gasInstantUseKcal(stateData)
+        flowRate = (
+            self.navienSmartControl.bigHexToInt(stateData["hotWaterFlowRate"]) / 10.0
+        )
+        counter = self.navienSmartControl.bigHexToInt(stateData["gasAccumulatedUse"])
+        with self.lock:
+            state = self.devices.get(device)
+            if state is None:
+                state = _DeviceConsumption()
+                self.devices[device] = state
+            if state.timestamp is not None:
+                elapsed = timestamp - state.timestamp
+                if elapsed <= 0:
+                    # Out of order
+                    return
+                if elapsed <= self.maxGap:
+                    heat = (state.gasRate + gasRate) / 2.0 * elapsed / 3600.0
+                    state.heat += heat
+                    state.stateAnchor.heatSinceCounter += heat
+                    state.trendAnchor.heatSinceCounter += heat
+                    state.hotWater += (state.flowRate + flowRate) / 2.0 * elapsed / 60.0
+            state.timestamp = timestamp
+            state.gasRate = gasRate
+            state.flowRate = flowRate
+            self.anchor(state.stateAnchor, counter)
+
+    def updateTrend(self, device, timestamp, trendData):
+        """
+        Re-anchor the estimate of the TREND_SAMPLE counter (has the signature of an AdaptivePoller trend listener, other responses are ignored)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param trendData: The parsed trend response data
+        """
+        if trendData["controlType"] != ControlType.TREND_SAMPLE.value:
+            return
+        counter = self.navienSmartControl.bigHexToInt(
+            trendData["totalGasAccumulateSum"]
+        )
+        with self.lock:
+            state = self.devices.get(device)
+            if state is None:
+                state = _DeviceConsumption()
+                self.devices[device] = state
+            self.anchor(state.trendAnchor, counter)
+
+    def consumption(self, device):
+        """
+        Get the consumption estimate of a device
+
+        :param device: The DeviceKey of the device
+        :return: Dictionary with the timestamp of the last sample, gas (estimated gasAccumulatedUse reading in m3), gasCounter (last gasAccumulatedUse reading in m3), trendGas and trendGasCounter (the same for totalGasAccumulateSum), heat (kcal) and hotWater (liters) integrated since the first sample, or None if no counter was read yet (the values of a counter not read yet are None)
+        """
+        with self.lock:
+            state = self.devices.get(device)
+            if (state is None) or (
+                (state.stateAnchor.counter is None)
+                and (state.trendAnchor.counter is None)
+            ):
+                return None
+            result = {
+                "timestamp": state.timestamp,
+                "heat": state.heat,
+                "hotWater": state.hotWater,
+            }
+            for name, anchor in [
+                ("gas", state.stateAnchor),
+                ("trendGas", state.trendAnchor),
+            ]:
+                if anchor.counter is None:
+                    result[name] = None
+                    result[name + "Counter"] = None
+                else:
+                    result[name] = self.estimate(anchor)
+                    result[name + "Counter"] = anchor.counterGas
+            return result
+
+    def forget(self, device):
+        """
+        Drop the integration state of a device
+
+        :param device: The DeviceKey of the device
+        """
+        with self.lock:
+            self.devices.pop(device, None)
@@ -0,0 +1,320 @@
+"""
+Write coalescing queue for NavienSmartControl control requests.
+
+Rapid successive control requests for the same device (for example from a UI
+slider) are held for a short debounce window. Requests of the same
+DeviceControl kind that arrive within the window supersede each other, so only
+the latest value is sent and every caller receives the result of the request
+that was finally sent, through the future returned when it was queued.
+"""
+
+# We run the debounce timers on threads.
+import threading
+
+# We need a clock to enforce the maximum delay.
+import time
+
+# We hand each caller a future for the coalesced result.
+from concurrent.futures import Future
+
+from .NavienSmartControl import DeviceControl, DeviceKey, gatewayKey
+
+
+class _PendingControl:
+    """A control request waiting for its debounce window to elapse"""
+
+    def __init__(self, send, args):
+        self.send = send
+        self.args = args
+        self.future = Future()
+        self.queuedAt = time.monotonic()
+        self.timer = None
+
+
+class ControlQueue:
+    """Per-device debouncing queue in front of a NavienSmartControl object"""
+
+    def __init__(self, navienSmartControl, debounceWindow=0.25, maxDelay=1.0):
+        """
+        Construct a new 'ControlQueue' object.
+
+        :param navienSmartControl: The connected NavienSmartControl object used to send the requests
+        :param debounceWindow: Seconds to wait for a newer value before sending a request
+        :param maxDelay: Upper bound in seconds on how long a request can be postponed by newer values (None for no bound)
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.debounceWindow = debounceWindow
+        self.maxDelay = maxDelay
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def submit(
+        self, gatewayID, currentControlChannel, deviceNumber, controlItem, send, *args
+    ):
+        """
+        Queue a control request, superseding any pending request of the same kind for the device
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param controlItem: Corresponds with the DeviceControl enum, used to decide which requests supersede each other
+        :param send: The NavienSmartControl method that sends the request
+        :param args: The arguments to pass to send
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        key = (
+            DeviceKey(gatewayKey(gatewayID), currentControlChannel, deviceNumber),
+            DeviceControl(controlItem),
+        )
+        with self.lock:
+            entry = self.pending.get(key)
+            if entry is None:
+                entry = _PendingControl(send, args)
+                self.pending[key] = entry
+            else:
+                # Superseded, only the latest value goes out.
+                entry.send = send
+                entry.args = args
+            self._schedule(key, entry)
+            return entry.future
+
+    def _schedule(self, key, entry):
+        """
+        (Re)start the debounce timer of a pending request (caller must hold the lock)
+
+        :param key: The pending request key
+        :param entry: The pending request
+        """
+        delay = self.debounceWindow
+        if self.maxDelay is not None:
+            delay = max(
+                0, min(delay, entry.queuedAt + self.maxDelay - time.monotonic())
+            )
+        if entry.timer is not None:
+            entry.timer.cancel()
+        entry.timer = threading.Timer(delay, self._flush, (key, entry))
+        entry.timer.daemon = True
+        entry.timer.start()
+
+    def _flush(self, key, entry):
+        """
+        Send a pending request once its debounce window has elapsed
+
+        :param key: The pending request key
+        :param entry: The pending request
+        """
+        with self.lock:
+            # A newer value may have restarted the timer after this one fired.
+            if (self.pending.get(key) is not entry) or (
+                entry.timer is not threading.current_thread()
+            ):
+                return
+            del self.pending[key]
+        self._send(entry)
+
+    def _send(self, entry):
+        """
+        Send a request and resolve the future shared by all of its callers
+
+        :param entry: The pending request
+        """
+        if not entry.future.set_running_or_notify_cancel():
+            return
+        try:
+            result = entry.send(*entry.args)
+        except Exception as e:
+            entry.future.set_exception(e)
+        else:
+            entry.future.set_result(result)
+
+    def flush(self):
+        """
+        Send all pending requests immediately
+        """
+        with self.lock:
+            entries = list(self.pending.values())
+            self.pending.clear()
+        for entry in entries:
+            entry.timer.cancel()
+            self._send(entry)
+
+    # ----- Coalescing equivalents of the NavienSmartControl control requests ----- #
+    # These return futures rather than blocking, so that successive calls from a
+    # single thread (e.g. a slider handler) coalesce. Call .result() to wait.
+
+    def sendPowerControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, powerState
+    ):
+        """
+        Queue device power control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param powerState: The power state as identified in the OnOFFFlag enum
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.POWER.value,
+            self.navienSmartControl.sendPowerControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            powerState,
+        )
+
+    def sendHeatControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData, heatState
+    ):
+        """
+        Queue device heat control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param channelData: The parsed channel information data
+        :param heatState: The heat state as identified in the OnOFFFlag enum
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.HEAT.value,
+            self.navienSmartControl.sendHeatControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            channelData,
+            heatState,
+        )
+
+    def sendOnDemandControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData
+    ):
+        """
+        Queue device on demand control request (repeated presses within the window are sent once)
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param channelData: The parsed channel information data
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.ON_DEMAND.value,
+            self.navienSmartControl.sendOnDemandControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            channelData,
+        )
+
+    def sendDeviceWeeklyControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, weeklyState
+    ):
+        """
+        Queue device weekly control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param weeklyState: The weekly control state as identified in the OnOFFFlag enum
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.WEEKLY.value,
+            self.navienSmartControl.sendDeviceWeeklyControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            weeklyState,
+        )
+
+    def sendWaterTempControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData, tempVal
+    ):
+        """
+        Queue device water temperature control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param channelData: The parsed channel information data used to determine limits and units
+        :param tempVal: The temperature to set
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.WATER_TEMPERATURE.value,
+            self.navienSmartControl.sendWaterTempControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            channelData,
+            tempVal,
+        )
+
+    def sendHeatingWaterTempControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData, tempVal
+    ):
+        """
+        Queue device heating water temperature control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param channelData: The parsed channel information data used to determine limits and units
+        :param tempVal: The temperature to set
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.HEATING_WATER_TEMPERATURE.value,
+            self.navienSmartControl.sendHeatingWaterTempControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            channelData,
+            tempVal,
+        )
+
+    def sendRecirculationTempControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber, channelData, tempVal
+    ):
+        """
+        Queue recirculation temperature control request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param channelData: The parsed channel information data used to determine limits and units
+        :param tempVal: The temperature to set
+        :return: A future that resolves to the parsed response data of the request finally sent
+        """
+        return self.submit(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            DeviceControl.RECIRCULATION_TEMPERATURE.value,
+            self.navienSmartControl.sendRecirculationTempControlRequest,
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            channelData,
+            tempVal,
+        )
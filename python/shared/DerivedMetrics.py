@@ -0,0 +1,187 @@
+"""
+Vectorised derived metrics over arrays of STATE samples.
+
+The functions take the raw columns of STATE samples, as returned for live data
+by RecentSamples.window() and for history by HistoryQuery.read() or
+ColumnarStateStore.query(), and compute the derived quantities for all the
+samples at once: temperatures and flow in their units, the gas input, the
+thermal power delivered to the hot water from the flow and the temperature
+rise, the gas-to-heat efficiency and the totals of a cascade of devices.
+
+Unlike the rest of the package this module requires NumPy.
+"""
+
+# NumPy is required here (pip install PyNavienSmartControl[numpy])
+import numpy
+
+from .NavienSmartControl import TemperatureType, gasInstantUseFactor
+
+# The quantities summed over a cascade by default
+CASCADE_FIELDS = ["gasInput", "thermalPower", "hotWaterFlowRate"]
+
+
+def temperature(raw, temperatureType=TemperatureType.CELSIUS.value):
+    """
+    Convert raw temperatures to degrees
+
+    :param raw: The raw temperatures
+    :param temperatureType: The temperature type of the device (Celsius is reported in half degrees, Fahrenheit in degrees)
+    :return: Array of degrees Celsius or Fahrenheit
+    """
+    values = numpy.asarray(raw, dtype=numpy.float64)
+    if temperatureType == TemperatureType.CELSIUS.value:
+        return values / 2.0
+    return values
+
+
+def temperatureRise(rawOutlet, rawInlet, temperatureType=TemperatureType.CELSIUS.value):
+    """
+    Compute the temperature rise between raw inlet and outlet temperatures
+
+    :param rawOutlet: The raw outlet temperatures
+    :param rawInlet: The raw inlet temperatures
+    :param temperatureType: The temperature type of the device
+    :return: Array of temperature rises in K
+    """
+    rise = temperature(rawOutlet, temperatureType) - temperature(
+        rawInlet, temperatureType
+    )
+    if temperatureType != TemperatureType.CELSIUS.value:
+        rise *= 5.0 / 9.0
+    return rise
+
+
+def flowRate(raw):
+    """
+    Convert raw hot water flow rates to liters per minute
+
+    :param raw: The raw hotWaterFlowRate values (in 0.1 LPM)
+    :return: Array of LPM
+    """
+    return numpy.asarray(raw, dtype=numpy.float64) / 10.0
+
+
+def gasInput(raw, deviceSorting):
+    """
+    Convert raw gasInstantUse values to kcal/h, as in NavienSmartControl.gasInstantUseKcal
+
+    :param raw: The raw gasInstantUse values
+    :param deviceSorting: The deviceSorting of the device, or an array with the deviceSorting of each sample
+    :return: Array of kcal/h
+    """
+    deviceSorting = numpy.asarray(deviceSorting)
+    if deviceSorting.ndim == 0:
+        GIUFactor = gasInstantUseFactor(int(deviceSorting))
+    else:
+        sortings, inverse = numpy.unique(deviceSorting, return_inverse=True)
+        GIUFactor = numpy.array(
+            [gasInstantUseFactor(int(sorting)) for sorting in sortings]
+        )[inverse]
+    return numpy.asarray(raw, dtype=numpy.float64) * GIUFactor / 10.0
+
+
+def thermalPower(flow, rise):
+    """
+    Compute the thermal power delivered to the hot water
+
+    :param flow: Array of flow rates in LPM
+    :param rise: Array of temperature rises in K
+    :return: Array of kcal/h (water taken as 1 kg/l and 1 kcal/(kg K))
+    """
+    return numpy.asarray(flow) * 60.0 * numpy.asarray(rise)
+
+
+def efficiency(power, gas):
+    """
+    Compute the gas-to-heat efficiency
+
+    :param power: Array of delivered thermal power in kcal/h
+    :param gas: Array of gas input in kcal/h
+    :return: Array of efficiencies (NaN where no gas is burning)
+    """
+    power = numpy.asarray(power, dtype=numpy.float64)
+    gas = numpy.asarray(gas, dtype=numpy.float64)
+    result = numpy.full(gas.shape, numpy.nan)
+    numpy.divide(power, gas, out=result, where=gas > 0)
+    return result
+
+
+def deriveMetrics(
+    samples, deviceSorting, temperatureType=TemperatureType.CELSIUS.value
+):
+    """
+    Compute the derived metrics of a device's samples
+
+    :param samples: Dictionary of "timestamp", "hotWaterFlowRate", "gasInstantUse", "hotWaterCurrentTemperature" (outlet) and "hotWaterTemperature" (inlet) to raw arrays
+    :param deviceSorting: The deviceSorting of the device
+    :param temperatureType: The temperature type of the device
+    :return: Dictionary of timestamp, hotWaterFlowRate (LPM), outletTemperature, inletTemperature, temperatureRise (K), gasInput (kcal/h), thermalPower (kcal/h) and efficiency arrays
+    """
+    flow = flowRate(samples["hotWaterFlowRate"])
+    rise = temperatureRise(
+        samples["hotWaterCurrentTemperature"],
+        samples["hotWaterTemperature"],
+        temperatureType,
+    )
+    gas = gasInput(samples["gasInstantUse"], deviceSorting)
+    power = thermalPower(flow, rise)
+    return {
+        "timestamp": numpy.asarray(samples["timestamp"], dtype=numpy.float64),
+        "hotWaterFlowRate": flow,
+        "outletTemperature": temperature(
+            samples["hotWaterCurrentTemperature"], temperatureType
+        ),
+        "inletTemperature": temperature(
+            samples["hotWaterTemperature"], temperatureType
+        ),
+        "temperatureRise": rise,
+        "gasInput": gas,
+        "thermalPower": power,
+        "efficiency": efficiency(power, gas),
+    }
+
+
+def resample(timestamps, values, grid, maxGap=900.0):
+    """
+    Hold the last sample at each point of a time grid
+
+    :param timestamps: The sorted sample timestamps
+    :param values: The sample values
+    :param grid: The sorted times to resample at
+    :param maxGap: A sample is held for at most this many seconds, after that the value is 0
+    :return: Array of the values at the grid times
+    """
+    timestamps = numpy.asarray(timestamps, dtype=numpy.float64)
+    values = numpy.asarray(values, dtype=numpy.float64)
+    grid = numpy.asarray(grid, dtype=numpy.float64)
+    if len(timestamps) == 0:
+        return numpy.zeros(grid.shape)
+    index = numpy.searchsorted(timestamps, grid, "right") - 1
+    clipped = numpy.clip(index, 0, len(timestamps) - 1)
+    valid = (index >= 0) & (grid - timestamps[clipped] <= maxGap)
+    return numpy.where(valid, values[clipped], 0.0)
+
+
+def cascadeTotals(metricsByDevice, grid, fields=None, maxGap=900.0):
+    """
+    Sum the metrics of the devices of a cascade on a common time grid
+
+    :param metricsByDevice: Dictionary of DeviceKey to the deriveMetrics result of the device
+    :param grid: The sorted times to sum at, e.g. numpy.arange(start, end, step)
+    :param fields: The metrics to sum (None for CASCADE_FIELDS)
+    :param maxGap: A sample is held for at most this many seconds
+    :return: Dictionary of timestamp, each summed metric and, when gasInput and thermalPower are summed, the cascade efficiency
+    """
+    if fields is None:
+        fields = CASCADE_FIELDS
+    grid = numpy.asarray(grid, dtype=numpy.float64)
+    totals = {"timestamp": grid}
+    for field in fields:
+        totals[field] = numpy.zeros(grid.shape)
+        for metrics in metricsByDevice.values():
+            totals[field] += resample(
+                metrics["timestamp"], metrics[field], grid, maxGap
+            )
+    if ("gasInput" in totals) and ("thermalPower" in totals):
+        totals["efficiency"] = efficiency(totals["thermalPower"], totals["gasInput"])
+    return totals
@@ -0,0 +1,311 @@
+"""
+Manager for a fleet of NavienSmartControl accounts.
+
+Each account gets its own NavienSmartControl object and RateLimiter, so one
+account's rate limits and failures never hold up the others. Logins run on a
+bounded pool of threads and sessions older than a configurable TTL are logged
+in again. All the gateways and devices of all the accounts are then available
+through a single poll interface keyed by DeviceKey.
+"""
+
+# The credential files are JSON.
+import json
+
+# The accounts are shared between the polling threads.
+import threading
+
+# We need a clock to expire sessions.
+import time
+
+# Logins and polls run concurrently, one task per account.
+from concurrent.futures import ThreadPoolExecutor
+
+from .NavienSmartControl import (
+    NavienSmartControl,
+    DeviceKey,
+    DeviceSorting,
+    gatewayKey,
+)
+from .RateLimiter import RateLimiter
+
+
+class _Account:
+    """The session and discovered devices of one account"""
+
+    def __init__(self, navienSmartControl):
+        self.navienSmartControl = navienSmartControl
+        self.lock = threading.Lock()
+        self.gateways = []
+        self.channelInfo = {}
+        self.loggedInAt = None
+        self.error = None
+
+
+class FleetManager:
+    """Logs in, discovers and polls the devices of many accounts"""
+
+    def __init__(
+        self, credentials, maxConcurrency=8, sessionTTL=3600, rateLimiterFactory=None
+    ):
+        """
+        Construct a new 'FleetManager' object.
+
+        :param credentials: List of dictionaries with the Username and Password of each account (as in credentials.json)
+        :param maxConcurrency: Maximum number of accounts logged in or polled at the same time
+        :param sessionTTL: Seconds after which an account is logged in again
+        :param rateLimiterFactory: Callable returning the RateLimiter for each account (defaults to RateLimiter())
+        :return: returns nothing
+        """
+        self.maxConcurrency = maxConcurrency
+        self.sessionTTL = sessionTTL
+        if rateLimiterFactory is None:
+            rateLimiterFactory = RateLimiter
+        self.accounts = {}
+        for credential in credentials:
+            self.accounts[credential["Username"]] = _Account(
+                NavienSmartControl(
+                    credential["Username"],
+                    credential["Password"],
+                    rateLimiter=rateLimiterFactory(),
+                )
+            )
+        self.executor = ThreadPoolExecutor(max_workers=maxConcurrency)
+
+    @staticmethod
+    def loadCredentials(path):
+        """
+        Load credentials from a JSON file holding one credential set or a list of them
+
+        :param path: The path of the credentials file
+        :return: List of credential dictionaries
+        """
+        with open(path, "r") as in_file:
+            credentials = json.load(in_file)
+        if isinstance(credentials, dict):
+            credentials = [credentials]
+        return credentials
+
+    def forEachAccount(self, function, userIDs=None):
+        """
+        Run a function for several accounts concurrently, isolating their failures
+
+        :param function: Callable taking the userID and the _Account
+        :param userIDs: The accounts to run it for (None for all of them)
+        :return: Dictionary of userID to the function's result or the exception it raised
+        """
+        if userIDs is None:
+            userIDs = list(self.accounts)
+        futures = {
+            userID: self.executor.submit(function, userID, self.accounts[userID])
+            for userID in userIDs
+        }
+        results = {}
+        for userID, future in futures.items():
+            try:
+                results[userID] = future.result()
+            except Exception as e:
+                results[userID] = e
+        return results
+
+    def loginAccount(self, userID, account):
+        """
+        Log an account in and forget its previous connections
+
+        :param userID: The account's user ID
+        :param account: The account
+        :return: The gateway list
+        """
+        with account.lock:
+            account.navienSmartControl.disconnect()
+            account.channelInfo = {}
+            try:
+                account.gateways = account.navienSmartControl.login()
+            except Exception as e:
+                account.error = e
+                account.loggedInAt = None
+                raise
+            account.error = None
+            account.loggedInAt = time.monotonic()
+            return account.gateways
+
+    def login(self):
+        """
+        Log in every account
+
+        :return: Dictionary of userID to gateway list or the exception raised by its login
+        """
+        return self.forEachAccount(self.loginAccount)
+
+    def isStale(self, account):
+        """
+        Check whether an account needs to log in (again)
+
+        :param account: The account
+        :return: True if the account has no session or its session has expired
+        """
+        return (account.loggedInAt is None) or (
+            time.monotonic() - account.loggedInAt >= self.sessionTTL
+        )
+
+    def refresh(self):
+        """
+        Log in the accounts that have no session or whose session has expired
+
+        :return: Dictionary of userID to gateway list or the exception raised by its login
+        """
+        return self.forEachAccount(
+            self.loginAccount,
+            [
+                userID
+                for userID, account in self.accounts.items()
+                if self.isStale(account)
+            ],
+        )
+
+    def gateways(self):
+        """
+        List the gateways of every logged in account
+
+        :return: List of (userID, gateway) tuples
+        """
+        return [
+            (userID, gateway)
+            for userID, account in self.accounts.items()
+            for gateway in account.gateways
+        ]
+
+    def discover(self, userID, account):
+        """
+        Connect to each of an account's gateways that isn't connected yet and list its devices
+
+        :param userID: The account's user ID
+        :param account: The account
+        :return: List of DeviceKey
+        """
+        devices = []
+        with account.lock:
+            gateways = list(account.gateways)
+        for gateway in gateways:
+            key = gatewayKey(gateway["GID"])
+            if key not in account.channelInfo:
+                try:
+                    account.channelInfo[key] = account.navienSmartControl.connect(
+                        gateway["GID"]
+                    )
+                except Exception:
+                    # Tried again on the next discovery
+                    continue
+            channelInfo = account.channelInfo[key]
+            for chan in channelInfo["channel"]:
+                if (
+                    channelInfo["channel"][chan]["deviceSorting"]
+                    == DeviceSorting.NO_DEVICE.value
+                ):
+                    continue
+                for deviceNumber in range(
+                    1, channelInfo["channel"][chan]["deviceCount"] + 1
+                ):
+                    devices.append(DeviceKey(key, int(chan), deviceNumber))
+        return devices
+
+    def devices(self):
+        """
+        List the devices of every logged in account
+
+        :return: List of (userID, DeviceKey) tuples
+        """
+        results = self.forEachAccount(self.discover)
+        return [
+            (userID, device)
+            for userID, devices in results.items()
+            if not isinstance(devices, Exception)
+            for device in devices
+        ]
+
+    def findAccount(self, gatewayID):
+        """
+        Find the account a gateway belongs to
+
+        :param gatewayID: The gatewayID as a hex string or raw bytes
+        :return: The userID
+        """
+        key = gatewayKey(gatewayID)
+        for userID, account in self.accounts.items():
+            for gateway in account.gateways:
+                if gatewayKey(gateway["GID"]) == key:
+                    return userID
+        raise Exception("Error: Unknown gatewayID " + key)
+
+    def query(self, device):
+        """
+        Request the state of a single device
+
+        :param device: The DeviceKey of the device
+        :return: Parsed state response data
+        """
+        return self.requestState(
+            self.accounts[self.findAccount(device.gatewayID)], device
+        )
+
+    def requestState(self, account, device):
+        """
+        Request the state of a device through its account
+
+        :param account: The account the device belongs to
+        :param device: The DeviceKey of the device
+        :return: Parsed state response data
+        """
+        try:
+            return account.navienSmartControl.sendStateRequest(
+                bytes(bytearray.fromhex(device.gatewayID)),
+                device.channel,
+                device.deviceNumber,
+            )
+        except Exception:
+            # Reconnect on the next discovery
+            account.channelInfo.pop(device.gatewayID, None)
+            raise
+
+    def pollAccount(self, userID, account):
+        """
+        Request the state of all of an account's devices
+
+        :param userID: The account's user ID
+        :param account: The account
+        :return: Dictionary of DeviceKey to parsed state response data or the exception raised by its request
+        """
+        results = {}
+        for device in self.discover(userID, account):
+            try:
+                results[device] = self.requestState(account, device)
+            except Exception as e:
+                results[device] = e
+        return results
+
+    def poll(self):
+        """
+        Refresh stale sessions and request the state of every device in the fleet
+
+        :return: Dictionary of DeviceKey to parsed state response data or the exception raised by its request
+        """
+        self.refresh()
+        results = {}
+        for userID, devices in self.forEachAccount(
+            self.pollAccount,
+            [
+                userID
+                for userID, account in self.accounts.items()
+                if account.loggedInAt is not None
+            ],
+        ).items():
+            if not isinstance(devices, Exception):
+                results.update(devices)
+        return results
+
+    def close(self):
+        """
+        Disconnect every account and stop the worker threads
+        """
+        for account in self.accounts.values():
+            account.navienSmartControl.disconnect()
+        self.executor.shutdown()
@@ -0,0 +1,338 @@
+"""
+Process sharded poller for large fleets of gateways.
+
+Gateways are hashed across a configurable number of worker processes. Each
+worker logs in to the REST API, opens its own connections through a
+NavienMultiplexer, polls the state of every device it finds and does the
+CPU-bound work (frame decoding and flattening of the response into integers)
+itself. The results stream back to
+the parent as binary records over a pipe, so throughput scales with the number
+of cores. As successive records of a device differ in a few fields, each one
+is sent as a StateDelta keyframe or delta record of its fixed-width form.
+"""
+
+# We pick up the worker results as soon as any pipe has data.
+import multiprocessing
+import multiprocessing.connection
+
+# We pack the results into fixed-width binary records.
+import struct
+
+# We need clocks for the poll interval and for timestamping samples.
+import time
+
+# We use a stable hash to shard the gateways.
+import zlib
+
+from .NavienSmartControl import (
+    NavienSmartControl,
+    ControlType,
+    DeviceKey,
+    DeviceSorting,
+    gatewayKey,
+)
+from .NavienMultiplexer import NavienMultiplexer
+from .StateDelta import StateDeltaDecoder, StateDeltaEncoder
+
+# The state fields carried in each record (all as raw integers in device units)
+STATE_RECORD_FIELDS = [
+    "deviceSorting",
+    "errorCD",
+    "averageCalorimeter",
+    "gasInstantUse",
+    "gasAccumulatedUse",
+    "hotWaterSettingTemperature",
+    "hotWaterCurrentTemperature",
+    "hotWaterFlowRate",
+    "hotWaterTemperature",
+    "heatSettingTemperature",
+    "currentWorkingFluidTemperature",
+    "currentReturnWaterTemperature",
+    "powerStatus",
+    "heatStatus",
+    "useOnDemand",
+    "weeklyControl",
+    "recirculationSettingTemperature",
+    "recirculationCurrentTemperature",
+]
+
+# gatewayID, channel and deviceNumber of a record, sent as they are so that the previous record of the device is found, and the length of the keyframe or delta record that follows
+STATE_RECORD_KEY = struct.Struct("<8s B B H")
+
+# timestamp, followed by the state fields
+STATE_RECORD = struct.Struct("<d B H B H I B B H B B B B B B B B B B")
+
+# Message kinds sent from the workers
+MESSAGE_STATE = b"S"
+MESSAGE_ERROR = b"E"
+
+
+def shardForGateway(gatewayID, workerCount):
+    """
+    Pick the worker a gateway belongs to
+
+    :param gatewayID: The gatewayID as a hex string or raw bytes
+    :param workerCount: The number of workers
+    :return: The worker index
+    """
+    return zlib.crc32(gatewayKey(gatewayID).encode()) % workerCount
+
+
+def encodeStateRecords(navienSmartControl, samples, encoder):
+    """
+    Pack state responses into a single message
+
+    :param navienSmartControl: The NavienSmartControl object used to decode the byte fields
+    :param samples: List of (timestamp, stateData) tuples
+    :param encoder: The StateDeltaEncoder of the pipe the message is sent on
+    :return: The message bytes
+    """
+    message = bytearray(MESSAGE_STATE)
+    for timestamp, stateData in samples:
+        values = [
+            navienSmartControl.bigHexToInt(stateData.get(field, 0))
+            for field in STATE_RECORD_FIELDS
+        ]
+        key = (
+            bytes(stateData["deviceID"]),
+            stateData["currentChannel"],
+            stateData["deviceNumber"],
+        )
+        record = encoder.encode(key, STATE_RECORD.pack(timestamp, *values))
+        message.extend(STATE_RECORD_KEY.pack(*(key + (len(record),))))
+        message.extend(record)
+    return bytes(message)
+
+
+def decodeStateRecords(message, decoder):
+    """
+    Unpack a state message
+
+    :param message: The message bytes (without the kind)
+    :param decoder: The StateDeltaDecoder of the pipe the message was received on
+    :return: List of (DeviceKey, timestamp, values) tuples
+    """
+    samples = []
+    offset = 0
+    while offset < len(message):
+        gatewayID, channel, deviceNumber, length = STATE_RECORD_KEY.unpack_from(
+            message, offset
+        )
+        offset += STATE_RECORD_KEY.size
+        record = STATE_RECORD.unpack(
+            decoder.decode(
+                (gatewayID, channel, deviceNumber), message[offset : offset + length]
+            )
+        )
+        offset += length
+        key = DeviceKey(gatewayKey(gatewayID), channel, deviceNumber)
+        samples.append((key, record[0], dict(zip(STATE_RECORD_FIELDS, record[1:]))))
+    return samples
+
+
+def _runWorker(userID, passwd, gatewayIDs, interval, directConnect, writer, stopEvent):
+    """
+    Worker process polling its share of the gateways
+
+    :param userID: The user ID used to log in to the mobile application
+    :param passwd: The corresponding user's password
+    :param gatewayIDs: The gatewayIDs (hex strings) this worker polls
+    :param interval: Seconds between polls of each device
+    :param directConnect: Connect to the server advertised for each gateway at login
+    :param writer: The pipe connection the results are written to
+    :param stopEvent: Event set by the parent to stop the worker
+    """
+    navienSmartControl = NavienSmartControl(userID, passwd, directConnect=directConnect)
+    multiplexer = NavienMultiplexer(navienSmartControl)
+    encoder = StateDeltaEncoder()
+    loggedIn = False
+    devices = {}
+    samples = []
+    errors = []
+
+    def onChannelInfo(gatewayID, future):
+        if future.exception() is not None:
+            errors.append((gatewayID, 0, 0, future.exception()))
+            return
+        channelInfo = future.result()
+        devices[gatewayID] = [
+            (int(chan), deviceNumber)
+            for chan in channelInfo["channel"]
+            if channelInfo["channel"][chan]["deviceSorting"]
+            != DeviceSorting.NO_DEVICE.value
+            for deviceNumber in range(
+                1, channelInfo["channel"][chan]["deviceCount"] + 1
+            )
+        ]
+
+    def onState(gatewayID, chan, deviceNumber, future):
+        if future.exception() is not None:
+            errors.append((gatewayID, chan, deviceNumber, future.exception()))
+        elif future.result()["controlType"] == ControlType.STATE.value:
+            samples.append((time.time(), future.result()))
+
+    nextPoll = time.monotonic()
+    while not stopEvent.is_set():
+        if time.monotonic() >= nextPoll:
+            nextPoll += interval
+            if not loggedIn:
+                # Log in before the first poll (and retry on the next cycle if that fails)
+                try:
+                    navienSmartControl.login()
+                    loggedIn = True
+                except Exception as e:
+                    errors.extend((gatewayID, 0, 0, e) for gatewayID in gatewayIDs)
+            if loggedIn:
+                for gatewayID in gatewayIDs:
+                    if gatewayKey(gatewayID) not in multiplexer.connections:
+                        # (Re)connect, the devices are polled from the next cycle on
+                        devices.pop(gatewayID, None)
+                        multiplexer.open(gatewayID).add_done_callback(
+                            lambda future, gatewayID=gatewayID: onChannelInfo(
+                                gatewayID, future
+                            )
+                        )
+                        continue
+                    for chan, deviceNumber in devices.get(gatewayID, []):
+                        multiplexer.sendStateRequest(
+                            bytes(bytearray.fromhex(gatewayID)), chan, deviceNumber
+                        ).add_done_callback(
+                            lambda future, gatewayID=gatewayID, chan=chan, deviceNumber=deviceNumber: onState(
+                                gatewayID, chan, deviceNumber, future
+                            )
+                        )
+        multiplexer.runOnce(max(0, min(nextPoll - time.monotonic(), 0.5)))
+
+        if samples:
+            writer.send_bytes(encodeStateRecords(navienSmartControl, samples, encoder))
+            del samples[:]
+        for gatewayID, chan, deviceNumber, error in errors:
+            writer.send_bytes(
+                MESSAGE_ERROR
+                + struct.pack(
+                    "<8s B B", bytes(bytearray.fromhex(gatewayID)), chan, deviceNumber
+                )
+                + str(error).encode("utf-8", "replace")
+            )
+        del errors[:]
+    multiplexer.close()
+    writer.close()
+
+
+class FleetPoller:
+    """Polls a fleet of gateways from a pool of worker processes"""
+
+    def __init__(
+        self,
+        userID,
+        passwd,
+        gateways,
+        workerCount=None,
+        interval=10.0,
+        directConnect=False,
+    ):
+        """
+        Construct a new 'FleetPoller' object.
+
+        :param userID: The user ID used to log in to the mobile application
+        :param passwd: The corresponding user's password
+        :param gateways: The gateway list returned by login(), or a list of gatewayIDs as hex strings
+        :param workerCount: The number of worker processes (defaults to the number of CPUs)
+        :param interval: Seconds between polls of each device
+        :param directConnect: Have the workers connect to the server advertised for each gateway at login
+        :return: returns nothing
+        """
+        self.userID = userID
+        self.passwd = passwd
+        self.gatewayIDs = [
+            gateway["GID"] if isinstance(gateway, dict) else gateway
+            for gateway in gateways
+        ]
+        self.workerCount = workerCount or multiprocessing.cpu_count()
+        self.interval = interval
+        self.directConnect = directConnect
+        self.workers = []
+        self.readers = []
+        # The StateDeltaDecoder of each reader
+        self.decoders = {}
+        self.stopEvent = None
+
+    def start(self):
+        """
+        Start the worker processes
+        """
+        self.stopEvent = multiprocessing.Event()
+        shards = [[] for _ in range(self.workerCount)]
+        for gatewayID in self.gatewayIDs:
+            shards[shardForGateway(gatewayID, self.workerCount)].append(gatewayID)
+        for shard in shards:
+            if not shard:
+                continue
+            reader, writer = multiprocessing.Pipe(duplex=False)
+            worker = multiprocessing.Process(
+                target=_runWorker,
+                args=(
+                    self.userID,
+                    self.passwd,
+                    shard,
+                    self.interval,
+                    self.directConnect,
+                    writer,
+                    self.stopEvent,
+                ),
+            )
+            worker.daemon = True
+            worker.start()
+            # Only the worker writes to the pipe.
+            writer.close()
+            self.workers.append(worker)
+            self.readers.append(reader)
+            self.decoders[reader] = StateDeltaDecoder()
+
+    def results(self, timeout=None):
+        """
+        Read the results that have arrived from the workers
+
+        :param timeout: Seconds to wait for results (None to wait until a result arrives)
+        :return: Generator of (DeviceKey, timestamp, values, error) tuples where either values or error is None (empty at once if no worker is running)
+        """
+        if not self.readers:
+            # Nothing could ever arrive
+            return
+        for reader in multiprocessing.connection.wait(self.readers, timeout):
+            try:
+                message = reader.recv_bytes()
+            except EOFError:
+                # The worker has exited
+                self.readers.remove(reader)
+                del self.decoders[reader]
+                continue
+            if message[:1] == MESSAGE_STATE:
+                for key, timestamp, values in decodeStateRecords(
+                    message[1:], self.decoders[reader]
+                ):
+                    yield key, timestamp, values, None
+            elif message[:1] == MESSAGE_ERROR:
+                gatewayID, chan, deviceNumber = struct.unpack("<8s B B", message[1:11])
+                yield (
+                    DeviceKey(gatewayKey(gatewayID), chan, deviceNumber),
+                    time.time(),
+                    None,
+                    Exception(message[11:].decode("utf-8", "replace")),
+                )
+
+    def stop(self):
+        """
+        Stop the worker processes
+        """
+        if self.stopEvent is not None:
+            self.stopEvent.set()
+        for worker in self.workers:
+            worker.join(5)
+            if worker.is_alive():
+                worker.terminate()
+        for reader in self.readers:
+            reader.close()
+        self.workers = []
+        self.readers = []
+        self.decoders = {}
@@ -0,0 +1,245 @@
+"""
+Append-only capture log of the raw binary API traffic.
+
+A FrameRecorder passed to NavienSmartControl receives every request/response
+pair sent by connect() and sendRequest() and appends it, unparsed, to a binary
+log together with its timestamps and (gatewayID, channel, deviceNumber,
+controlType) key. A side index with one fixed-width entry per record allows
+seeking by time and device without scanning the log, so the history can be
+decoded again after parser fixes.
+
+As successive pairs of the same key are nearly identical, each pair (the
+request followed by the response) is stored as a StateDelta keyframe or delta
+record. Every record also carries the offset of the previous record of its key,
+so a reader can walk back to the keyframe of any record it seeks to.
+
+Log file:   b"NSCFLOG2" followed by records of RECORD_HEADER and the keyframe or delta record of the pair
+Index file: b"NSCFIDX1" followed by INDEX_ENTRY entries, in the same order as the records
+
+Logs of the earlier b"NSCFLOG1" format store RAW_RECORD_HEADER, the request and the response instead; they can still be read but not appended to.
+"""
+
+# We seek through the index by time.
+import bisect
+
+# We check for existing logs before appending.
+import os
+
+# We pack the records into bytes.
+import struct
+
+# The recorder is shared between threads.
+import threading
+
+# We need both a monotonic clock and the wall clock.
+import time
+
+from .NavienSmartControl import ControlType, DeviceKey, gatewayKey
+from .StateDelta import StateDeltaEncoder
+
+LOG_MAGIC = b"NSCFLOG2"
+RAW_LOG_MAGIC = b"NSCFLOG1"
+INDEX_MAGIC = b"NSCFIDX1"
+
+# monotonic time, wall time, gatewayID, channel, deviceNumber, controlType, request length, response length,
+# offset of the previous record of the same key (0 if none) and length of the stored keyframe or delta record
+RECORD_HEADER = struct.Struct("<d d 8s B B B I I Q I")
+
+# monotonic time, wall time, gatewayID, channel, deviceNumber, controlType, request length, response length
+RAW_RECORD_HEADER = struct.Struct("<d d 8s B B B I I")
+
+# wall time, gatewayID, channel, deviceNumber, controlType, record offset in the log
+INDEX_ENTRY = struct.Struct("<d 8s B B B Q")
+
+
+def indexPath(logPath):
+    """
+    Get the path of the index belonging to a log
+
+    :param logPath: The path of the log
+    :return: The path of the index
+    """
+    return logPath + ".idx"
+
+
+def rawGatewayID(gatewayID):
+    """
+    Convert a gatewayID to the 8 raw bytes stored in the log
+
+    :param gatewayID: The gatewayID as a hex string or raw bytes
+    :return: The raw gatewayID
+    """
+    return bytes(bytearray.fromhex(gatewayKey(gatewayID)))
+
+
+class FrameRecorder:
+    """Appends request/response pairs to a capture log and its index"""
+
+    def __init__(self, path, keyframeInterval=100):
+        """
+        Construct a new 'FrameRecorder' object, appending to the log if it exists.
+
+        :param path: The path of the log (the index is written next to it)
+        :param keyframeInterval: Number of records per key between keyframes, which bounds how far a reader walks back
+        :return: returns nothing
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        # The records appended before a restart aren't decoded again, so each key starts with a keyframe.
+        self.encoder = StateDeltaEncoder(keyframeInterval)
+        self.lastOffsets = {}
+        self.log = self.openFile(path, LOG_MAGIC)
+        self.index = self.openFile(indexPath(path), INDEX_MAGIC)
+
+    @staticmethod
+    def openFile(path, magic):
+        """
+        Open a file for appending, writing its magic if it is new
+
+        :param path: The path of the file
+        :param magic: The magic the file starts with
+        :return: The file object
+        """
+        exists = os.path.exists(path) and (os.path.getsize(path) > 0)
+        if exists:
+            with open(path, "rb") as in_file:
+                found = in_file.read(len(magic))
+            if (magic == LOG_MAGIC) and (found == RAW_LOG_MAGIC):
+                raise Exception(
+                    "Error: "
+                    + path
+                    + " is a capture file of the earlier format, please record to a new file."
+                )
+            if found != magic:
+                raise Exception("Error: " + path + " is not a frame capture file.")
+        out_file = open(path, "ab")
+        if not exists:
+            out_file.write(magic)
+        return out_file
+
+    def record(
+        self,
+        gatewayID,
+        currentControlChannel,
+        deviceNumber,
+        controlType,
+        request,
+        response,
+    ):
+        """
+        Append a request/response pair
+
+        :param gatewayID: The gatewayID the request was sent to
+        :param currentControlChannel: The channel the request was for (0 for the handshake)
+        :param deviceNumber: The device number the request was for (0 for the handshake)
+        :param controlType: The controlType of the response (None if the frame is too short to carry one)
+        :param request: The bytes sent
+        :param response: The response frame
+        """
+        if controlType is None:
+            controlType = ControlType.UNKNOWN.value
+        wallTime = time.time()
+        monotonicTime = time.monotonic()
+        key = (
+            rawGatewayID(gatewayID),
+            currentControlChannel,
+            deviceNumber,
+            controlType,
+        )
+        with self.lock:
+            offset = self.log.tell()
+            # The pairs of a key must be encoded in log order
+            stored = self.encoder.encode(key, bytes(request) + bytes(response))
+            self.log.write(
+                RECORD_HEADER.pack(
+                    monotonicTime,
+                    wallTime,
+                    key[0],
+                    currentControlChannel,
+                    deviceNumber,
+                    controlType,
+                    len(request),
+                    len(response),
+                    self.lastOffsets.get(key, 0),
+                    len(stored),
+                )
+            )
+            self.log.write(stored)
+            self.lastOffsets[key] = offset
+            self.index.write(
+                INDEX_ENTRY.pack(
+                    wallTime,
+                    rawGatewayID(gatewayID),
+                    currentControlChannel,
+                    deviceNumber,
+                    controlType,
+                    offset,
+                )
+            )
+
+    def flush(self):
+        """
+        Flush the log and the index to disk
+        """
+        with self.lock:
+            self.log.flush()
+            self.index.flush()
+
+    def close(self):
+        """
+        Close the log and the index
+        """
+        with self.lock:
+            self.log.close()
+            self.index.close()
+
+
+class FrameIndex:
+    """The index of a capture log, loaded for seeking by time and device"""
+
+    def __init__(self, logPath):
+        """
+        Construct a new 'FrameIndex' object.
+
+        :param logPath: The path of the log whose index to load
+        :return: returns nothing
+        """
+        with open(indexPath(logPath), "rb") as in_file:
+            data = in_file.read()
+        if data[: len(INDEX_MAGIC)] != INDEX_MAGIC:
+            raise Exception("Error: " + indexPath(logPath) + " is not a frame index.")
+        # Ignore a partially written last entry
+        end = len(INDEX_MAGIC) + (
+            (len(data) - len(INDEX_MAGIC)) // INDEX_ENTRY.size * INDEX_ENTRY.size
+        )
+        self.entries = list(INDEX_ENTRY.iter_unpack(data[len(INDEX_MAGIC) : end]))
+        self.times = [entry[0] for entry in self.entries]
+
+    def find(self, start=None, end=None, device=None, controlType=None):
+        """
+        Find the records in a time range, optionally for a single device and controlType
+
+        :param start: The earliest wall time (None for the beginning of the log)
+        :param end: The latest wall time, exclusive (None for the end of the log)
+        :param device: The DeviceKey of the device (None for every device)
+        :param controlType: The controlType of the responses (None for every controlType)
+        :return: List of (wall time, DeviceKey, controlType, offset) tuples in log order
+        """
+        first = 0 if start is None else bisect.bisect_left(self.times, start)
+        last = len(self.entries) if end is None else bisect.bisect_left(self.times, end)
+        records = []
+        for (
+            wallTime,
+            gatewayID,
+            channel,
+            deviceNumber,
+            recordType,
+            offset,
+        ) in self.entries[first:last]:
+            key = DeviceKey(gatewayKey(gatewayID), channel, deviceNumber)
+            if (device is not None) and (key != device):
+                continue
+            if (controlType is not None) and (recordType != controlType):
+                continue
+            records.append((wallTime, key, recordType, offset))
+        return records
@@ -0,0 +1,320 @@
+"""
+Reading and replaying FrameRecorder capture logs.
+
+FrameLogReader walks a capture log through mmap, so only the records that are
+actually read are paged in. The delta records are decoded against the last
+pair decoded for their key, so reading in log order applies each delta once,
+and a record sought to directly is rebuilt from its key's previous keyframe.
+ReplayTransport plugs into NavienSmartControl as
+its transport and answers the handshake and every request with the responses
+recorded for them, so the parsing and printing paths can be benchmarked and
+regression tested without a network.
+"""
+
+# We use namedtuple to reduce index errors.
+import collections
+
+# We map the log into memory instead of reading it.
+import mmap
+
+# The replayed sockets may be read from a background reader thread.
+import threading
+
+from .NavienSmartControl import gatewayKey
+from .FrameRecorder import (
+    LOG_MAGIC,
+    RAW_LOG_MAGIC,
+    RAW_RECORD_HEADER,
+    RECORD_HEADER,
+    FrameIndex,
+)
+from .StateDelta import KEYFRAME, applyDelta, decodeKeyframe
+
+# A single request/response pair from a capture log
+FrameRecord = collections.namedtuple(
+    "FrameRecord",
+    [
+        "offset",
+        "monotonicTime",
+        "wallTime",
+        "gatewayID",
+        "channel",
+        "deviceNumber",
+        "controlType",
+        "request",
+        "response",
+    ],
+)
+
+
+class FrameLogReader:
+    """Iterates the records of a capture log without loading it into memory"""
+
+    def __init__(self, path):
+        """
+        Construct a new 'FrameLogReader' object.
+
+        :param path: The path of the capture log
+        :return: returns nothing
+        """
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic = self.map[: len(LOG_MAGIC)]
+        if magic not in [LOG_MAGIC, RAW_LOG_MAGIC]:
+            self.close()
+            raise Exception("Error: " + path + " is not a frame capture file.")
+        # Logs of the earlier format hold the request and the response as they are
+        self.raw = magic == RAW_LOG_MAGIC
+        self.header = RAW_RECORD_HEADER if self.raw else RECORD_HEADER
+        self.index = None
+        # The offset and pair of the last record decoded for each key
+        self.lock = threading.Lock()
+        self.decoded = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        return self.records()
+
+    def readAt(self, offset):
+        """
+        Read the record at an offset
+
+        :param offset: The offset of the record in the log
+        :return: The FrameRecord, or None if the log ends in a partially written record
+        """
+        end = self.recordEnd(offset)
+        if (end is None) or (end > len(self.map)):
+            return None
+        fields = self.header.unpack_from(self.map, offset)
+        (
+            monotonicTime,
+            wallTime,
+            gatewayID,
+            channel,
+            deviceNumber,
+            controlType,
+            requestLength,
+            responseLength,
+        ) = fields[:8]
+        if self.raw:
+            pair = self.map[offset + self.header.size : end]
+        else:
+            pair = self.decodePair(fields[2:6], offset)
+        return FrameRecord(
+            offset,
+            monotonicTime,
+            wallTime,
+            gatewayKey(gatewayID),
+            channel,
+            deviceNumber,
+            controlType,
+            pair[:requestLength],
+            pair[requestLength : requestLength + responseLength],
+        )
+
+    def recordEnd(self, offset):
+        """
+        Find where a record ends
+
+        :param offset: The offset of the record in the log
+        :return: The offset following the record, or None if the log ends within its header
+        """
+        if offset + self.header.size > len(self.map):
+            return None
+        fields = self.header.unpack_from(self.map, offset)
+        if self.raw:
+            return offset + self.header.size + fields[6] + fields[7]
+        return offset + self.header.size + fields[9]
+
+    def decodePair(self, key, offset):
+        """
+        Rebuild the request/response pair of a record, walking back to the keyframe of its key if needed
+
+        :param key: The (gatewayID, channel, deviceNumber, controlType) of the record
+        :param offset: The offset of the record in the log
+        :return: The request followed by the response
+        """
+        with self.lock:
+            cached = self.decoded.get(key)
+        deltas = []
+        position = offset
+        while True:
+            if (cached is not None) and (cached[0] == position):
+                pair = cached[1]
+                break
+            previousOffset, storedLength = RECORD_HEADER.unpack_from(
+                self.map, position
+            )[8:]
+            start = position + RECORD_HEADER.size
+            stored = self.map[start : start + storedLength]
+            if stored[:1] == KEYFRAME:
+                pair = decodeKeyframe(stored)
+                break
+            if not (len(LOG_MAGIC) <= previousOffset < position):
+                raise Exception(
+                    "Error: Delta record at offset "
+                    + str(position)
+                    + " has no previous record."
+                )
+            deltas.append(stored)
+            position = previousOffset
+        for stored in reversed(deltas):
+            pair = applyDelta(pair, stored)
+        with self.lock:
+            self.decoded[key] = (offset, pair)
+        return pair
+
+    def records(self, offset=None):
+        """
+        Iterate the records in log order
+
+        :param offset: The offset of the first record (None for the start of the log)
+        :return: Generator of FrameRecord
+        """
+        if offset is None:
+            offset = len(LOG_MAGIC)
+        while True:
+            record = self.readAt(offset)
+            if record is None:
+                return
+            yield record
+            offset = self.recordEnd(offset)
+
+    def find(self, start=None, end=None, device=None, controlType=None):
+        """
+        Iterate the records in a time range through the index, optionally for a single device and controlType
+
+        :param start: The earliest wall time (None for the beginning of the log)
+        :param end: The latest wall time, exclusive (None for the end of the log)
+        :param device: The DeviceKey of the device (None for every device)
+        :param controlType: The controlType of the responses (None for every controlType)
+        :return: Generator of FrameRecord
+        """
+        if self.index is None:
+            self.index = FrameIndex(self.path)
+        for wallTime, key, recordType, offset in self.index.find(
+            start, end, device, controlType
+        ):
+            record = self.readAt(offset)
+            if record is not None:
+                yield record
+
+    def close(self):
+        """
+        Unmap and close the log
+        """
+        self.map.close()
+        self.file.close()
+
+
+class _ReplaySocket:
+    """Socket-like object answering the requests of one connection from a recording"""
+
+    def __init__(self, transport, gatewayID):
+        self.transport = transport
+        self.gatewayID = gatewayID
+        self.condition = threading.Condition()
+        self.buffer = bytearray()
+        self.handshaken = False
+        self.closed = False
+
+    def sendall(self, data):
+        if self.closed:
+            raise OSError("Error: Replay connection is closed.")
+        if not self.handshaken:
+            # The handshake carries the userID, so it is matched on the gateway only.
+            response = self.transport.nextResponse(self.gatewayID, None)
+            self.handshaken = True
+        else:
+            response = self.transport.nextResponse(self.gatewayID, bytes(data))
+        with self.condition:
+            self.buffer.extend(response)
+            self.condition.notify_all()
+
+    def recv(self, bufsize):
+        with self.condition:
+            while (not self.buffer) and (not self.closed):
+                self.condition.wait()
+            data = bytes(self.buffer[:bufsize])
+            del self.buffer[:bufsize]
+            return data
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+
+
+class ReplayTransport:
+    """NavienSmartControl transport that serves the responses of a capture log"""
+
+    def __init__(self, path, loop=True):
+        """
+        Construct a new 'ReplayTransport' object.
+
+        :param path: The path of the capture log
+        :param loop: Start again from the first recorded response once the responses to a request run out
+        :return: returns nothing
+        """
+        self.loop = loop
+        self.lock = threading.Lock()
+        # Only the offsets of the records are kept, the responses are read from the mapped log when they are served.
+        self.reader = FrameLogReader(path)
+        self.offsets = {}
+        self.positions = {}
+        for record in self.reader:
+            if (record.channel == 0) and (record.deviceNumber == 0):
+                key = (record.gatewayID, None)
+            else:
+                key = (record.gatewayID, record.request)
+            self.offsets.setdefault(key, []).append(record.offset)
+
+    def open(self, gatewayID):
+        """
+        Open a replayed connection to a gateway
+
+        :param gatewayID: The gatewayID that we want to connect to
+        :return: A socket-like object
+        """
+        return _ReplaySocket(self, gatewayKey(gatewayID))
+
+    def nextResponse(self, gatewayID, request):
+        """
+        Get the next recorded response to a request
+
+        :param gatewayID: The gatewayID as a lowercase hex string
+        :param request: The request bytes (None for the handshake)
+        :return: The response frame
+        """
+        key = (gatewayID, request)
+        with self.lock:
+            offsets = self.offsets.get(key)
+            if not offsets:
+                raise Exception(
+                    "Error: No recorded response for this request to gateway "
+                    + gatewayID
+                    + "."
+                )
+            position = self.positions.get(key, 0)
+            if position >= len(offsets):
+                if not self.loop:
+                    raise Exception(
+                        "Error: Recorded responses for this request to gateway "
+                        + gatewayID
+                        + " are exhausted."
+                    )
+                position = 0
+            self.positions[key] = position + 1
+        return self.reader.readAt(offsets[position]).response
+
+    def close(self):
+        """
+        Close the capture log (the replayed connections can't be used afterwards)
+        """
+        self.reader.close()
@@ -0,0 +1,201 @@
+"""
+Time range queries over the recorded history.
+
+HistoryQuery answers query(device, start, end, fields, resolution) from the
+raw samples of a ColumnarStateStore or from the Rollup tables. It picks the
+coarsest rollup whose buckets are no longer than the requested resolution and
+that holds every requested field, finds the partitions in range by binary
+search over their sorted names and the rows by binary search over the sorted
+timestamp column, and streams the result partition by partition as arrays.
+"""
+
+# We fall back to array when NumPy isn't installed.
+import array
+
+# We find the partitions in range in the sorted partition names.
+import bisect
+
+# We step through the days of the raw store.
+import datetime
+
+# NumPy is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .ColumnarStore import NUMPY_TYPES
+from .Rollup import RESOLUTIONS, ROLLUP_COLUMNS, ROLLUP_TEMPERATURES, Rollup
+
+
+def concatenate(chunks):
+    """
+    Join the chunks streamed by HistoryQuery.query
+
+    :param chunks: Iterable of dictionaries of column name to array
+    :return: Dictionary of column name to a single array (None if there were no chunks)
+    """
+    parts = {}
+    for chunk in chunks:
+        for name, values in chunk.items():
+            parts.setdefault(name, []).append(values)
+    if not parts:
+        return None
+    result = {}
+    for name, values in parts.items():
+        if numpy is not None:
+            result[name] = numpy.concatenate(values)
+        else:
+            result[name] = array.array(values[0].typecode)
+            for part in values:
+                result[name].extend(part)
+    return result
+
+
+class HistoryQuery:
+    """Serves time range queries from the raw samples or the coarsest fitting rollup"""
+
+    def __init__(self, store=None, rollup=None):
+        """
+        Construct a new 'HistoryQuery' object.
+
+        :param store: The ColumnarStateStore holding the raw samples (None if there are none)
+        :param rollup: The Rollup holding the aggregates (None if there are none)
+        :return: returns nothing
+        """
+        self.store = store
+        self.rollup = rollup
+
+    @staticmethod
+    def rollupColumn(field):
+        """
+        Get the rollup column that serves a field
+
+        :param field: The field name, either a rollup column or a STATE temperature (served by its mean)
+        :return: The rollup column name, or None if the rollups don't hold the field
+        """
+        if field in ROLLUP_TEMPERATURES:
+            return field + "Mean"
+        if field in dict(ROLLUP_COLUMNS):
+            return field
+        return None
+
+    def source(self, fields, resolution):
+        """
+        Choose where a query is served from
+
+        :param fields: The field names
+        :param resolution: The requested resolution in seconds (None or 0 for the raw samples)
+        :return: The index of the resolution in RESOLUTIONS, or None for the raw samples
+        """
+        if (self.rollup is not None) and resolution:
+            servable = all(self.rollupColumn(field) is not None for field in fields)
+            if servable:
+                for level in reversed(range(len(RESOLUTIONS))):
+                    if RESOLUTIONS[level][1] <= resolution:
+                        return level
+        if self.store is not None:
+            rawColumns = dict(self.store.columns)
+            if all(field in rawColumns for field in fields):
+                return None
+        raise Exception(
+            "Error: No stored history holds "
+            + ", ".join(fields)
+            + " at a resolution of "
+            + str(resolution)
+            + " seconds."
+        )
+
+    def query(self, device, start, end, fields, resolution=None):
+        """
+        Stream the history of a device in a time range
+
+        :param device: The DeviceKey of the device
+        :param start: The earliest timestamp
+        :param end: The latest timestamp, exclusive
+        :param fields: The field names (rollup columns such as "hotWaterCurrentTemperatureMax" or "gasUse" are served from the rollups, STATE temperatures from the rollup means)
+        :param resolution: The coarsest acceptable spacing of the samples in seconds (None for the raw samples)
+        :return: Generator of dictionaries of "timestamp" and each field to an array, one per partition in time order
+        """
+        level = self.source(fields, resolution)
+        if level is None:
+            return self.queryRaw(device, start, end, fields)
+        return self.queryRollup(device, start, end, fields, level)
+
+    def queryRaw(self, device, start, end, fields):
+        """
+        Stream the raw samples of a device in a time range
+
+        :param device: The DeviceKey of the device
+        :param start: The earliest timestamp
+        :param end: The latest timestamp, exclusive
+        :param fields: The field names
+        :return: Generator of dictionaries of "timestamp" and each field to an array
+        """
+        self.store.flush()
+        day = self.store.day(start)
+        while day <= self.store.day(end):
+            table = self.store.table(device, day)
+            if table.rowCount() > 0:
+                first, last = table.range(start, end)
+                if last > first:
+                    yield dict(
+                        (name, table.readColumn(name, first, last))
+                        for name in ["timestamp"] + list(fields)
+                    )
+            day += datetime.timedelta(days=1)
+
+    def queryRollup(self, device, start, end, fields, level):
+        """
+        Stream the rollup buckets of a device in a time range
+
+        :param device: The DeviceKey of the device
+        :param start: The earliest bucket start
+        :param end: The latest bucket start, exclusive
+        :param fields: The field names
+        :param level: The index of the resolution in RESOLUTIONS
+        :return: Generator of dictionaries of "timestamp" and each field to an array
+        """
+        self.rollup.flush()
+        resolution = RESOLUTIONS[level][0]
+        partitions = self.rollup.partitions(device, resolution)
+        first = bisect.bisect_left(partitions, Rollup.partition(level, start))
+        last = bisect.bisect_right(partitions, Rollup.partition(level, end))
+        for partition in partitions[first:last]:
+            table = self.rollup.table(device, resolution, partition)
+            if table.rowCount() == 0:
+                continue
+            firstRow, lastRow = table.range(start, end)
+            if lastRow > firstRow:
+                chunk = {"timestamp": table.readColumn("timestamp", firstRow, lastRow)}
+                for field in fields:
+                    chunk[field] = table.readColumn(
+                        self.rollupColumn(field), firstRow, lastRow
+                    )
+                yield chunk
+
+    def read(self, device, start, end, fields, resolution=None):
+        """
+        Read the history of a device in a time range into single arrays
+
+        :param device: The DeviceKey of the device
+        :param start: The earliest timestamp
+        :param end: The latest timestamp, exclusive
+        :param fields: The field names (see query)
+        :param resolution: The coarsest acceptable spacing of the samples in seconds (None for the raw samples)
+        :return: Dictionary of "timestamp" and each field to an array
+        """
+        result = concatenate(self.query(device, start, end, fields, resolution))
+        if result is None:
+            result = {}
+            level = self.source(fields, resolution)
+            columns = dict(ROLLUP_COLUMNS if level is not None else self.store.columns)
+            for name in ["timestamp"] + list(fields):
+                typecode = columns[
+                    name if level is None else (self.rollupColumn(name) or name)
+                ]
+                if numpy is not None:
+                    result[name] = numpy.empty(0, dtype=NUMPY_TYPES[typecode])
+                else:
+                    result[name] = array.array(typecode)
+        return result
@@ -0,0 +1,640 @@
+"""
+selectors based event loop for many simultaneous gateway connections.
+
+A single thread drives any number of gateway sockets. Connections and
+handshakes are non-blocking, each socket has its own NavienProtocol for frame
+reassembly, and connect and request timeouts are kept on a hashed timer wheel
+so that scheduling and cancelling a timeout are O(1). Server addresses that
+aren't in the resolver cache are looked up on a small thread pool, so a slow
+DNS lookup doesn't stall the other gateways. Per connection state is kept to a
+few small objects so that thousands of sessions fit in memory.
+
+Every call returns a concurrent.futures.Future which is resolved from the
+event loop thread. open(), request() and close() must be called from the event
+loop thread (for example from a future's done callback) or before run().
+"""
+
+# We need to know which connect errors mean "in progress".
+import errno
+
+# We use the platform's best I/O multiplexing mechanism (epoll, kqueue, ...).
+import selectors
+
+# We use raw sockets.
+import socket
+
+# We need a clock for the timer wheel.
+import time
+
+# We keep the queued requests of a connection in order.
+import collections
+
+# We hand each caller a future for the result, and look up addresses off the event loop thread.
+from concurrent.futures import Future, ThreadPoolExecutor
+
+from .NavienSmartControl import (
+    NavienProtocol,
+    ControlSorting,
+    ControlType,
+    ProtocolState,
+    gatewayKey,
+)
+
+
+class TimerWheel:
+    """Hashed timer wheel with O(1) schedule and cancel"""
+
+    def __init__(self, resolution=0.1, wheelSize=512):
+        """
+        Construct a new 'TimerWheel' object.
+
+        :param resolution: Seconds per slot
+        :param wheelSize: Number of slots
+        :return: returns nothing
+        """
+        self.resolution = resolution
+        self.wheelSize = wheelSize
+        self.slots = [[] for _ in range(wheelSize)]
+        self.currentTick = int(time.monotonic() / resolution)
+        self.count = 0
+
+    def schedule(self, delay, callback):
+        """
+        Call a function after a delay
+
+        :param delay: Seconds until the callback is due
+        :param callback: The function to call
+        :return: A handle that can be passed to cancel()
+        """
+        deadline = time.monotonic() + delay
+        tick = max(int(deadline / self.resolution), self.currentTick + 1)
+        handle = [deadline, callback]
+        self.slots[tick % self.wheelSize].append(handle)
+        self.count += 1
+        return handle
+
+    def cancel(self, handle):
+        """
+        Cancel a scheduled callback (it is dropped lazily when its slot comes round)
+
+        :param handle: The handle returned by schedule()
+        """
+        if (handle is not None) and (handle[1] is not None):
+            handle[1] = None
+            self.count -= 1
+
+    def advance(self):
+        """
+        Fire every callback that is due
+        """
+        now = time.monotonic()
+        nowTick = int(now / self.resolution)
+        # Never walk the wheel more than once round per advance
+        firstTick = max(self.currentTick, nowTick - self.wheelSize + 1)
+        for tick in range(firstTick, nowTick + 1):
+            slot = self.slots[tick % self.wheelSize]
+            if not slot:
+                continue
+            remaining = []
+            for handle in slot:
+                if handle[1] is None:
+                    continue
+                if handle[0] <= now:
+                    callback = handle[1]
+                    handle[1] = None
+                    self.count -= 1
+                    callback()
+                else:
+                    # Due on a later revolution of the wheel
+                    remaining.append(handle)
+            slot[:] = remaining
+        self.currentTick = nowTick
+
+    def nextTimeout(self):
+        """
+        Upper bound on how long the event loop may sleep
+
+        :return: Seconds until the next slot, or None if nothing is scheduled
+        """
+        if self.count == 0:
+            return None
+        return max(0, (self.currentTick + 1) * self.resolution - time.monotonic())
+
+
+class _MultiplexedConnection:
+    """State of one gateway connection"""
+
+    __slots__ = (
+        "gatewayID",
+        "socket",
+        "protocol",
+        "connecting",
+        "outgoing",
+        "queue",
+        "current",
+        "timer",
+        "endpoints",
+        "endpoint",
+    )
+
+    def __init__(self, gatewayID, protocol):
+        self.gatewayID = gatewayID
+        self.socket = None
+        self.protocol = protocol
+        self.connecting = True
+        self.outgoing = bytearray()
+        self.queue = None
+        self.current = None
+        self.timer = None
+        self.endpoints = None
+        self.endpoint = None
+
+
+class NavienMultiplexer:
+    """Drives many NaviLink gateway connections from a single thread"""
+
+    def __init__(
+        self,
+        navienSmartControl,
+        connectTimeout=10.0,
+        requestTimeout=10.0,
+        timerResolution=0.1,
+        resolverThreads=4,
+    ):
+        """
+        Construct a new 'NavienMultiplexer' object.
+
+        :param navienSmartControl: The NavienSmartControl object providing the userID, server endpoints (see directConnect), resolver cache, response parsers and optional rate limiter
+        :param connectTimeout: Seconds allowed for the TCP connect and the handshake
+        :param requestTimeout: Seconds allowed for each response
+        :param timerResolution: Granularity in seconds of the timeouts
+        :param resolverThreads: Number of threads looking up the server addresses that aren't cached
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.connectTimeout = connectTimeout
+        self.requestTimeout = requestTimeout
+        self.selector = selectors.DefaultSelector()
+        self.timers = TimerWheel(timerResolution)
+        self.connections = {}
+        self.running = False
+        self.resolver = ThreadPoolExecutor(resolverThreads)
+        # Callbacks handed to the event loop thread by other threads, and the socket pair that wakes it up for them
+        self.callbacks = collections.deque()
+        self.wakeReader, self.wakeWriter = socket.socketpair()
+        self.wakeReader.setblocking(False)
+        self.wakeWriter.setblocking(False)
+        self.selector.register(self.wakeReader, selectors.EVENT_READ, None)
+
+    def callSoon(self, callback):
+        """
+        Run a function on the event loop thread (may be called from any thread)
+
+        :param callback: The function to call
+        """
+        self.callbacks.append(callback)
+        try:
+            self.wakeWriter.send(b"\0")
+        except (BlockingIOError, InterruptedError):
+            # The event loop is already due to wake up
+            pass
+
+    def lookup(self, connection, host, port, error):
+        """
+        Resolve a server address on the resolver threads, then carry on connecting on the event loop thread
+
+        :param connection: The connection
+        :param host: The server host name
+        :param port: The server port
+        :param error: The error of the previous endpoint (None for the first attempt)
+        """
+        resolverCache = self.navienSmartControl.resolverCache
+
+        def resolve():
+            try:
+                address = resolverCache.resolve(host, port)
+                lookupError = None
+            except socket.error as e:
+                address = None
+                lookupError = e
+            self.callSoon(
+                lambda: self.resolved(connection, address, lookupError or error)
+            )
+
+        self.resolver.submit(resolve)
+
+    def resolved(self, connection, address, error):
+        """
+        Connect to a server address once it was looked up, or fail over to the next endpoint
+
+        :param connection: The connection
+        :param address: The socket address (None if the lookup failed)
+        :param error: The error of the lookup or of the previous endpoint
+        """
+        if self.connections.get(gatewayKey(connection.gatewayID)) is not connection:
+            # The connection was closed or timed out meanwhile
+            return
+        host, port = connection.endpoints.popleft()
+        try:
+            if address is not None:
+                try:
+                    self.connectTo(connection, host, port, address)
+                    return
+                except socket.error as e:
+                    error = e
+            self.connectNext(connection, error)
+        except Exception as e:
+            self.fail(connection, e)
+
+    def open(self, gatewayID):
+        """
+        Start a non-blocking connection and handshake to a gateway
+
+        :param gatewayID: The gatewayID that we want to connect to, as a hex string
+        :return: A future that resolves to the channel information response
+        """
+        self.close(gatewayID)
+        connection = _MultiplexedConnection(
+            gatewayID, NavienProtocol(self.navienSmartControl.parseResponse)
+        )
+        connection.current = Future()
+        connection.current.set_running_or_notify_cancel()
+        # The same endpoints, in the same order, as NavienSmartControl.openSocket tries
+        connection.endpoints = collections.deque(
+            self.navienSmartControl.serverEndpoints(gatewayID)
+        )
+        self.connections[gatewayKey(gatewayID)] = connection
+        try:
+            self.connectNext(connection)
+        except Exception as e:
+            future = connection.current
+            self.fail(connection, e)
+            return future
+        connection.timer = self.scheduleTimer(
+            connection,
+            self.connectTimeout,
+            lambda: self.fail(
+                connection, Exception("Error: Timed out connecting to the gateway.")
+            ),
+        )
+        return connection.current
+
+    def connectNext(self, connection, error=None):
+        """
+        Start a non-blocking connect to the next endpoint of a gateway, failing over from endpoints that can't be reached
+
+        :param connection: The connection
+        :param error: The error of the previous endpoint (None for the first attempt)
+        """
+        while connection.endpoints:
+            host, port = connection.endpoints[0]
+            address = self.navienSmartControl.resolverCache.cached(host, port)
+            if address is None:
+                # Don't block the event loop on DNS
+                self.lookup(connection, host, port, error)
+                return
+            connection.endpoints.popleft()
+            try:
+                self.connectTo(connection, host, port, address)
+                return
+            except socket.error as e:
+                error = e
+        raise error
+
+    def connectTo(self, connection, host, port, address):
+        """
+        Start a non-blocking connect and the handshake to a resolved endpoint
+
+        :param connection: The connection
+        :param host: The server host name of the endpoint
+        :param port: The server port of the endpoint
+        :param address: The resolved socket address
+        """
+        connectionSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        connectionSocket.setblocking(False)
+        try:
+            result = connectionSocket.connect_ex(address)
+            if result not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK]:
+                raise socket.error(result, "Error: Unable to connect to the server.")
+        except socket.error:
+            connectionSocket.close()
+            self.navienSmartControl.resolverCache.invalidate(host, port)
+            raise
+        connection.socket = connectionSocket
+        connection.endpoint = (host, port)
+        connection.outgoing = bytearray(
+            connection.protocol.startHandshake(
+                self.navienSmartControl.userID, connection.gatewayID
+            )
+        )
+        self.selector.register(connectionSocket, selectors.EVENT_WRITE, connection)
+
+    def scheduleTimer(self, connection, delay, callback):
+        """
+        Schedule a callback for a connection on the timer wheel, failing the connection rather than the event loop if it raises
+
+        :param connection: The connection the callback is for
+        :param delay: Seconds until the callback is due
+        :param callback: The function to call
+        :return: A handle that can be passed to TimerWheel.cancel()
+        """
+
+        def guarded():
+            try:
+                callback()
+            except Exception as e:
+                self.fail(connection, e)
+
+        return self.timers.schedule(delay, guarded)
+
+    def request(
+        self,
+        gatewayID,
+        currentControlChannel,
+        deviceNumber,
+        controlSorting,
+        infoItem,
+        controlItem,
+        controlValue,
+        WeeklyDay=None,
+    ):
+        """
+        Queue a request on a gateway connection
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param controlSorting: Corresponds with the ControlSorting enum (info or control)
+        :param infoItem: Corresponds with the ControlType enum
+        :param controlItem: Corresponds with the ControlType enum when controlSorting is control
+        :param controlValue: Value being changed when controlling
+        :param WeeklyDay: WeeklyDay dictionary (None for an empty one)
+        :return: A future that resolves to the parsed response data
+        """
+        future = Future()
+        connection = self.connections.get(gatewayKey(gatewayID))
+        if connection is None:
+            future.set_exception(
+                Exception("Error: Not connected. Please open() the gateway first.")
+            )
+            return future
+        if WeeklyDay is None:
+            WeeklyDay = self.navienSmartControl.initWeeklyDay()
+        args = (
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            controlSorting,
+            infoItem,
+            controlItem,
+            controlValue,
+            WeeklyDay,
+        )
+        if connection.queue is None:
+            connection.queue = collections.deque()
+        connection.queue.append((args, future))
+        self.sendNext(connection)
+        return future
+
+    def sendStateRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Queue a state request
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :return: A future that resolves to the parsed response data
+        """
+        return self.request(
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+            ControlSorting.INFO.value,
+            ControlType.STATE.value,
+            0x00,
+            0x00,
+        )
+
+    def sendNext(self, connection):
+        """
+        Send the next queued request if the connection is idle
+
+        :param connection: The connection
+        """
+        if (
+            connection.connecting
+            or (connection.current is not None)
+            or not connection.queue
+        ):
+            return
+        rateLimiter = self.navienSmartControl.rateLimiter
+        args, future = connection.queue.popleft()
+        if not future.set_running_or_notify_cancel():
+            self.sendNext(connection)
+            return
+        connection.current = future
+        delay = 0
+        if rateLimiter is not None:
+            delay = rateLimiter.reserve(connection.gatewayID)
+        if delay > 0:
+            # Wait for the rate limiter on the timer wheel rather than blocking the loop
+            connection.timer = self.scheduleTimer(
+                connection, delay, lambda: self.write(connection, args)
+            )
+        else:
+            self.write(connection, args)
+
+    def write(self, connection, args):
+        """
+        Queue a request for sending and start the response timeout
+
+        :param connection: The connection
+        :param args: The arguments of NavienProtocol.encodeRequest
+        """
+        connection.outgoing.extend(connection.protocol.sendRequest(*args))
+        self.selector.modify(
+            connection.socket, selectors.EVENT_READ | selectors.EVENT_WRITE, connection
+        )
+        connection.timer = self.scheduleTimer(
+            connection, self.requestTimeout, lambda: self.requestTimedOut(connection)
+        )
+
+    def requestTimedOut(self, connection):
+        """
+        Resolve the request in flight with the buffered bytes, or give up on the connection if nothing arrived
+
+        :param connection: The connection
+        """
+        connection.timer = None
+        # Take what was buffered as a complete frame so it can't be prepended to the next response
+        events = connection.protocol.receiveTimeout()
+        if not events:
+            # A late response would be taken for the answer to the next request
+            self.fail(
+                connection, TimeoutError("Error: Timed out waiting for a response.")
+            )
+            return
+        self.handleEvents(connection, events)
+
+    def handleWritable(self, connection):
+        """
+        Complete a pending connect and flush queued bytes
+
+        :param connection: The connection
+        """
+        if connection.connecting:
+            error = connection.socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if error != 0:
+                # Fail over to the next endpoint, if there is one
+                self.selector.unregister(connection.socket)
+                connection.socket.close()
+                connection.socket = None
+                self.navienSmartControl.resolverCache.invalidate(*connection.endpoint)
+                self.connectNext(
+                    connection,
+                    socket.error(error, "Error: Unable to connect to the server."),
+                )
+                return
+        if connection.outgoing:
+            sent = connection.socket.send(connection.outgoing)
+            del connection.outgoing[:sent]
+        if not connection.outgoing:
+            self.selector.modify(connection.socket, selectors.EVENT_READ, connection)
+
+    def handleReadable(self, connection):
+        """
+        Reassemble received frames and resolve the request in flight
+
+        :param connection: The connection
+        """
+        data = connection.socket.recv(4096)
+        if not data:
+            connection.protocol.receiveData(data)
+            raise Exception("Error: Connection closed by the server.")
+        self.handleEvents(connection, connection.protocol.receiveData(data))
+
+    def handleEvents(self, connection, events):
+        """
+        Resolve the request in flight with received frames and send the next one
+
+        :param connection: The connection
+        :param events: List of ProtocolEvents
+        """
+        for event in events:
+            future = connection.current
+            if future is None:
+                # Not a response to anything we sent
+                continue
+            self.timers.cancel(connection.timer)
+            connection.timer = None
+            connection.current = None
+            connection.connecting = False
+            if event.error is not None:
+                future.set_exception(event.error)
+            else:
+                future.set_result(event.response)
+        self.sendNext(connection)
+
+    def fail(self, connection, error):
+        """
+        Close a connection and fail everything waiting on it
+
+        :param connection: The connection
+        :param error: The exception to fail the futures with
+        """
+        self.timers.cancel(connection.timer)
+        connection.timer = None
+        if connection.socket is not None:
+            try:
+                self.selector.unregister(connection.socket)
+            except (KeyError, ValueError):
+                pass
+            connection.socket.close()
+            connection.socket = None
+        key = gatewayKey(connection.gatewayID)
+        if self.connections.get(key) is connection:
+            del self.connections[key]
+        connection.protocol.receiveData(b"")
+        futures = []
+        if connection.current is not None:
+            futures.append(connection.current)
+            connection.current = None
+        if connection.queue:
+            futures.extend(future for args, future in connection.queue)
+            connection.queue = None
+        for future in futures:
+            if not future.done():
+                if future.running():
+                    future.set_exception(error)
+                elif future.set_running_or_notify_cancel():
+                    future.set_exception(error)
+
+    def close(self, gatewayID=None):
+        """
+        Close a gateway connection
+
+        :param gatewayID: The gatewayID to disconnect from (None to close every connection)
+        """
+        if gatewayID is None:
+            connections = list(self.connections.values())
+        else:
+            connections = [self.connections.get(gatewayKey(gatewayID))]
+        for connection in connections:
+            if connection is not None:
+                self.fail(connection, Exception("Error: Connection closed."))
+
+    def isConnected(self, gatewayID):
+        """
+        Check if a gateway has completed its handshake
+
+        :param gatewayID: The gatewayID
+        :return: True if requests can be sent to the gateway
+        """
+        connection = self.connections.get(gatewayKey(gatewayID))
+        return (connection is not None) and (
+            connection.protocol.state == ProtocolState.CONNECTED
+        )
+
+    def runOnce(self, timeout=None):
+        """
+        Wait for and handle socket events and due timeouts
+
+        :param timeout: Maximum seconds to wait for an event (None to wait for the next timer)
+        """
+        nextTimer = self.timers.nextTimeout()
+        if (timeout is None) or ((nextTimer is not None) and (nextTimer < timeout)):
+            timeout = nextTimer
+        for key, mask in self.selector.select(timeout):
+            connection = key.data
+            if connection is None:
+                # Woken up for callbacks from another thread
+                try:
+                    while self.wakeReader.recv(4096):
+                        pass
+                except (BlockingIOError, InterruptedError):
+                    pass
+                continue
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    self.handleWritable(connection)
+                if (mask & selectors.EVENT_READ) and (connection.socket is not None):
+                    self.handleReadable(connection)
+            except Exception as e:
+                self.fail(connection, e)
+        while self.callbacks:
+            self.callbacks.popleft()()
+        self.timers.advance()
+
+    def run(self):
+        """
+        Run the event loop until stop() is called
+        """
+        self.running = True
+        while self.running:
+            self.runOnce(1.0)
+
+    def stop(self):
+        """
+        Stop a running event loop after the current iteration
+        """
+        self.running = False
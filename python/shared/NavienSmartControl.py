@@ -28,6 +28,9 @@ import struct
 # We use namedtuple to reduce index errors.
 import collections
 
+# We wrap gateway operations in an optional circuit breaker.
+import contextlib
+
 # We use binascii to convert some consts from hex.
 import binascii
 
@@ -37,6 +40,15 @@ import enum
 # We need json support for parsing the REST API response
 import json
 
+# We serialise requests on each connection between threads.
+import threading
+
+# We need a clock to expire cached DNS lookups and to timestamp pushed updates.
+import time
+
+# The background reader hands responses to the waiting requests through futures.
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
 
 class ControlType(enum.Enum):
     UNKNOWN = 0
@@ -152,6 +164,13 @@ class ControlSorting(enum.Enum):
     CONTROL = 2
 
 
+class ProtocolState(enum.Enum):
+    IDLE = 0
+    HANDSHAKE = 1
+    CONNECTED = 2
+    CLOSED = 3
+
+
 class DeviceControl(enum.Enum):
     POWER = 1
     HEAT = 2
@@ -162,6 +181,501 @@ class DeviceControl(enum.Enum):
     RECIRCULATION_TEMPERATURE = 7
 
 
+# Identifies a single device behind a gateway (gatewayID is the lowercase hex form).
+DeviceKey = collections.namedtuple(
+    "DeviceKey", ["gatewayID", "channel", "deviceNumber"]
+)
+
+
+# A complete frame received from the server, with its parsed response (or the error raised parsing it).
+ProtocolEvent = collections.namedtuple(
+    "ProtocolEvent",
+    ["controlType", "channel", "deviceNumber", "frame", "response", "error"],
+)
+
+
+class ProtocolError(Exception):
+    """Raised for a frame the server sent that can't be made sense of"""
+
+
+def gatewayKey(gatewayID):
+    """
+    Normalise a gatewayID to the lowercase hex string form
+
+    The REST API returns the GID as a hex string whereas the binary API expects raw bytes, so this gives both a common form to be used as a dictionary key.
+
+    :param gatewayID: The gatewayID as a hex string or as raw bytes
+    :return: The gatewayID as a lowercase hex string
+    """
+    if isinstance(gatewayID, (bytes, bytearray)):
+        return binascii.hexlify(gatewayID).decode().lower()
+    return str(gatewayID).lower()
+
+
+class GatewayConnection:
+    """A socket connection to a single gateway and the lock serialising its request/response pairs"""
+
+    def __init__(self, gatewayID):
+        self.gatewayID = gatewayID
+        self.socket = None
+        self.protocol = None
+        self.lock = threading.Lock()
+        # Frames received beyond the one a request was waiting for
+        self.events = collections.deque()
+        # Only used with the background reader: the requests waiting for a response and the thread reading them
+        self.waiters = []
+        self.waitersLock = threading.Lock()
+        self.reader = None
+
+
+class NavienProtocol:
+    """
+    Sans-I/O state machine for the binary API
+
+    Bytes received from the gateway go in through receiveData() and come out as ProtocolEvents carrying the complete frame and its parsed response. Bytes to send come out of startHandshake() and sendRequest(). No socket calls are made here, so blocking, asyncio and selectors based transports can all share this.
+    """
+
+    # The fixed response header (deviceID, countryCD, controlType, swVersionMajor, swVersionMinor)
+    headerLength = 12
+    controlTypeOffset = 9
+    # Number of gatewayID bytes that have to match to recognise the start of a frame
+    markerLength = 4
+    # The short and long form lengths of the frames that come in two forms
+    variableFrameLengths = {
+        ControlType.STATE.value: (271, 273),
+        ControlType.TREND_SAMPLE.value: (39, 43),
+    }
+
+    def __init__(self, responseParser=None):
+        """
+        Construct a new 'NavienProtocol' object.
+
+        :param responseParser: Callable that parses a complete frame (e.g. NavienSmartControl.parseResponse). Without one, events only carry the raw frame.
+        :return: returns nothing
+        """
+        self.responseParser = responseParser
+        self.state = ProtocolState.IDLE
+        self.gatewayID = None
+        self.buffer = bytearray()
+        self.pendingRequests = 0
+
+    def startHandshake(self, userID, gatewayID):
+        """
+        Begin the connection handshake
+
+        :param userID: The user ID used to log in to the mobile application
+        :param gatewayID: The gatewayID that we want to connect to, as a hex string
+        :return: The bytes to send to the server
+        """
+        self.state = ProtocolState.HANDSHAKE
+        self.gatewayID = bytes(binascii.unhexlify(gatewayID))
+        self.buffer = bytearray()
+        return (userID + "$" + "iPhone1.0" + "$" + gatewayID).encode()
+
+    @staticmethod
+    def encodeRequest(
+        gatewayID,
+        currentControlChannel,
+        deviceNumber,
+        controlSorting,
+        infoItem,
+        controlItem,
+        controlValue,
+        WeeklyDay,
+    ):
+        """
+        Encode a request frame for the binary API
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param controlSorting: Corresponds with the ControlSorting enum (info or control)
+        :param infoItem: Corresponds with the ControlType enum
+        :param controlItem: Corresponds with the ControlType enum when controlSorting is control
+        :param controlValue: Value being changed when controlling
+        :param WeeklyDay: WeeklyDay dictionary (values are ignored when not changing schedule, but must be present)
+        :return: The encoded request frame
+        """
+        requestHeader = {
+            "stx": 0x07,
+            "did": 0x99,
+            "reserve": 0x00,
+            "cmd": 0xA6,
+            "dataLength": 0x37,
+            "dSid": 0x00,
+        }
+        sendData = bytearray(
+            [
+                requestHeader["stx"],
+                requestHeader["did"],
+                requestHeader["reserve"],
+                requestHeader["cmd"],
+                requestHeader["dataLength"],
+                requestHeader["dSid"],
+            ]
+        )
+        sendData.extend(gatewayID)
+        sendData.extend(
+            [
+                0x01,  # commandCount
+                currentControlChannel,
+                deviceNumber,
+                controlSorting,
+                infoItem,
+                controlItem,
+                controlValue,
+            ]
+        )
+        sendData.extend(
+            [
+                WeeklyDay["WeeklyDay"],
+                WeeklyDay["WeeklyCount"],
+                WeeklyDay["1_Hour"],
+                WeeklyDay["1_Minute"],
+                WeeklyDay["1_Flag"],
+                WeeklyDay["2_Hour"],
+                WeeklyDay["2_Minute"],
+                WeeklyDay["2_Flag"],
+                WeeklyDay["3_Hour"],
+                WeeklyDay["3_Minute"],
+                WeeklyDay["3_Flag"],
+                WeeklyDay["4_Hour"],
+                WeeklyDay["4_Minute"],
+                WeeklyDay["4_Flag"],
+                WeeklyDay["5_Hour"],
+                WeeklyDay["5_Minute"],
+                WeeklyDay["5_Flag"],
+                WeeklyDay["6_Hour"],
+                WeeklyDay["6_Minute"],
+                WeeklyDay["6_Flag"],
+                WeeklyDay["7_Hour"],
+                WeeklyDay["7_Minute"],
+                WeeklyDay["7_Flag"],
+                WeeklyDay["8_Hour"],
+                WeeklyDay["8_Minute"],
+                WeeklyDay["8_Flag"],
+                WeeklyDay["9_Hour"],
+                WeeklyDay["9_Minute"],
+                WeeklyDay["9_Flag"],
+                WeeklyDay["10_Hour"],
+                WeeklyDay["10_Minute"],
+                WeeklyDay["10_Flag"],
+            ]
+        )
+        return sendData
+
+    def sendRequest(self, *args):
+        """
+        Encode a request to be sent on this connection
+
+        :param args: The arguments of encodeRequest
+        :return: The bytes to send to the server
+        """
+        if self.state != ProtocolState.CONNECTED:
+            raise Exception(
+                "Error: Unable to send a request while the connection is "
+                + self.state.name
+            )
+        self.pendingRequests += 1
+        return self.encodeRequest(*args)
+
+    def receiveData(self, data):
+        """
+        Feed bytes received from the server into the state machine
+
+        :param data: The bytes received (empty when the server closed the connection)
+        :return: A list of ProtocolEvents for each frame completed by the data
+        """
+        if not data:
+            self.state = ProtocolState.CLOSED
+            return []
+        self.buffer.extend(data)
+        events = []
+        while self.buffer:
+            frameLength = self.frameLength(self.buffer)
+            if frameLength is None:
+                break
+            frame = bytes(self.buffer[:frameLength])
+            del self.buffer[:frameLength]
+            events.append(self.handleFrame(frame))
+        return events
+
+    def receiveTimeout(self):
+        """
+        Tell the state machine that no more bytes arrived for a while
+
+        A frame of unexpected length can't be told apart from a frame still arriving, so once the transport has waited long enough the buffered bytes are taken as a complete frame.
+
+        :return: A list with the ProtocolEvent of the buffered bytes (empty if nothing was buffered)
+        """
+        if not self.buffer:
+            return []
+        frame = bytes(self.buffer)
+        del self.buffer[:]
+        if len(frame) < NavienProtocol.headerLength:
+            if self.pendingRequests > 0:
+                self.pendingRequests -= 1
+            return [
+                ProtocolEvent(
+                    None,
+                    None,
+                    None,
+                    frame,
+                    None,
+                    ProtocolError(
+                        "Error: Incomplete " + str(len(frame)) + " byte frame received."
+                    ),
+                )
+            ]
+        return [self.handleFrame(frame)]
+
+    def handleFrame(self, frame):
+        """
+        Turn a complete frame into an event
+
+        :param frame: The complete frame
+        :return: The ProtocolEvent for the frame
+        """
+        if self.state == ProtocolState.HANDSHAKE:
+            # The first frame is the channel information that completes the handshake
+            self.state = ProtocolState.CONNECTED
+        elif self.pendingRequests > 0:
+            self.pendingRequests -= 1
+
+        controlType = frame[NavienProtocol.controlTypeOffset]
+        channel = None
+        deviceNumber = None
+        if (controlType != ControlType.CHANNEL_INFORMATION.value) and (len(frame) > 19):
+            # Every device response carries currentChannel and deviceNumber after the versions, deviceSorting and deviceCount
+            channel = frame[18]
+            deviceNumber = frame[19]
+
+        response = None
+        error = None
+        if (controlType in NavienProtocol.variableFrameLengths) and (
+            len(frame) not in NavienProtocol.variableFrameLengths[controlType]
+        ):
+            error = ProtocolError(
+                "Error: Unexpected "
+                + str(len(frame))
+                + " byte "
+                + ControlType(controlType).name
+                + " frame received."
+            )
+        elif self.responseParser is not None:
+            try:
+                response = self.responseParser(frame)
+            except Exception as e:
+                error = ProtocolError(str(e))
+                error.__cause__ = e
+        return ProtocolEvent(controlType, channel, deviceNumber, frame, response, error)
+
+    def frameLength(self, buffer):
+        """
+        Work out the length of the frame at the start of the buffer
+
+        Responses carry no length field, so it is derived from the controlType (and the firmware version or record count where those change the layout).
+
+        :param buffer: The received bytes
+        :return: The frame length, or None if more bytes are needed
+        """
+        if len(buffer) < NavienProtocol.headerLength:
+            return None
+        controlType = buffer[NavienProtocol.controlTypeOffset]
+        if controlType == ControlType.CHANNEL_INFORMATION.value:
+            fwVersion = int(buffer[10] * 100 + buffer[11])
+            if fwVersion > 1500:
+                frameLength = 13 + 15 * 3
+            else:
+                frameLength = 13 + 13 * 3
+        elif controlType == ControlType.STATE.value:
+            # The recirculation temperatures are only present on newer devices
+            return self.variableFrameLength(
+                buffer, *NavienProtocol.variableFrameLengths[controlType]
+            )
+        elif controlType == ControlType.TREND_SAMPLE.value:
+            # The DHW usage time is only present on newer devices
+            return self.variableFrameLength(
+                buffer, *NavienProtocol.variableFrameLengths[controlType]
+            )
+        elif controlType in [
+            ControlType.TREND_MONTH.value,
+            ControlType.TREND_YEAR.value,
+        ]:
+            if len(buffer) < 21:
+                return None
+            frameLength = 21 + 22 * buffer[20]
+        elif controlType == ControlType.ERROR_CODE.value:
+            frameLength = 23
+        else:
+            # Unknown frame, hand over everything so the parser can report it
+            frameLength = len(buffer)
+        if len(buffer) < frameLength:
+            return None
+        return frameLength
+
+    def variableFrameLength(self, buffer, shortLength, longLength):
+        """
+        Work out the length of a frame that comes in a short and a long form
+
+        Every frame starts with the gatewayID, so when bytes beyond the frame are buffered we check which form the next frame follows. Otherwise the end of the received data is taken as the end of the frame. A frame of any other length runs up to the start of the next frame, or to the end of the received data, and is reported by handleFrame rather than leaving its extra bytes to misalign the following frames.
+
+        :param buffer: The received bytes
+        :param shortLength: The length of the short form
+        :param longLength: The length of the long form
+        :return: The frame length, or None if more bytes are needed (see receiveTimeout)
+        """
+        if len(buffer) < shortLength:
+            return None
+        if len(buffer) == shortLength:
+            return shortLength
+        if self.startsFrame(buffer, shortLength):
+            return shortLength
+        if (len(buffer) == longLength) or self.startsFrame(buffer, longLength):
+            return longLength
+        nextFrame = self.findFrame(buffer, shortLength + 1)
+        if nextFrame is not None:
+            return nextFrame
+        if len(buffer) < longLength + NavienProtocol.markerLength:
+            # Either the rest of a long frame or the start of the next frame may still be coming
+            return None
+        return len(buffer)
+
+    def findFrame(self, buffer, start):
+        """
+        Find where the next frame appears to start in the buffer
+
+        :param buffer: The received bytes
+        :param start: The offset to search from
+        :return: The offset of the next frame, or None if none was found
+        """
+        if self.gatewayID is None:
+            return None
+        marker = self.gatewayID[: NavienProtocol.markerLength]
+        offset = buffer.find(marker, start)
+        while offset >= 0:
+            if self.startsFrame(buffer, offset):
+                return offset
+            offset = buffer.find(marker, offset + 1)
+        return None
+
+    def startsFrame(self, buffer, offset):
+        """
+        Check if a frame appears to start at an offset in the buffer
+
+        :param buffer: The received bytes
+        :param offset: The offset to check
+        :return: True if the bytes at the offset match (the start of) the gatewayID
+        """
+        if (self.gatewayID is None) or (len(buffer) <= offset):
+            return False
+        following = bytes(buffer[offset : offset + len(self.gatewayID)])
+        return self.gatewayID.startswith(following) and (
+            len(following) >= NavienProtocol.markerLength
+        )
+
+
+class ResolverCache:
+    """Caches resolved server addresses for a limited time"""
+
+    def __init__(self, ttl=300):
+        """
+        Construct a new 'ResolverCache' object.
+
+        :param ttl: Seconds a resolved address is reused before it is looked up again
+        :return: returns nothing
+        """
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.addresses = {}
+
+    def resolve(self, host, port):
+        """
+        Resolve a server address, reusing the cached address while it is fresh
+
+        :param host: The server host name or IP address
+        :param port: The server port
+        :return: The socket address to connect to
+        """
+        now = time.monotonic()
+        with self.lock:
+            cached = self.addresses.get((host, port))
+        if (cached is not None) and (cached[1] > now):
+            return cached[0]
+        addresses = socket.getaddrinfo(host, port, socket.AF_INET, socket.SOCK_STREAM)
+        address = addresses[0][4]
+        with self.lock:
+            self.addresses[(host, port)] = (address, now + self.ttl)
+        return address
+
+    def cached(self, host, port):
+        """
+        Get a server address only if it is cached and fresh, without looking it up
+
+        :param host: The server host name or IP address
+        :param port: The server port
+        :return: The socket address to connect to, or None if it needs to be resolved
+        """
+        with self.lock:
+            cached = self.addresses.get((host, port))
+        if (cached is not None) and (cached[1] > time.monotonic()):
+            return cached[0]
+        return None
+
+    def invalidate(self, host, port):
+        """
+        Forget a cached address, for example after connecting to it failed
+
+        :param host: The server host name or IP address
+        :param port: The server port
+        """
+        with self.lock:
+            self.addresses.pop((host, port), None)
+
+
+def gasInstantUseFactor(deviceSorting):
+    """
+    Get the factor that scales gasInstantUse to tenths of a kcal, which depends on the device model
+
+    :param deviceSorting: The deviceSorting of the device
+    :return: The factor
+    """
+    if deviceSorting in [
+        DeviceSorting.NFC.value,
+        DeviceSorting.NCB_H.value,
+        DeviceSorting.NFB.value,
+        DeviceSorting.NVW.value,
+    ]:
+        return 100
+    return 10
+
+
+def trendPeriod(controlType, dMIndex, date):
+    """
+    Get the period a trend month or year record belongs to
+
+    A trend month record is indexed by the day of the month and a trend year record by the month of the year, so the response only tells the period through the date of the request. A record with an index past that date is from the previous month or year still in the device's window.
+
+    :param controlType: The controlType of the trend response (TREND_MONTH or TREND_YEAR)
+    :param dMIndex: The dMIndex of the record
+    :param date: The date of the request
+    :return: The period as "YYYY-MM" for a trend month record and "YYYY" for a trend year record
+    """
+    if controlType == ControlType.TREND_MONTH.value:
+        year, month = date.year, date.month
+        if dMIndex > date.day:
+            year, month = (year - 1, 12) if month == 1 else (year, month - 1)
+        return "%04d-%02d" % (year, month)
+    if controlType == ControlType.TREND_YEAR.value:
+        year = date.year
+        if dMIndex > date.month:
+            year -= 1
+        return "%04d" % year
+    raise Exception(
+        "Error: " + ControlType(controlType).name + " is not a trend month or year"
+    )
+
+
 class AutoVivification(dict):
     """Implementation of perl's autovivification feature."""
 
@@ -184,17 +698,53 @@ class NavienSmartControl:
     navienWebServer = "https://" + navienServer
     navienServerSocketPort = 6001
 
-    def __init__(self, userID, passwd):
+    def __init__(
+        self,
+        userID,
+        passwd,
+        rateLimiter=None,
+        directConnect=False,
+        resolverCache=None,
+        circuitBreaker=None,
+        backgroundReader=False,
+        recorder=None,
+        transport=None,
+        timeout=30.0,
+    ):
         """
         Construct a new 'NavienSmartControl' object.
 
         :param userID: The user ID used to log in to the mobile application
         :param passwd: The corresponding user's password
+        :param rateLimiter: Optional RateLimiter shared by login, connect and sendRequest
+        :param directConnect: Connect to the ServerIP/ServerPort advertised for each gateway at login, falling back to the default server
+        :param resolverCache: Optional ResolverCache (one with the default TTL is created if not given)
+        :param circuitBreaker: Optional CircuitBreaker that fails connect and sendRequest fast for gateways that keep failing
+        :param backgroundReader: Read each connection on a background thread, routing responses to their requests and unsolicited STATE frames to the state subscribers
+        :param recorder: Optional FrameRecorder that every request/response pair sent by connect and sendRequest is appended to
+        :param transport: Optional object whose open(gatewayID) returns a socket-like object (sendall, recv, close) used instead of a TCP connection, e.g. a ReplayTransport
+        :param timeout: Seconds to wait for the server to accept the connection or to respond (None to wait forever)
         :return: returns nothing
         """
         self.userID = userID
         self.passwd = passwd
         self.connection = None
+        self.rateLimiter = rateLimiter
+        self.directConnect = directConnect
+        self.circuitBreaker = circuitBreaker
+        self.backgroundReader = backgroundReader
+        self.recorder = recorder
+        self.transport = transport
+        self.timeout = timeout
+        self.stateSubscribers = []
+        if resolverCache is None:
+            resolverCache = ResolverCache()
+        self.resolverCache = resolverCache
+        # The server endpoint of each gateway, as advertised in the gateway list.
+        self.gatewayEndpoints = {}
+        # One connection per gateway so that requests to different gateways can run in parallel.
+        self.connections = {}
+        self.connectionsLock = threading.Lock()
 
     def login(self):
         """
@@ -202,6 +752,9 @@ class NavienSmartControl:
         
         :return: The REST API response
         """
+        if self.rateLimiter is not None:
+            self.rateLimiter.acquire()
+
         response = requests.post(
             NavienSmartControl.navienWebServer + "/api/requestDeviceList",
             headers=NavienSmartControl.stealthyHeaders,
@@ -209,7 +762,70 @@ class NavienSmartControl:
         )
 
         # If an error occurs this will raise it, otherwise it returns the gateway list.
-        return self.handleResponse(response)
+        gateways = self.handleResponse(response)
+
+        # Remember where each gateway's server is so that we can connect to it directly.
+        for gateway in gateways:
+            if gateway.get("ServerIP") and gateway.get("ServerPort"):
+                self.gatewayEndpoints[gatewayKey(gateway["GID"])] = (
+                    gateway["ServerIP"],
+                    int(gateway["ServerPort"]),
+                )
+
+        return gateways
+
+    def serverEndpoints(self, gatewayID):
+        """
+        List the server endpoints to try when connecting to a gateway
+
+        :param gatewayID: The gatewayID that we want to connect to
+        :return: List of (host, port) tuples in the order they should be tried
+        """
+        endpoints = []
+        if self.directConnect:
+            endpoint = self.gatewayEndpoints.get(gatewayKey(gatewayID))
+            if endpoint is not None:
+                endpoints.append(endpoint)
+        defaultEndpoint = (
+            NavienSmartControl.navienServer,
+            NavienSmartControl.navienServerSocketPort,
+        )
+        if defaultEndpoint not in endpoints:
+            endpoints.append(defaultEndpoint)
+        return endpoints
+
+    def guardGateway(self, gatewayID):
+        """
+        Report the outcome of an operation on a gateway to the circuit breaker, if any
+
+        :param gatewayID: The gatewayID the operation is for
+        :return: A context manager that raises CircuitOpenError on entry while the gateway's circuit is open
+        """
+        if self.circuitBreaker is None:
+            return contextlib.nullcontext()
+        return self.circuitBreaker.guard(gatewayID)
+
+    def openSocket(self, gatewayID):
+        """
+        Open a socket to the server of a gateway, failing over to the next endpoint on error
+
+        :param gatewayID: The gatewayID that we want to connect to
+        :return: The connected socket
+        """
+        if self.transport is not None:
+            return self.transport.open(gatewayID)
+
+        error = None
+        for host, port in self.serverEndpoints(gatewayID):
+            try:
+                # Connect to the socket server, giving up on an unreachable one in time to try the next.
+                return socket.create_connection(
+                    self.resolverCache.resolve(host, port), self.timeout
+                )
+            except socket.error as e:
+                self.resolverCache.invalidate(host, port)
+                error = e
+        raise error
 
     def handleResponse(self, response):
         """
@@ -250,24 +866,262 @@ class NavienSmartControl:
         :return: The response data (normally a channel information response)
         """
 
-        # Construct a socket object.
-        self.connection = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # Connect to the socket server.
-        self.connection.connect(
-            (NavienSmartControl.navienServer, NavienSmartControl.navienServerSocketPort)
+        with self.guardGateway(gatewayID):
+            if self.rateLimiter is not None:
+                self.rateLimiter.acquire(gatewayID)
+
+            with self.connectionsLock:
+                connection = self.connections.get(gatewayKey(gatewayID))
+                if connection is None:
+                    connection = GatewayConnection(gatewayID)
+                    self.connections[gatewayKey(gatewayID)] = connection
+
+            with connection.lock:
+                # Replace any previous connection to this gateway.
+                if connection.socket is not None:
+                    connection.socket.close()
+                    connection.socket = None
+
+                connectionSocket = self.openSocket(gatewayID)
+                if hasattr(connectionSocket, "settimeout"):
+                    connectionSocket.settimeout(self.timeout)
+                connection.socket = connectionSocket
+                connection.protocol = NavienProtocol(self.parseResponse)
+                connection.events = collections.deque()
+                self.connection = connectionSocket
+
+                # Send the initial connection details
+                request = connection.protocol.startHandshake(self.userID, gatewayID)
+                connectionSocket.sendall(request)
+
+                # Receive the status.
+                event = self.receiveEvent(connection)
+                self.recordFrames(gatewayID, 0, 0, request, event)
+                if event.error is not None:
+                    raise event.error
+
+                if self.backgroundReader:
+                    self.startReader(connection)
+
+            # Return the parsed data.
+            return event.response
+
+    def receiveEvent(self, connection):
+        """
+        Read from a connection until the next complete frame has arrived (caller must hold the connection lock)
+
+        :param connection: The GatewayConnection to read from
+        :return: The ProtocolEvent of the frame (its error is set if the frame couldn't be parsed)
+        """
+        while not connection.events:
+            try:
+                data = connection.socket.recv(1024)
+            except socket.timeout:
+                events = connection.protocol.receiveTimeout()
+                if not events:
+                    # A late response would be taken for the answer to the next request, so give up on the connection
+                    if connection.socket is self.connection:
+                        self.connection = None
+                    connection.socket.close()
+                    connection.socket = None
+                    raise TimeoutError(
+                        "Error: Timed out waiting for a response from the server."
+                    )
+                connection.events.extend(events)
+                continue
+            if not data:
+                connection.protocol.receiveData(data)
+                raise ConnectionError("Error: Connection closed by the server.")
+            connection.events.extend(connection.protocol.receiveData(data))
+        return connection.events.popleft()
+
+    def recordFrames(
+        self, gatewayID, currentControlChannel, deviceNumber, request, event
+    ):
+        """
+        Hand a request/response pair to the recorder, if any
+
+        :param gatewayID: The gatewayID the request was sent to
+        :param currentControlChannel: The channel the request was for (0 for the handshake)
+        :param deviceNumber: The device number the request was for (0 for the handshake)
+        :param request: The bytes sent
+        :param event: The ProtocolEvent of the response
+        """
+        if self.recorder is not None:
+            try:
+                self.recorder.record(
+                    gatewayID,
+                    currentControlChannel,
+                    deviceNumber,
+                    event.controlType,
+                    request,
+                    event.frame,
+                )
+            except Exception:
+                # The error of the response is the one the caller needs to see
+                if event.error is None:
+                    raise
+
+    def startReader(self, connection):
+        """
+        Start the background reader of a freshly connected socket (caller must hold the connection lock)
+
+        :param connection: The GatewayConnection to read from
+        """
+        # Each socket gets its own waiters so that a reader that is winding down can't fail requests sent on a newer socket.
+        connection.waiters = []
+        if (self.timeout is not None) and hasattr(connection.socket, "settimeout"):
+            # Flush incomplete frames well before the request waiting for them times out
+            connection.socket.settimeout(self.timeout / 2.0)
+        connection.reader = threading.Thread(
+            target=self.readLoop,
+            args=(
+                connection,
+                connection.socket,
+                connection.protocol,
+                connection.waiters,
+            ),
+            name="NavienReader-" + gatewayKey(connection.gatewayID),
         )
+        connection.reader.daemon = True
+        connection.reader.start()
+
+    def readLoop(self, connection, connectionSocket, protocol, waiters):
+        """
+        Read frames from a socket until it is closed, routing each of them
+
+        :param connection: The GatewayConnection the socket belongs to
+        :param connectionSocket: The socket to read from
+        :param protocol: The NavienProtocol of the socket
+        :param waiters: The requests waiting for a response on the socket
+        """
+        error = ConnectionError("Error: Connection closed by the server.")
+        while True:
+            try:
+                data = connectionSocket.recv(1024)
+            except socket.timeout:
+                # The connection is merely idle, but anything buffered is as complete as it gets
+                for event in protocol.receiveTimeout():
+                    self.routeEvent(connection, waiters, event)
+                continue
+            except (OSError, ValueError) as e:
+                error = e
+                data = b""
+            events = protocol.receiveData(data)
+            if not data:
+                break
+            for event in events:
+                self.routeEvent(connection, waiters, event)
+        with connection.waitersLock:
+            pending = list(waiters)
+            del waiters[:]
+        for expected, future in pending:
+            future.set_exception(error)
+
+    def routeEvent(self, connection, waiters, event):
+        """
+        Hand a frame to the request waiting for it, or to the state subscribers if no request is waiting for it
+
+        :param connection: The GatewayConnection the frame arrived on
+        :param waiters: The requests waiting for a response on the connection's socket
+        :param event: The ProtocolEvent of the frame
+        """
+        with connection.waitersLock:
+            for i, (expected, future) in enumerate(waiters):
+                if self.responseMatches(expected, event):
+                    del waiters[i]
+                    break
+            else:
+                future = None
+        if future is not None:
+            future.set_result(event)
+        elif (event.controlType == ControlType.STATE.value) and (
+            event.response is not None
+        ):
+            deviceKey = DeviceKey(
+                gatewayKey(connection.gatewayID), event.channel, event.deviceNumber
+            )
+            timestamp = time.time()
+            for callback in list(self.stateSubscribers):
+                try:
+                    callback(deviceKey, timestamp, event.response)
+                except Exception:
+                    # A failing subscriber must not stop the reader
+                    pass
+
+    def responseMatches(self, expected, event):
+        """
+        Check whether a frame is the response to a request
+
+        :param expected: The (controlType, channel, deviceNumber) the request expects
+        :param event: The ProtocolEvent of the frame
+        :return: True if the frame answers the request
+        """
+        controlType, channel, deviceNumber = expected
+        if event.error is not None:
+            # A frame we can't parse is handed to the oldest request so that it doesn't wait forever
+            return True
+        if (event.channel is not None) and (
+            (event.channel != channel) or (event.deviceNumber != deviceNumber)
+        ):
+            return False
+        return event.controlType in [controlType, ControlType.ERROR_CODE.value]
 
-        # Send the initial connection details
-        self.connection.sendall(
-            (self.userID + "$" + "iPhone1.0" + "$" + gatewayID).encode()
-        )
+    def addStateSubscriber(self, callback):
+        """
+        Register a callback for STATE frames the server pushes without a request (requires backgroundReader)
+
+        :param callback: Callable taking (deviceKey, timestamp, stateData)
+        """
+        self.stateSubscribers.append(callback)
+
+    def removeStateSubscriber(self, callback):
+        """
+        Unregister a state subscriber
+
+        :param callback: The callback passed to addStateSubscriber
+        """
+        self.stateSubscribers.remove(callback)
+
+    def getConnection(self, gatewayID):
+        """
+        Find the connection for a gateway
+
+        :param gatewayID: The gatewayID (NaviLink) as a hex string or raw bytes
+        :return: The GatewayConnection of the gateway
+        """
+        with self.connectionsLock:
+            connection = self.connections.get(gatewayKey(gatewayID))
+            if (connection is None) and (len(self.connections) == 1):
+                # A single connection serves every request, as before connections were kept per gateway
+                connection = list(self.connections.values())[0]
+        if (connection is None) or (connection.socket is None):
+            raise ConnectionError(
+                "Error: Not connected. Please connect() to the gateway first."
+            )
+        return connection
 
-        # Receive the status.
-        data = self.connection.recv(1024)
+    def disconnect(self, gatewayID=None):
+        """
+        Close the connection to a gateway
 
-        # Return the parsed data.
-        return self.parseResponse(data)
+        :param gatewayID: The gatewayID to disconnect from (None to close every connection)
+        """
+        with self.connectionsLock:
+            if gatewayID is None:
+                connections = list(self.connections.values())
+                self.connections.clear()
+            else:
+                connections = [self.connections.pop(gatewayKey(gatewayID), None)]
+        for connection in connections:
+            if connection is None:
+                continue
+            with connection.lock:
+                if connection.socket is not None:
+                    if connection.socket is self.connection:
+                        self.connection = None
+                    connection.socket.close()
+                    connection.socket = None
 
     def parseResponse(self, data):
         """
@@ -629,7 +1483,7 @@ class NavienSmartControl:
                 "errorCD",
             ],
         )
-        errorResponseData = trendSampleMYResponseColumns._make(
+        errorResponseData = errorResponseColumns._make(
             struct.unpack("2s 2s B B B B B 2s", data[12:23])
         )
         result = errorResponseData._asdict()
@@ -827,25 +1681,10 @@ class NavienSmartControl:
             + " %"
         )
         if temperatureType == TemperatureType.CELSIUS.value:
-            if stateData["deviceSorting"] in [
-                DeviceSorting.NFC.value,
-                DeviceSorting.NCB_H.value,
-                DeviceSorting.NFB.value,
-                DeviceSorting.NVW.value,
-            ]:
-                GIUFactor = 100
-            else:
-                GIUFactor = 10
             # This needs to be summed for cascaded units
             print(
                 "Current Gas Usage: "
-                + str(
-                    round(
-                        (self.bigHexToInt(stateData["gasInstantUse"]) * GIUFactor)
-                        / 10.0,
-                        1,
-                    )
-                )
+                + str(round(self.gasInstantUseKcal(stateData), 1))
                 + " kcal"
             )
             # This needs to be summed for cascaded units
@@ -987,26 +1826,10 @@ class NavienSmartControl:
                     + "C"
                 )
         elif temperatureType == TemperatureType.FAHRENHEIT.value:
-            if stateData["deviceSorting"] in [
-                DeviceSorting.NFC.value,
-                DeviceSorting.NCB_H.value,
-                DeviceSorting.NFB.value,
-                DeviceSorting.NVW.value,
-            ]:
-                GIUFactor = 10
-            else:
-                GIUFactor = 1
             # This needs to be summed for cascaded units
             print(
                 "Current Gas Usage: "
-                + str(
-                    round(
-                        self.bigHexToInt(stateData["gasInstantUse"])
-                        * GIUFactor
-                        * 3.968,
-                        1,
-                    )
-                )
+                + str(round(self.gasInstantUseKcal(stateData) * 3.968, 1))
                 + " BTU"
             )
             # This needs to be summed for cascaded units
@@ -1483,6 +2306,16 @@ class NavienSmartControl:
         littleHexStr = "".join("%02x" % b for b in littleHex)
         return int(littleHexStr, 16)
 
+    def gasInstantUseKcal(self, stateData):
+        """
+        Convert the gasInstantUse of a STATE response to kcal, as its unit depends on the device model
+
+        :param stateData: The parsed state response data
+        :return: The current gas usage in kcal
+        """
+        GIUFactor = gasInstantUseFactor(stateData["deviceSorting"])
+        return (self.bigHexToInt(stateData["gasInstantUse"]) * GIUFactor) / 10.0
+
     def sendRequest(
         self,
         gatewayID,
@@ -1508,79 +2341,120 @@ class NavienSmartControl:
         :return: Parsed response data
         
         """
-        requestHeader = {
-            "stx": 0x07,
-            "did": 0x99,
-            "reserve": 0x00,
-            "cmd": 0xA6,
-            "dataLength": 0x37,
-            "dSid": 0x00,
-        }
-        sendData = bytearray(
-            [
-                requestHeader["stx"],
-                requestHeader["did"],
-                requestHeader["reserve"],
-                requestHeader["cmd"],
-                requestHeader["dataLength"],
-                requestHeader["dSid"],
-            ]
-        )
-        sendData.extend(gatewayID)
-        sendData.extend(
-            [
-                0x01,  # commandCount
-                currentControlChannel,
-                deviceNumber,
-                controlSorting,
-                infoItem,
-                controlItem,
-                controlValue,
-            ]
-        )
-        sendData.extend(
-            [
-                WeeklyDay["WeeklyDay"],
-                WeeklyDay["WeeklyCount"],
-                WeeklyDay["1_Hour"],
-                WeeklyDay["1_Minute"],
-                WeeklyDay["1_Flag"],
-                WeeklyDay["2_Hour"],
-                WeeklyDay["2_Minute"],
-                WeeklyDay["2_Flag"],
-                WeeklyDay["3_Hour"],
-                WeeklyDay["3_Minute"],
-                WeeklyDay["3_Flag"],
-                WeeklyDay["4_Hour"],
-                WeeklyDay["4_Minute"],
-                WeeklyDay["4_Flag"],
-                WeeklyDay["5_Hour"],
-                WeeklyDay["5_Minute"],
-                WeeklyDay["5_Flag"],
-                WeeklyDay["6_Hour"],
-                WeeklyDay["6_Minute"],
-                WeeklyDay["6_Flag"],
-                WeeklyDay["7_Hour"],
-                WeeklyDay["7_Minute"],
-                WeeklyDay["7_Flag"],
-                WeeklyDay["8_Hour"],
-                WeeklyDay["8_Minute"],
-                WeeklyDay["8_Flag"],
-                WeeklyDay["9_Hour"],
-                WeeklyDay["9_Minute"],
-                WeeklyDay["9_Flag"],
-                WeeklyDay["10_Hour"],
-                WeeklyDay["10_Minute"],
-                WeeklyDay["10_Flag"],
-            ]
-        )
+        with self.guardGateway(gatewayID):
+            if self.rateLimiter is not None:
+                self.rateLimiter.acquire(gatewayID)
+
+            connection = self.getConnection(gatewayID)
+
+            if connection.reader is not None:
+                return self.sendRoutedRequest(
+                    connection,
+                    gatewayID,
+                    currentControlChannel,
+                    deviceNumber,
+                    controlSorting,
+                    infoItem,
+                    controlItem,
+                    controlValue,
+                    WeeklyDay,
+                )
 
-        # We should ensure that the socket is still connected, and abort if not
-        self.connection.sendall(sendData)
+            # Only one request/response pair may be in flight on a connection at a time.
+            with connection.lock:
+                # We should ensure that the socket is still connected, and abort if not
+                if connection.socket is None:
+                    raise ConnectionError(
+                        "Error: Connection to the gateway was closed."
+                    )
+                request = connection.protocol.sendRequest(
+                    gatewayID,
+                    currentControlChannel,
+                    deviceNumber,
+                    controlSorting,
+                    infoItem,
+                    controlItem,
+                    controlValue,
+                    WeeklyDay,
+                )
+                connection.socket.sendall(request)
 
-        # Receive the status.
-        data = self.connection.recv(1024)
-        return self.parseResponse(data)
+                # Receive the status.
+                event = self.receiveEvent(connection)
+                self.recordFrames(
+                    gatewayID, currentControlChannel, deviceNumber, request, event
+                )
+                if event.error is not None:
+                    raise event.error
+            return event.response
+
+    def sendRoutedRequest(
+        self,
+        connection,
+        gatewayID,
+        currentControlChannel,
+        deviceNumber,
+        controlSorting,
+        infoItem,
+        controlItem,
+        controlValue,
+        WeeklyDay,
+    ):
+        """
+        Send a request on a connection with a background reader and wait for the reader to route its response
+
+        :param connection: The GatewayConnection to send the request on
+        :return: Parsed response data
+        """
+        # Devices answer control requests with their new state.
+        if controlSorting == ControlSorting.CONTROL.value:
+            expected = ControlType.STATE.value
+        else:
+            expected = infoItem
+        future = Future()
+        with connection.lock:
+            if connection.socket is None:
+                raise ConnectionError("Error: Connection to the gateway was closed.")
+            waiter = ((expected, currentControlChannel, deviceNumber), future)
+            with connection.waitersLock:
+                connection.waiters.append(waiter)
+            try:
+                request = connection.protocol.sendRequest(
+                    gatewayID,
+                    currentControlChannel,
+                    deviceNumber,
+                    controlSorting,
+                    infoItem,
+                    controlItem,
+                    controlValue,
+                    WeeklyDay,
+                )
+                connection.socket.sendall(request)
+            except Exception:
+                with connection.waitersLock:
+                    if waiter in connection.waiters:
+                        connection.waiters.remove(waiter)
+                raise
+            # Only one request/response pair may be in flight on a connection at a time.
+            try:
+                event = future.result(self.timeout)
+            except FutureTimeoutError:
+                with connection.waitersLock:
+                    abandoned = waiter in connection.waiters
+                    if abandoned:
+                        connection.waiters.remove(waiter)
+                if abandoned:
+                    raise TimeoutError(
+                        "Error: Timed out waiting for a response from the server."
+                    )
+                # The reader routed the response just as we gave up
+                event = future.result()
+        self.recordFrames(
+            gatewayID, currentControlChannel, deviceNumber, request, event
+        )
+        if event.error is not None:
+            raise event.error
+        return event.response
 
     def initWeeklyDay(self):
         """
@@ -0,0 +1,155 @@
+"""
+Token bucket rate limiting for NavienSmartControl.
+
+A RateLimiter holds one token bucket for the account and one per gateway. It is
+passed to NavienSmartControl, which takes a token before each login(),
+connect() and sendRequest() call. Callers that would exceed either bucket are
+delayed rather than rejected, and the time spent waiting is recorded.
+
+Buckets reserve tokens ahead of time, so concurrent callers queue up fairly
+instead of waking up together. When a caller does have to wait, an optional
+random jitter is added so that pollers which were released at the same moment
+drift apart again.
+"""
+
+# We add random jitter to throttled waits.
+import random
+
+# The limiter is shared between threads.
+import threading
+
+# We need a clock to refill the buckets.
+import time
+
+from .NavienSmartControl import gatewayKey
+
+
+class TokenBucket:
+    """A token bucket that lets callers reserve tokens they have to wait for"""
+
+    def __init__(self, rate, capacity):
+        """
+        Construct a new 'TokenBucket' object.
+
+        :param rate: Tokens added per second
+        :param capacity: Maximum number of tokens (the allowed burst)
+        :return: returns nothing
+        """
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+
+    def reserve(self, now):
+        """
+        Take a token, going into debt if none are available
+
+        :param now: The current monotonic time
+        :return: Seconds to wait before the token may be used
+        """
+        if now > self.updated:
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated) * self.rate
+            )
+            self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimiter:
+    """Per-account and per-gateway token buckets with wait time metrics"""
+
+    def __init__(
+        self,
+        accountRate=2.0,
+        accountBurst=10,
+        gatewayRate=1.0,
+        gatewayBurst=4,
+        jitter=0.0,
+    ):
+        """
+        Construct a new 'RateLimiter' object.
+
+        :param accountRate: Requests per second allowed for the whole account (None for no limit)
+        :param accountBurst: Requests the account may burst above its rate
+        :param gatewayRate: Requests per second allowed for each gateway (None for no limit)
+        :param gatewayBurst: Requests a gateway may burst above its rate
+        :param jitter: Maximum random delay in seconds added whenever a caller is throttled
+        :return: returns nothing
+        """
+        self.gatewayRate = gatewayRate
+        self.gatewayBurst = gatewayBurst
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.accountBucket = None
+        if accountRate is not None:
+            self.accountBucket = TokenBucket(accountRate, accountBurst)
+        self.gatewayBuckets = {}
+        self.requestCount = 0
+        self.throttledCount = 0
+        self.totalWaitTime = 0.0
+        self.maxWaitTime = 0.0
+        self.gatewayWaitTime = {}
+
+    def reserve(self, gatewayID=None):
+        """
+        Reserve a token from the account bucket and, if given, the gateway's bucket
+
+        :param gatewayID: The gatewayID the request is for (None for account level requests such as login)
+        :return: Seconds to wait before sending the request
+        """
+        now = time.monotonic()
+        delay = 0.0
+        with self.lock:
+            if self.accountBucket is not None:
+                delay = self.accountBucket.reserve(now)
+            if (gatewayID is not None) and (self.gatewayRate is not None):
+                key = gatewayKey(gatewayID)
+                bucket = self.gatewayBuckets.get(key)
+                if bucket is None:
+                    bucket = TokenBucket(self.gatewayRate, self.gatewayBurst)
+                    self.gatewayBuckets[key] = bucket
+                delay = max(delay, bucket.reserve(now))
+            if (delay > 0) and (self.jitter > 0):
+                delay += random.uniform(0, self.jitter)
+
+            self.requestCount += 1
+            if delay > 0:
+                self.throttledCount += 1
+                self.totalWaitTime += delay
+                self.maxWaitTime = max(self.maxWaitTime, delay)
+                if gatewayID is not None:
+                    key = gatewayKey(gatewayID)
+                    self.gatewayWaitTime[key] = (
+                        self.gatewayWaitTime.get(key, 0.0) + delay
+                    )
+        return delay
+
+    def acquire(self, gatewayID=None):
+        """
+        Wait until a request may be sent
+
+        :param gatewayID: The gatewayID the request is for (None for account level requests such as login)
+        :return: Seconds spent waiting
+        """
+        delay = self.reserve(gatewayID)
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+    def metrics(self):
+        """
+        Snapshot of the rate limiter metrics
+
+        :return: Dictionary of request and wait time counters
+        """
+        with self.lock:
+            return {
+                "requestCount": self.requestCount,
+                "throttledCount": self.throttledCount,
+                "totalWaitTime": self.totalWaitTime,
+                "maxWaitTime": self.maxWaitTime,
+                "gatewayWaitTime": dict(self.gatewayWaitTime),
+            }
@@ -0,0 +1,302 @@
+"""
+Priority request scheduler for a NavienSmartControl connection.
+
+Requests are sent one at a time from a single worker thread. Control requests
+have their own queue and are always dispatched first, so a control request
+waits for at most the one request already in flight however busy polling is.
+State requests are dispatched ahead of trend requests. To keep trend requests
+from starving each background request is given a deadline of its queue time
+plus an aging allowance (none for state, agingInterval for trend), and the
+background request with the earliest deadline is sent next.
+"""
+
+# Control requests are sent in FIFO order.
+import collections
+
+# We order the queued requests on a heap.
+import heapq
+
+# We use Python enums.
+import enum
+
+# We dispatch from a worker thread.
+import threading
+
+# We need a clock to age the queued requests.
+import time
+
+# We hand each caller a future for the result.
+from concurrent.futures import Future
+
+
+class RequestPriority(enum.Enum):
+    CONTROL = 0
+    STATE = 1
+    TREND = 2
+
+
+class RequestScheduler:
+    """Sends the requests for one connection in priority order"""
+
+    def __init__(self, navienSmartControl, agingInterval=5.0):
+        """
+        Construct a new 'RequestScheduler' object.
+
+        :param navienSmartControl: The connected NavienSmartControl object used to send the requests
+        :param agingInterval: Seconds of aging allowance that state requests get over trend requests
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.agingInterval = agingInterval
+        self.controlQueue = collections.deque()
+        self.queue = []
+        self.sequence = 0
+        self.condition = threading.Condition()
+        self.worker = None
+        self.running = False
+
+    def submit(self, priority, send, *args):
+        """
+        Queue a request
+
+        :param priority: The RequestPriority of the request
+        :param send: The NavienSmartControl method that sends the request
+        :param args: The arguments to pass to send
+        :return: A future that resolves to the parsed response data
+        """
+        future = Future()
+        priority = RequestPriority(priority)
+        with self.condition:
+            if not self.running:
+                self.running = True
+                self.worker = threading.Thread(target=self._run)
+                self.worker.daemon = True
+                self.worker.start()
+            if priority == RequestPriority.CONTROL:
+                self.controlQueue.append((future, send, args))
+            else:
+                deadline = time.monotonic() + (
+                    (priority.value - RequestPriority.STATE.value) * self.agingInterval
+                )
+                # The sequence number keeps requests with equal deadlines in FIFO order.
+                heapq.heappush(
+                    self.queue, (deadline, self.sequence, future, send, args)
+                )
+                self.sequence += 1
+            self.condition.notify()
+        return future
+
+    def _run(self):
+        """
+        Worker loop sending the queued control requests first, then the others in deadline order
+        """
+        while True:
+            with self.condition:
+                while self.running and not (self.controlQueue or self.queue):
+                    self.condition.wait()
+                if self.controlQueue:
+                    future, send, args = self.controlQueue.popleft()
+                elif self.queue:
+                    deadline, sequence, future, send, args = heapq.heappop(self.queue)
+                else:
+                    return
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                result = send(*args)
+            except Exception as e:
+                future.set_exception(e)
+            else:
+                future.set_result(result)
+
+    def close(self):
+        """
+        Stop the worker once the queued requests have been sent
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.worker is not None:
+            self.worker.join()
+            self.worker = None
+
+    def pendingCount(self):
+        """
+        Number of requests waiting to be sent
+
+        :return: The number of queued requests
+        """
+        with self.condition:
+            return len(self.controlQueue) + len(self.queue)
+
+    def __getattr__(self, name):
+        """
+        Pass anything that is not a request (e.g. bigHexToInt) through to the NavienSmartControl object
+
+        :param name: The attribute name
+        :return: The NavienSmartControl attribute
+        """
+        if name == "navienSmartControl":
+            raise AttributeError(name)
+        return getattr(self.navienSmartControl, name)
+
+    # ----- Scheduled equivalents of the NavienSmartControl requests ----- #
+
+    def _request(self, priority, name, *args):
+        """
+        Queue a NavienSmartControl request by name and wait for the result
+
+        :param priority: The RequestPriority of the request
+        :param name: The name of the NavienSmartControl method
+        :param args: The arguments to pass to the method
+        :return: Parsed response data
+        """
+        return self.submit(
+            priority, getattr(self.navienSmartControl, name), *args
+        ).result()
+
+    def sendStateRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send state request at STATE priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.STATE,
+            "sendStateRequest",
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+        )
+
+    def sendChannelInfoRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send channel information request at STATE priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.STATE,
+            "sendChannelInfoRequest",
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+        )
+
+    def sendTrendSampleRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send trend sample request at TREND priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.TREND,
+            "sendTrendSampleRequest",
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+        )
+
+    def sendTrendMonthRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send trend month request at TREND priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.TREND,
+            "sendTrendMonthRequest",
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+        )
+
+    def sendTrendYearRequest(self, gatewayID, currentControlChannel, deviceNumber):
+        """
+        Send trend year request at TREND priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.TREND,
+            "sendTrendYearRequest",
+            gatewayID,
+            currentControlChannel,
+            deviceNumber,
+        )
+
+    def sendPowerControlRequest(self, *args):
+        """
+        Send device power control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(RequestPriority.CONTROL, "sendPowerControlRequest", *args)
+
+    def sendHeatControlRequest(self, *args):
+        """
+        Send device heat control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(RequestPriority.CONTROL, "sendHeatControlRequest", *args)
+
+    def sendOnDemandControlRequest(self, *args):
+        """
+        Send device on demand control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendOnDemandControlRequest", *args
+        )
+
+    def sendDeviceWeeklyControlRequest(self, *args):
+        """
+        Send device weekly control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendDeviceWeeklyControlRequest", *args
+        )
+
+    def sendWaterTempControlRequest(self, *args):
+        """
+        Send device water temperature control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendWaterTempControlRequest", *args
+        )
+
+    def sendHeatingWaterTempControlRequest(self, *args):
+        """
+        Send device heating water temperature control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendHeatingWaterTempControlRequest", *args
+        )
+
+    def sendRecirculationTempControlRequest(self, *args):
+        """
+        Send recirculation temperature control request at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendRecirculationTempControlRequest", *args
+        )
+
+    def sendDeviceControlWeeklyScheduleRequest(self, *args):
+        """
+        Send request to set weekly schedule at CONTROL priority
+
+        :return: Parsed response data
+        """
+        return self._request(
+            RequestPriority.CONTROL, "sendDeviceControlWeeklyScheduleRequest", *args
+        )
@@ -0,0 +1,205 @@
+"""
+Fixed-memory ring buffers of the most recent STATE samples per device.
+
+Every column of a RingBuffer is preallocated at twice its capacity and each
+value is written both at its slot and at its slot plus the capacity. Any
+window of up to capacity samples is then a single contiguous slice, so windows
+are returned as views without copying, appends are O(1) and the footprint of a
+device never grows. NumPy arrays are used when NumPy is installed, otherwise
+the standard library array module with memoryview slices.
+"""
+
+# We fall back to array when NumPy isn't installed.
+import array
+
+# The buffers are fed from the poller thread and read from others.
+import threading
+
+# NumPy is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .ColumnarStore import NUMPY_TYPES, STATE_COLUMNS, TIMESTAMP_COLUMN, fieldValue
+
+
+class RingBuffer:
+    """The last capacity rows of a fixed set of columns"""
+
+    def __init__(self, capacity, columns):
+        """
+        Construct a new 'RingBuffer' object.
+
+        :param capacity: The number of rows kept
+        :param columns: List of (name, typecode) tuples
+        :return: returns nothing
+        """
+        if capacity < 1:
+            raise Exception("Error: Ring buffer capacity must be at least 1.")
+        self.capacity = capacity
+        self.columns = columns
+        self.data = {}
+        for name, typecode in columns:
+            if numpy is not None:
+                self.data[name] = numpy.zeros(2 * capacity, dtype=NUMPY_TYPES[typecode])
+            else:
+                self.data[name] = array.array(
+                    typecode, bytes(2 * capacity * array.array(typecode).itemsize)
+                )
+        self.views = {
+            name: (column if numpy is not None else memoryview(column))
+            for name, column in self.data.items()
+        }
+        # The slot the next row is written to
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        """
+        The memory held by the columns
+
+        :return: The size in bytes
+        """
+        return sum(view.nbytes for view in self.views.values())
+
+    def append(self, row):
+        """
+        Append a row, overwriting the oldest one once the buffer is full
+
+        :param row: Tuple with a value for each column
+        """
+        head = self.head
+        mirror = head + self.capacity
+        for (name, typecode), value in zip(self.columns, row):
+            column = self.data[name]
+            column[head] = value
+            column[mirror] = value
+        self.head = (head + 1) % self.capacity
+        if self.count < self.capacity:
+            self.count += 1
+
+    def window(self, name, count=None):
+        """
+        Get the most recent values of a column, oldest first, without copying
+
+        The view shares memory with the buffer, so it changes as rows are appended. Copy it to keep it.
+
+        :param name: The column name
+        :param count: The number of values (None for every row held)
+        :return: A NumPy array view if NumPy is installed, otherwise a memoryview
+        """
+        if (count is None) or (count > self.count):
+            count = self.count
+        end = self.head + self.capacity
+        return self.views[name][end - count : end]
+
+    def latest(self):
+        """
+        Get the most recent row
+
+        :return: Dictionary of each column to its value, or None if the buffer is empty
+        """
+        if self.count == 0:
+            return None
+        slot = (self.head - 1) % self.capacity
+        return {name: self.data[name][slot] for name, typecode in self.columns}
+
+
+class RecentSamples:
+    """A RingBuffer of the latest STATE samples for each device"""
+
+    def __init__(self, capacity=1000, columns=None):
+        """
+        Construct a new 'RecentSamples' object.
+
+        :param capacity: The number of samples kept per device
+        :param columns: List of (field name, typecode) tuples to keep (defaults to STATE_COLUMNS)
+        :return: returns nothing
+        """
+        self.capacity = capacity
+        self.columns = [TIMESTAMP_COLUMN] + list(columns or STATE_COLUMNS)
+        self.lock = threading.Lock()
+        self.buffers = {}
+
+    def append(self, device, timestamp, stateData):
+        """
+        Append a STATE sample (has the signature of an AdaptivePoller state listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        row = (timestamp,) + tuple(
+            fieldValue(stateData.get(name)) for name, typecode in self.columns[1:]
+        )
+        with self.lock:
+            buffer = self.buffers.get(device)
+            if buffer is None:
+                buffer = RingBuffer(self.capacity, self.columns)
+                self.buffers[device] = buffer
+            buffer.append(row)
+
+    def buffer(self, device):
+        """
+        Get the ring buffer of a device
+
+        :param device: The DeviceKey of the device
+        :return: The RingBuffer, or None if no sample was appended for the device
+        """
+        return self.buffers.get(device)
+
+    def window(self, device, fields=None, count=None):
+        """
+        Get the most recent samples of a device, oldest first, without copying
+
+        :param device: The DeviceKey of the device
+        :param fields: The field names (None for every kept field)
+        :param count: The number of samples (None for every sample held)
+        :return: Dictionary of "timestamp" and each field to a view (see RingBuffer.window)
+        """
+        if fields is None:
+            fields = [name for name, typecode in self.columns[1:]]
+        with self.lock:
+            buffer = self.buffers.get(device)
+            if buffer is None:
+                return None
+            if (count is None) or (count > len(buffer)):
+                count = len(buffer)
+            return {
+                name: buffer.window(name, count)
+                for name in ["timestamp"] + list(fields)
+            }
+
+    def latest(self, device):
+        """
+        Get the most recent sample of a device
+
+        :param device: The DeviceKey of the device
+        :return: Dictionary of "timestamp" and each field to its value, or None if there is none
+        """
+        with self.lock:
+            buffer = self.buffers.get(device)
+            return None if buffer is None else buffer.latest()
+
+    def forget(self, device):
+        """
+        Release the buffer of a device
+
+        :param device: The DeviceKey of the device
+        """
+        with self.lock:
+            self.buffers.pop(device, None)
+
+    def devices(self):
+        """
+        List the devices with buffered samples
+
+        :return: List of DeviceKey
+        """
+        with self.lock:
+            return list(self.buffers)
@@ -0,0 +1,473 @@
+"""
+Incremental rollups of STATE samples.
+
+Samples are folded into 1 minute buckets as they arrive. Each 1 minute bucket
+is folded into its 1 hour bucket once it closes, and each 1 hour bucket into
+its 1 day bucket, so history is never rescanned. A bucket holds the sample
+count, the min/max/mean of the measured temperatures and the trapezoidal
+integrals of gasInstantUse and hotWaterFlowRate. Fields missing from a sample
+are left out of the aggregates rather than taken as 0, and a temperature no
+sample of a bucket had is stored as NaN. When buckets are folded into the next
+level, a mean is weighted by the sample count of its bucket.
+
+Closed buckets are appended to ColumnarTables partitioned by day (1m), month
+(1h) and year (1d), under root/<device>/<resolution>/<partition>, and the
+retention policy of a resolution is enforced by dropping whole partitions.
+"""
+
+# We build the partition names from calendar dates.
+import datetime
+
+# Temperatures without samples are stored as NaN.
+import math
+
+# We use os.path to build the partition paths.
+import os
+
+# Expired partitions are removed with their directory.
+import shutil
+
+# Samples may come from several threads.
+import threading
+
+# We timestamp retention runs.
+import time
+
+from .ColumnarStore import (
+    ColumnarTable,
+    deviceDirectory,
+    fieldValue,
+    parseDeviceDirectory,
+)
+
+# The resolutions, finest first: name, bucket length in seconds and partition date format
+RESOLUTIONS = [
+    ("1m", 60, "%Y-%m-%d"),
+    ("1h", 3600, "%Y-%m"),
+    ("1d", 86400, "%Y"),
+]
+
+# How long the buckets of each resolution are kept, in seconds (None to keep them forever)
+DEFAULT_RETENTION = {"1m": 14 * 86400, "1h": 400 * 86400, "1d": None}
+
+# The STATE temperatures whose min, max and mean are kept
+ROLLUP_TEMPERATURES = [
+    "hotWaterCurrentTemperature",
+    "hotWaterTemperature",
+    "currentWorkingFluidTemperature",
+    "currentReturnWaterTemperature",
+    "recirculationCurrentTemperature",
+]
+
+# The columns of a rollup table. gasUse is gasInstantUse integrated over hours, in
+# the raw units of gasInstantUse (the GIU factor of the device still applies), and
+# hotWaterVolume is hotWaterFlowRate (0.1 LPM) integrated into liters.
+ROLLUP_COLUMNS = (
+    [("timestamp", "d"), ("count", "i")]
+    + [
+        (field + suffix, "d")
+        for field in ROLLUP_TEMPERATURES
+        for suffix in ["Min", "Max", "Mean"]
+    ]
+    + [("gasUse", "d"), ("hotWaterVolume", "d")]
+)
+
+
+def partitionEnd(resolution, partition):
+    """
+    Get the time a partition ends
+
+    :param resolution: The resolution name
+    :param partition: The partition name
+    :return: Seconds since the epoch
+    """
+    dateFormat = dict((name, fmt) for name, seconds, fmt in RESOLUTIONS)[resolution]
+    start = datetime.datetime.strptime(partition, dateFormat)
+    if dateFormat == "%Y-%m-%d":
+        end = start + datetime.timedelta(days=1)
+    elif dateFormat == "%Y-%m":
+        end = (start + datetime.timedelta(days=32)).replace(day=1)
+    else:
+        end = start.replace(year=start.year + 1)
+    return end.replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class _Bucket:
+    """The aggregates of one bucket"""
+
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.mins = dict((field, None) for field in ROLLUP_TEMPERATURES)
+        self.maxs = dict((field, None) for field in ROLLUP_TEMPERATURES)
+        self.sums = dict((field, 0.0) for field in ROLLUP_TEMPERATURES)
+        self.counts = dict((field, 0) for field in ROLLUP_TEMPERATURES)
+        self.gasUse = 0.0
+        self.hotWaterVolume = 0.0
+
+    def combine(self, field, low, high, total, count):
+        if (self.mins[field] is None) or (low < self.mins[field]):
+            self.mins[field] = low
+        if (self.maxs[field] is None) or (high > self.maxs[field]):
+            self.maxs[field] = high
+        self.sums[field] += total
+        self.counts[field] += count
+
+    def addSample(self, values):
+        self.count += 1
+        for field in ROLLUP_TEMPERATURES:
+            if field in values:
+                self.combine(field, values[field], values[field], values[field], 1)
+
+    def merge(self, row):
+        self.count += row["count"]
+        for field in ROLLUP_TEMPERATURES:
+            if math.isnan(row[field + "Mean"]):
+                continue
+            self.combine(
+                field,
+                row[field + "Min"],
+                row[field + "Max"],
+                row[field + "Mean"] * row["count"],
+                row["count"],
+            )
+        self.gasUse += row["gasUse"]
+        self.hotWaterVolume += row["hotWaterVolume"]
+
+    def row(self):
+        values = [self.start, self.count]
+        for field in ROLLUP_TEMPERATURES:
+            if self.counts[field] == 0:
+                values.extend([math.nan, math.nan, math.nan])
+            else:
+                values.extend(
+                    [
+                        self.mins[field],
+                        self.maxs[field],
+                        self.sums[field] / self.counts[field],
+                    ]
+                )
+        values.extend([self.gasUse, self.hotWaterVolume])
+        return tuple(values)
+
+
+class _DeviceRollup:
+    """The open buckets of a device"""
+
+    def __init__(self):
+        self.buckets = [None] * len(RESOLUTIONS)
+        self.lastSample = None
+        # Samples in or before the last stored 1 minute bucket are dropped
+        self.resumeAfter = None
+
+
+class Rollup:
+    """Maintains 1 minute, 1 hour and 1 day rollups of the STATE samples of each device"""
+
+    def __init__(self, root, retention=None, maxGap=900.0, flushRows=1000):
+        """
+        Construct a new 'Rollup' object.
+
+        :param root: The directory the rollups live in
+        :param retention: Dictionary of resolution name to seconds to keep (None to keep forever), merged over DEFAULT_RETENTION
+        :param maxGap: Samples further apart than this many seconds are not integrated over
+        :param flushRows: Number of buffered closed buckets after which they are written to disk
+        :return: returns nothing
+        """
+        self.root = root
+        self.retention = dict(DEFAULT_RETENTION)
+        self.retention.update(retention or {})
+        self.maxGap = maxGap
+        self.flushRows = flushRows
+        self.lock = threading.Lock()
+        self.deviceStates = {}
+        self.pending = {}
+        self.pendingCount = 0
+        self.lastRetention = None
+
+    def table(self, device, resolution, partition):
+        """
+        Get a partition of the rollup table of a device
+
+        :param device: The DeviceKey of the device
+        :param resolution: The resolution name
+        :param partition: The partition name
+        :return: The ColumnarTable
+        """
+        return ColumnarTable(
+            os.path.join(self.root, deviceDirectory(device), resolution, partition),
+            ROLLUP_COLUMNS,
+        )
+
+    def partitions(self, device, resolution):
+        """
+        List the stored partitions of a rollup table, oldest first
+
+        :param device: The DeviceKey of the device
+        :param resolution: The resolution name
+        :return: List of partition names
+        """
+        directory = os.path.join(self.root, deviceDirectory(device), resolution)
+        if not os.path.isdir(directory):
+            return []
+        return sorted(os.listdir(directory))
+
+    def storedDevices(self):
+        """
+        List the devices with stored rollups
+
+        :return: List of DeviceKey
+        """
+        if not os.path.isdir(self.root):
+            return []
+        return [parseDeviceDirectory(name) for name in sorted(os.listdir(self.root))]
+
+    @staticmethod
+    def partition(level, timestamp):
+        """
+        Get the partition a bucket falls in
+
+        :param level: The index of the resolution in RESOLUTIONS
+        :param timestamp: The bucket start
+        :return: The partition name
+        """
+        return datetime.datetime.fromtimestamp(
+            timestamp, datetime.timezone.utc
+        ).strftime(RESOLUTIONS[level][2])
+
+    def readRows(self, table, start=None):
+        """
+        Read the rows of a table from a time on
+
+        :param table: The ColumnarTable
+        :param start: The earliest bucket start (None for every row)
+        :return: List of dictionaries of column name to value
+        """
+        if table.rowCount() == 0:
+            return []
+        first, last = table.range(start, None)
+        columns = dict(
+            (name, table.readColumn(name, first, last))
+            for name, typecode in ROLLUP_COLUMNS
+        )
+        return [
+            dict((name, columns[name][i]) for name, typecode in ROLLUP_COLUMNS)
+            for i in range(last - first)
+        ]
+
+    def lastTimestamp(self, device, level):
+        """
+        Get the start of the last stored bucket of a level
+
+        :param device: The DeviceKey of the device
+        :param level: The index of the resolution in RESOLUTIONS
+        :return: The bucket start, or None if none is stored
+        """
+        for partition in reversed(self.partitions(device, RESOLUTIONS[level][0])):
+            table = self.table(device, RESOLUTIONS[level][0], partition)
+            rowCount = table.rowCount()
+            if rowCount > 0:
+                return float(table.readColumn("timestamp", rowCount - 1, rowCount)[0])
+        return None
+
+    def resume(self, device, state):
+        """
+        Rebuild the open buckets of a device from the finer buckets already stored (caller must hold the lock)
+
+        :param device: The DeviceKey of the device
+        :param state: The _DeviceRollup of the device
+        """
+        self.writePending()
+        state.resumeAfter = self.lastTimestamp(device, 0)
+        for level in range(1, len(RESOLUTIONS)):
+            finer = state.buckets[level - 1]
+            latest = (
+                finer.start
+                if finer is not None
+                else self.lastTimestamp(device, level - 1)
+            )
+            if latest is None:
+                continue
+            seconds = RESOLUTIONS[level][1]
+            start = latest // seconds * seconds
+            stored = self.lastTimestamp(device, level)
+            if (stored is not None) and (stored >= start):
+                continue
+            bucket = _Bucket(start)
+            for row in self.readRows(
+                self.table(
+                    device, RESOLUTIONS[level - 1][0], self.partition(level - 1, start)
+                ),
+                start,
+            ):
+                bucket.merge(row)
+            state.buckets[level] = bucket
+
+    def closeBucket(self, device, state, level):
+        """
+        Buffer the open bucket of a level and fold it into the next level (caller must hold the lock)
+
+        :param device: The DeviceKey of the device
+        :param state: The _DeviceRollup of the device
+        :param level: The index of the resolution in RESOLUTIONS
+        """
+        bucket = state.buckets[level]
+        state.buckets[level] = None
+        row = bucket.row()
+        self.pending.setdefault(
+            (device, RESOLUTIONS[level][0], self.partition(level, bucket.start)), []
+        ).append(row)
+        self.pendingCount += 1
+        if level + 1 < len(RESOLUTIONS):
+            self.openBucket(device, state, level + 1, bucket.start).merge(
+                dict(zip([name for name, typecode in ROLLUP_COLUMNS], row))
+            )
+
+    def openBucket(self, device, state, level, timestamp):
+        """
+        Get the bucket of a level a time falls in, closing the open one if it has ended (caller must hold the lock)
+
+        :param device: The DeviceKey of the device
+        :param state: The _DeviceRollup of the device
+        :param level: The index of the resolution in RESOLUTIONS
+        :param timestamp: The time
+        :return: The _Bucket, or None if the time is before the open bucket
+        """
+        seconds = RESOLUTIONS[level][1]
+        start = timestamp // seconds * seconds
+        bucket = state.buckets[level]
+        if bucket is not None:
+            if start == bucket.start:
+                return bucket
+            if start < bucket.start:
+                return None
+            self.closeBucket(device, state, level)
+        bucket = _Bucket(start)
+        state.buckets[level] = bucket
+        return bucket
+
+    def append(self, device, timestamp, stateData):
+        """
+        Fold a STATE sample into the rollups (has the signature of an AdaptivePoller state listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        values = dict(
+            (field, fieldValue(stateData[field]))
+            for field in ROLLUP_TEMPERATURES
+            if stateData.get(field) is not None
+        )
+        # A missing reading leaves the segments on either side of it out of the integral
+        gas = stateData.get("gasInstantUse")
+        if gas is not None:
+            gas = fieldValue(gas)
+        flow = stateData.get("hotWaterFlowRate")
+        if flow is not None:
+            flow = fieldValue(flow)
+        with self.lock:
+            state = self.deviceStates.get(device)
+            if state is None:
+                state = _DeviceRollup()
+                self.deviceStates[device] = state
+                self.resume(device, state)
+            if (state.resumeAfter is not None) and (
+                timestamp < state.resumeAfter + RESOLUTIONS[0][1]
+            ):
+                return
+            bucket = self.openBucket(device, state, 0, timestamp)
+            if bucket is None:
+                # Out of order
+                return
+            bucket.addSample(values)
+            # The segment since the previous sample is credited to the bucket it ends in
+            if state.lastSample is not None:
+                lastTimestamp, lastGas, lastFlow = state.lastSample
+                elapsed = timestamp - lastTimestamp
+                if 0 < elapsed <= self.maxGap:
+                    if (lastGas is not None) and (gas is not None):
+                        bucket.gasUse += (lastGas + gas) / 2.0 * elapsed / 3600.0
+                    if (lastFlow is not None) and (flow is not None):
+                        bucket.hotWaterVolume += (
+                            (lastFlow + flow) / 2.0 / 10.0 * elapsed / 60.0
+                        )
+            state.lastSample = (timestamp, gas, flow)
+            flush = self.pendingCount >= self.flushRows
+        if flush:
+            self.flush()
+
+    def writePending(self):
+        """
+        Write the buffered closed buckets to disk (caller must hold the lock)
+
+        Buckets stay buffered until they were written, so after a failed write the next flush retries them.
+        """
+        for key in list(self.pending):
+            device, resolution, partition = key
+            rows = self.pending[key]
+            self.table(device, resolution, partition).append(rows)
+            del self.pending[key]
+            self.pendingCount -= len(rows)
+
+    def flush(self):
+        """
+        Write the closed buckets to disk and enforce the retention policy at most once an hour
+        """
+        with self.lock:
+            self.writePending()
+        now = time.time()
+        if (self.lastRetention is None) or (now - self.lastRetention >= 3600):
+            self.lastRetention = now
+            self.enforceRetention(now)
+
+    def enforceRetention(self, now=None):
+        """
+        Remove the partitions that ended before the retention period of their resolution
+
+        :param now: The current time (None for the wall clock)
+        :return: The number of partitions removed
+        """
+        if now is None:
+            now = time.time()
+        removed = 0
+        with self.lock:
+            for device in self.storedDevices():
+                for resolution, seconds, dateFormat in RESOLUTIONS:
+                    retention = self.retention.get(resolution)
+                    if retention is None:
+                        continue
+                    for partition in self.partitions(device, resolution):
+                        if partitionEnd(resolution, partition) <= now - retention:
+                            shutil.rmtree(
+                                os.path.join(
+                                    self.root,
+                                    deviceDirectory(device),
+                                    resolution,
+                                    partition,
+                                )
+                            )
+                            removed += 1
+        return removed
+
+    def close(self):
+        """
+        Close the open 1 minute buckets and write everything to disk
+
+        The open coarser buckets are rebuilt from the stored finer ones when samples arrive again.
+        """
+        with self.lock:
+            for device, state in self.deviceStates.items():
+                if state.buckets[0] is not None:
+                    self.closeBucket(device, state, 0)
+            self.deviceStates = {}
+        self.flush()
+
+    def forget(self, device):
+        """
+        Drop the open buckets of a device (the stored rollups are kept)
+
+        :param device: The DeviceKey of the device
+        """
+        with self.lock:
+            self.deviceStates.pop(device, None)
@@ -0,0 +1,316 @@
+"""
+Batched SQLite sink for parsed responses.
+
+STATE, TREND_SAMPLE and TREND_MONTH/TREND_YEAR responses are buffered and
+written to a normalised schema in a single transaction per batch, using
+executemany with constant statements (which sqlite3 prepares once and caches).
+The database runs in WAL mode so that readers don't block the writer, and the
+sample tables are indexed by device and time. A trend month or year record is
+kept once per device, period (the month or year it belongs to) and dMIndex,
+the latest response replacing the earlier ones. The schema version is kept in
+PRAGMA user_version, and databases of an earlier version are migrated on open.
+"""
+
+# The period of a trend record is found from the date of the response.
+import datetime
+
+# The database is SQLite.
+import sqlite3
+
+# The sink is shared between threads.
+import threading
+
+from .NavienSmartControl import ControlType, gatewayKey, trendPeriod
+from .ColumnarStore import STATE_COLUMNS, fieldValue
+
+STATE_FIELDS = [name for name, typecode in STATE_COLUMNS]
+
+TREND_SAMPLE_FIELDS = [
+    "totalOperatedTime",
+    "totalGasAccumulateSum",
+    "totalHotWaterAccumulateSum",
+    "totalCHOperatedTime",
+    "totalDHWUsageTime",
+]
+
+TREND_SEQUENCE_FIELDS = [
+    "gasAccumulatedUse",
+    "hotWaterAccumulatedUse",
+    "hotWaterOperatedCount",
+    "onDemandUseCount",
+    "heatAccumulatedUse",
+    "outdoorAirMaxTemperature",
+    "outdoorAirMinTemperature",
+    "dHWAccumulatedUse",
+]
+
+# Version 1 added the period column of trend_sequence.
+SCHEMA_VERSION = 1
+
+SCHEMA = (
+    """
+CREATE TABLE IF NOT EXISTS device (
+    id INTEGER PRIMARY KEY,
+    gatewayID TEXT NOT NULL,
+    channel INTEGER NOT NULL,
+    deviceNumber INTEGER NOT NULL,
+    UNIQUE (gatewayID, channel, deviceNumber)
+);
+CREATE TABLE IF NOT EXISTS state (
+    deviceID INTEGER NOT NULL REFERENCES device (id),
+    timestamp REAL NOT NULL,
+    """
+    + ",\n    ".join(name + " INTEGER" for name in STATE_FIELDS)
+    + """
+);
+CREATE INDEX IF NOT EXISTS state_device_time ON state (deviceID, timestamp);
+CREATE TABLE IF NOT EXISTS trend_sample (
+    deviceID INTEGER NOT NULL REFERENCES device (id),
+    timestamp REAL NOT NULL,
+    """
+    + ",\n    ".join(name + " INTEGER" for name in TREND_SAMPLE_FIELDS)
+    + """
+);
+CREATE INDEX IF NOT EXISTS trend_sample_device_time ON trend_sample (deviceID, timestamp);
+CREATE TABLE IF NOT EXISTS trend_sequence (
+    deviceID INTEGER NOT NULL REFERENCES device (id),
+    timestamp REAL NOT NULL,
+    controlType INTEGER NOT NULL,
+    period TEXT NOT NULL,
+    dMIndex INTEGER NOT NULL,
+    """
+    + ",\n    ".join(name + " INTEGER" for name in TREND_SEQUENCE_FIELDS)
+    + """,
+    UNIQUE (deviceID, controlType, period, dMIndex)
+);
+CREATE INDEX IF NOT EXISTS trend_sequence_device_time ON trend_sequence (deviceID, controlType, timestamp);
+"""
+)
+
+
+def insertStatement(table, columns, replace=False):
+    """
+    Build the INSERT statement of a table
+
+    :param table: The table name
+    :param columns: The column names
+    :param replace: Replace the rows that conflict with a unique constraint
+    :return: The SQL statement
+    """
+    return (
+        ("INSERT OR REPLACE INTO " if replace else "INSERT INTO ")
+        + table
+        + " ("
+        + ", ".join(columns)
+        + ") VALUES ("
+        + ", ".join("?" for _ in columns)
+        + ")"
+    )
+
+
+class SQLiteSink:
+    """Buffers parsed responses and writes them to SQLite in batches"""
+
+    def __init__(self, path, batchSize=500):
+        """
+        Construct a new 'SQLiteSink' object.
+
+        :param path: The path of the database
+        :param batchSize: Number of buffered rows after which they are written in one transaction
+        :return: returns nothing
+        """
+        self.batchSize = batchSize
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # WAL keeps the database consistent without syncing on every commit.
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.deviceIDs = {}
+        self.pending = {"state": [], "trend_sample": [], "trend_sequence": []}
+        self.pendingCount = 0
+        self.statements = {
+            "state": insertStatement("state", ["deviceID", "timestamp"] + STATE_FIELDS),
+            "trend_sample": insertStatement(
+                "trend_sample", ["deviceID", "timestamp"] + TREND_SAMPLE_FIELDS
+            ),
+            "trend_sequence": insertStatement(
+                "trend_sequence",
+                ["deviceID", "timestamp", "controlType", "period", "dMIndex"]
+                + TREND_SEQUENCE_FIELDS,
+                replace=True,
+            ),
+        }
+        self.migrate()
+
+    def migrate(self):
+        """
+        Create the schema, rebuilding the tables of a database of an earlier version
+        """
+        version = self.connection.execute("PRAGMA user_version").fetchone()[0]
+        if version > SCHEMA_VERSION:
+            raise Exception(
+                "Error: The database schema version "
+                + str(version)
+                + " is newer than the supported version "
+                + str(SCHEMA_VERSION)
+            )
+        oldTrendSequence = (version < 1) and (
+            self.connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'trend_sequence'"
+            ).fetchone()
+            is not None
+        )
+        self.connection.execute("BEGIN")
+        with self.connection:
+            if oldTrendSequence:
+                # The version 0 table has no period, so it is rebuilt with the period found from the timestamp of each row.
+                self.connection.execute(
+                    "DROP INDEX IF EXISTS trend_sequence_device_time"
+                )
+                self.connection.execute(
+                    "ALTER TABLE trend_sequence RENAME TO trend_sequence_v0"
+                )
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    self.connection.execute(statement)
+            if oldTrendSequence:
+                columns = ["deviceID", "timestamp", "controlType", "dMIndex"]
+                columns += TREND_SEQUENCE_FIELDS
+                rows = self.connection.execute(
+                    "SELECT "
+                    + ", ".join(columns)
+                    + " FROM trend_sequence_v0 ORDER BY timestamp"
+                ).fetchall()
+                self.connection.executemany(
+                    self.statements["trend_sequence"],
+                    [
+                        row[:3]
+                        + (
+                            trendPeriod(
+                                row[2], row[3], datetime.date.fromtimestamp(row[1])
+                            ),
+                        )
+                        + row[3:]
+                        for row in rows
+                    ],
+                )
+                self.connection.execute("DROP TABLE trend_sequence_v0")
+            self.connection.execute("PRAGMA user_version = " + str(SCHEMA_VERSION))
+
+    def deviceID(self, device):
+        """
+        Get the row id of a device, adding it if needed (caller must hold the lock)
+
+        :param device: The DeviceKey of the device
+        :return: The row id
+        """
+        rowID = self.deviceIDs.get(device)
+        if rowID is None:
+            key = (gatewayKey(device.gatewayID), device.channel, device.deviceNumber)
+            self.connection.execute(
+                "INSERT OR IGNORE INTO device (gatewayID, channel, deviceNumber) VALUES (?, ?, ?)",
+                key,
+            )
+            rowID = self.connection.execute(
+                "SELECT id FROM device WHERE gatewayID = ? AND channel = ? AND deviceNumber = ?",
+                key,
+            ).fetchone()[0]
+            self.deviceIDs[device] = rowID
+        return rowID
+
+    def add(self, table, rows):
+        """
+        Buffer rows, writing the batch once it is full
+
+        :param table: The table the rows belong to
+        :param rows: List of row tuples
+        """
+        with self.lock:
+            self.pending[table].extend(rows)
+            self.pendingCount += len(rows)
+            flush = self.pendingCount >= self.batchSize
+        if flush:
+            self.flush()
+
+    def addState(self, device, timestamp, stateData):
+        """
+        Buffer a STATE response (has the signature of an AdaptivePoller state listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        with self.lock:
+            deviceID = self.deviceID(device)
+        self.add(
+            "state",
+            [
+                (deviceID, timestamp)
+                + tuple(fieldValue(stateData.get(name)) for name in STATE_FIELDS)
+            ],
+        )
+
+    def addTrend(self, device, timestamp, trendData):
+        """
+        Buffer a TREND_SAMPLE, TREND_MONTH or TREND_YEAR response (has the signature of an AdaptivePoller trend listener)
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param trendData: The parsed trend response data
+        """
+        with self.lock:
+            deviceID = self.deviceID(device)
+        if trendData["controlType"] == ControlType.TREND_SAMPLE.value:
+            self.add(
+                "trend_sample",
+                [
+                    (deviceID, timestamp)
+                    + tuple(
+                        fieldValue(trendData[name]) if name in trendData else None
+                        for name in TREND_SAMPLE_FIELDS
+                    )
+                ],
+            )
+        else:
+            date = datetime.date.fromtimestamp(timestamp)
+            self.add(
+                "trend_sequence",
+                [
+                    (
+                        deviceID,
+                        timestamp,
+                        trendData["controlType"],
+                        trendPeriod(
+                            trendData["controlType"], sequence["dMIndex"], date
+                        ),
+                        sequence["dMIndex"],
+                    )
+                    + tuple(
+                        fieldValue(sequence["trendData"][name])
+                        for name in TREND_SEQUENCE_FIELDS
+                    )
+                    for sequence in trendData["trendSequences"].values()
+                ],
+            )
+
+    def flush(self):
+        """
+        Write the buffered rows in a single transaction
+        """
+        with self.lock:
+            if self.pendingCount == 0:
+                return
+            with self.connection:
+                for table, rows in self.pending.items():
+                    if rows:
+                        self.connection.executemany(self.statements[table], rows)
+            self.pending = {table: [] for table in self.pending}
+            self.pendingCount = 0
+
+    def close(self):
+        """
+        Write the buffered rows and close the database
+        """
+        self.flush()
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,181 @@
+"""
+Delta encoding of successive response frames.
+
+Successive STATE frames of a device differ in a handful of bytes (the 7-day
+schedule block in particular almost never changes), so after a keyframe only
+the runs of bytes that changed since the previous frame of the same device are
+kept. A keyframe is written every keyframeInterval frames, whenever the frame
+length changes, and whenever the delta would not be smaller than the frame.
+FrameRecorder stores the request/response pairs of its capture log this way,
+and FleetPoller sends the state records of its workers this way.
+
+Records are self-describing bytes:
+
+    keyframe: b"K" + frame length (uint16) + frame
+    delta:    b"D" + frame length (uint16) + runs of offset (uint16), run length (uint8) and the new bytes
+"""
+
+# We pack the records into bytes.
+import struct
+
+RECORD_HEADER = struct.Struct("<c H")
+RUN_HEADER = struct.Struct("<H B")
+
+KEYFRAME = b"K"
+DELTA = b"D"
+
+# Unchanged gaps up to this many bytes are folded into the surrounding run, as a new run costs three header bytes
+MERGE_GAP = RUN_HEADER.size
+
+
+def encodeDelta(previous, frame):
+    """
+    Encode the changed byte runs between two frames of the same length
+
+    :param previous: The previous frame
+    :param frame: The new frame
+    :return: The delta record
+    """
+    record = bytearray(RECORD_HEADER.pack(DELTA, len(frame)))
+    runs = []
+    for offset in range(len(frame)):
+        if frame[offset] == previous[offset]:
+            continue
+        if (
+            runs
+            and (offset - runs[-1][1] <= MERGE_GAP)
+            and (offset - runs[-1][0] < 255)
+        ):
+            runs[-1][1] = offset + 1
+        else:
+            runs.append([offset, offset + 1])
+    for start, end in runs:
+        record.extend(RUN_HEADER.pack(start, end - start))
+        record.extend(frame[start:end])
+    return bytes(record)
+
+
+def decodeKeyframe(record):
+    """
+    Get the frame of a keyframe record
+
+    :param record: The keyframe record
+    :return: The frame
+    """
+    kind, length = RECORD_HEADER.unpack_from(record)
+    if kind != KEYFRAME:
+        raise Exception("Error: Not a keyframe record.")
+    return bytes(record[RECORD_HEADER.size : RECORD_HEADER.size + length])
+
+
+def applyDelta(previous, record):
+    """
+    Rebuild a frame from the previous frame and a delta record
+
+    :param previous: The previous frame
+    :param record: The delta record
+    :return: The new frame
+    """
+    kind, length = RECORD_HEADER.unpack_from(record)
+    if kind != DELTA:
+        raise Exception("Error: Not a delta record.")
+    if length != len(previous):
+        raise Exception("Error: Delta record does not match the previous frame.")
+    frame = bytearray(previous)
+    offset = RECORD_HEADER.size
+    while offset < len(record):
+        start, runLength = RUN_HEADER.unpack_from(record, offset)
+        offset += RUN_HEADER.size
+        frame[start : start + runLength] = record[offset : offset + runLength]
+        offset += runLength
+    return bytes(frame)
+
+
+class StateDeltaEncoder:
+    """Turns the frames of each device into keyframe and delta records"""
+
+    def __init__(self, keyframeInterval=100):
+        """
+        Construct a new 'StateDeltaEncoder' object.
+
+        :param keyframeInterval: Number of records per device between keyframes
+        :return: returns nothing
+        """
+        self.keyframeInterval = keyframeInterval
+        self.previous = {}
+        self.counts = {}
+
+    def encode(self, key, frame):
+        """
+        Encode the next frame of a device
+
+        :param key: Identifies the device (e.g. its DeviceKey)
+        :param frame: The raw frame
+        :return: The record
+        """
+        frame = bytes(frame)
+        previous = self.previous.get(key)
+        count = self.counts.get(key, 0)
+        record = None
+        if (
+            (previous is not None)
+            and (len(previous) == len(frame))
+            and (count % self.keyframeInterval != 0)
+        ):
+            record = encodeDelta(previous, frame)
+            if len(record) >= RECORD_HEADER.size + len(frame):
+                record = None
+        if record is None:
+            record = RECORD_HEADER.pack(KEYFRAME, len(frame)) + frame
+            count = 0
+        self.previous[key] = frame
+        self.counts[key] = count + 1
+        return record
+
+    def reset(self, key=None):
+        """
+        Force a keyframe as the next record (e.g. for a new reader of the stream)
+
+        :param key: Identifies the device (None for every device)
+        """
+        if key is None:
+            self.previous.clear()
+            self.counts.clear()
+        else:
+            self.previous.pop(key, None)
+            self.counts.pop(key, None)
+
+
+class StateDeltaDecoder:
+    """Rebuilds the frames of each device from keyframe and delta records"""
+
+    def __init__(self):
+        """
+        Construct a new 'StateDeltaDecoder' object.
+
+        :return: returns nothing
+        """
+        self.previous = {}
+
+    def decode(self, key, record):
+        """
+        Decode the next record of a device
+
+        :param key: Identifies the device (e.g. its DeviceKey)
+        :param record: The record
+        :return: The raw frame
+        """
+        kind = record[:1]
+        if kind == KEYFRAME:
+            frame = decodeKeyframe(record)
+        elif kind == DELTA:
+            previous = self.previous.get(key)
+            if previous is None:
+                raise Exception(
+                    "Error: Delta record received before a keyframe for " + str(key)
+                )
+            frame = applyDelta(previous, record)
+        else:
+            raise Exception("Error: Unknown record kind " + repr(kind))
+        self.previous[key] = frame
+        return frame
@@ -0,0 +1,130 @@
+"""
+Field level change subscriptions for STATE responses.
+
+StateSubscriptions keeps the last STATE response of each device and compares
+every new response against it once. Subscribers name the fields they care
+about and are only called when one of those fields changes, with the old and
+new values. Its update() method has the same signature as the AdaptivePoller
+state listeners and the NavienSmartControl state subscribers, so it can sit
+behind either.
+"""
+
+# We use namedtuple to reduce index errors.
+import collections
+
+# Updates may arrive from several threads.
+import threading
+
+# A single subscription (device is None to match every device, fields is None to match every field).
+Subscription = collections.namedtuple("Subscription", ["device", "fields", "callback"])
+
+
+class StateSubscriptions:
+    """Diffs successive STATE responses and notifies the subscribers of the changed fields"""
+
+    def __init__(self, converter=None, errorHandler=None):
+        """
+        Construct a new 'StateSubscriptions' object.
+
+        :param converter: Optional callable turning raw byte fields into values (e.g. NavienSmartControl.bigHexToInt)
+        :param errorHandler: Optional callable called with the DeviceKey and the exception raised by a subscriber, so the remaining subscribers are still notified (None to let the exception propagate)
+        :return: returns nothing
+        """
+        self.converter = converter
+        self.errorHandler = errorHandler
+        self.lock = threading.Lock()
+        self.subscriptions = []
+        self.states = {}
+
+    def subscribe(self, device, fields=None, callback=None):
+        """
+        Subscribe to changes of STATE fields
+
+        The first response seen for a device is reported with None as the old values.
+
+        :param device: The DeviceKey of the device (None for every device)
+        :param fields: The names of the fields to watch (None for every field)
+        :param callback: Called with the DeviceKey, the sample timestamp and a dictionary of field name to (old, new) values
+        :return: The Subscription, to pass to unsubscribe()
+        """
+        if fields is not None:
+            fields = tuple(fields)
+        subscription = Subscription(device, fields, callback)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """
+        Cancel a subscription
+
+        :param subscription: The Subscription returned by subscribe()
+        """
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def forget(self, device):
+        """
+        Drop the last known state of a device, so that its next response is reported in full
+
+        :param device: The DeviceKey of the device
+        """
+        with self.lock:
+            self.states.pop(device, None)
+
+    def convert(self, value):
+        """
+        Convert a raw field value for comparison and reporting
+
+        :param value: The parsed field value
+        :return: The converted value
+        """
+        if (self.converter is not None) and isinstance(value, (bytes, bytearray)):
+            return self.converter(value)
+        return value
+
+    def update(self, device, timestamp, stateData):
+        """
+        Compare a STATE response with the previous one of the device and notify the subscribers of the changes
+
+        :param device: The DeviceKey of the device
+        :param timestamp: The sample timestamp
+        :param stateData: The parsed state response data
+        """
+        values = {field: self.convert(value) for field, value in stateData.items()}
+        with self.lock:
+            previous = self.states.get(device)
+            self.states[device] = values
+            subscriptions = [
+                subscription
+                for subscription in self.subscriptions
+                if subscription.device in [None, device]
+            ]
+        if previous is None:
+            changes = {field: (None, value) for field, value in values.items()}
+        else:
+            changes = {
+                field: (previous.get(field), value)
+                for field, value in values.items()
+                if previous.get(field) != value
+            }
+        if not changes:
+            return
+        for subscription in subscriptions:
+            if subscription.fields is None:
+                selected = changes
+            else:
+                selected = {
+                    field: changes[field]
+                    for field in subscription.fields
+                    if field in changes
+                }
+            if not selected:
+                continue
+            try:
+                subscription.callback(device, timestamp, selected)
+            except Exception as e:
+                if self.errorHandler is None:
+                    raise
+                self.errorHandler(device, e)
@@ -0,0 +1,283 @@
+"""
+Incremental sync of the TREND_MONTH and TREND_YEAR data of devices.
+
+A trend month response holds up to 31 daily records and a trend year response
+up to 24 monthly records, and only the record of the current day or month
+changes. TrendSync keeps the records of each device keyed by period (the month
+or year a record belongs to) and dMIndex, fetches the month data again only
+once the day has rolled over and the year data only once the month has rolled
+over (or when forced), and merges each response into the kept records, so the
+records the device has dropped from its window are still served. The records
+are persisted as JSON so a restart doesn't refetch them, and the kept data is
+served as a parsed response that the print functions accept.
+"""
+
+# The date of the last fetch tells if the data is stale.
+import datetime
+
+# The records are persisted as JSON.
+import json
+
+# We replace the JSON file atomically.
+import os
+
+# The sync may be used from several polling threads.
+import threading
+
+from .NavienSmartControl import (
+    AutoVivification,
+    ControlType,
+    DeviceKey,
+    gatewayKey,
+    trendPeriod,
+)
+from .ColumnarStore import deviceDirectory
+
+# The periods synced: controlType, and the format of the date of a fetch that is still current
+PERIODS = {
+    "month": (ControlType.TREND_MONTH, "%Y-%m-%d"),
+    "year": (ControlType.TREND_YEAR, "%Y-%m"),
+}
+
+
+def encodeValue(value):
+    """
+    Convert a parsed response value to JSON, as the parsers leave the multi-byte fields as bytes
+
+    :param value: The value
+    :return: The JSON compatible value
+    """
+    if isinstance(value, (bytes, bytearray)):
+        return {"bytes": bytes(value).hex()}
+    if isinstance(value, dict):
+        return dict((str(key), encodeValue(item)) for key, item in value.items())
+    return value
+
+
+def decodeValue(value):
+    """
+    Convert a value read from JSON back to its parsed response form
+
+    :param value: The JSON value
+    :return: The value
+    """
+    if isinstance(value, dict):
+        if list(value) == ["bytes"]:
+            return bytes(bytearray.fromhex(value["bytes"]))
+        return dict((key, decodeValue(item)) for key, item in value.items())
+    return value
+
+
+class TrendSync:
+    """Keeps the trend month and year records of devices, fetching them only when they can have changed"""
+
+    def __init__(self, navienSmartControl, path=None):
+        """
+        Construct a new 'TrendSync' object.
+
+        :param navienSmartControl: The connected NavienSmartControl object (or a RequestScheduler wrapping one) used to send the requests
+        :param path: The JSON file the records are persisted to (None to keep them in memory only)
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.path = path
+        self.lock = threading.Lock()
+        self.devices = {}
+        if (path is not None) and os.path.exists(path):
+            with open(path, "r") as in_file:
+                self.devices = json.load(in_file)
+            for periods in self.devices.values():
+                for period, synced in periods.items():
+                    if "records" in synced:
+                        # Files written before the records were kept per period hold only the window of the last fetch.
+                        fetched = datetime.datetime.strptime(
+                            synced["fetched"], PERIODS[period][1]
+                        ).date()
+                        records = synced.pop("records")
+                        synced["periods"] = {}
+                        for dMIndex, trendData in records.items():
+                            label = trendPeriod(
+                                PERIODS[period][0].value, int(dMIndex), fetched
+                            )
+                            synced["periods"].setdefault(label, {})[dMIndex] = trendData
+
+    def isCurrent(self, device, period, today=None):
+        """
+        Tell if the kept records of a period were fetched since the last rollover
+
+        :param device: The DeviceKey of the device
+        :param period: "month" or "year"
+        :param today: The current date (None for today)
+        :return: True if there is no need to fetch them again
+        """
+        if today is None:
+            today = datetime.date.today()
+        with self.lock:
+            synced = self.devices.get(deviceDirectory(device), {}).get(period)
+            return (synced is not None) and (
+                synced["fetched"] == today.strftime(PERIODS[period][1])
+            )
+
+    def merge(self, device, period, response, today=None):
+        """
+        Merge a trend month or year response into the kept records of a period
+
+        The records are keyed by the period they belong to and their dMIndex, so a record of the response replaces the kept one of the same day or month, and kept records missing from the response are left as they are.
+
+        :param device: The DeviceKey of the device
+        :param period: "month" or "year"
+        :param response: The parsed trend response data
+        :param today: The date of the fetch (None for today)
+        """
+        if today is None:
+            today = datetime.date.today()
+        header = dict(
+            (key, value)
+            for key, value in response.items()
+            if key not in ["trendSequences", "totalDaySequence"]
+        )
+        with self.lock:
+            synced = self.devices.setdefault(deviceDirectory(device), {}).setdefault(
+                period, {"periods": {}}
+            )
+            synced["fetched"] = today.strftime(PERIODS[period][1])
+            synced["response"] = encodeValue(header)
+            for i in range(response["totalDaySequence"]):
+                sequence = response["trendSequences"][i]
+                label = trendPeriod(response["controlType"], sequence["dMIndex"], today)
+                synced["periods"].setdefault(label, {})[str(sequence["dMIndex"])] = (
+                    encodeValue(sequence["trendData"])
+                )
+
+    def sync(self, gatewayID, currentControlChannel, deviceNumber, force=False):
+        """
+        Fetch the trend month and year data of a device if the day or month rolled over since the last fetch
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to, as raw bytes
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :param force: Fetch both even if the kept records are current
+        :return: List of the parsed trend responses fetched
+        """
+        device = DeviceKey(gatewayKey(gatewayID), currentControlChannel, deviceNumber)
+        requests = [
+            ("month", self.navienSmartControl.sendTrendMonthRequest),
+            ("year", self.navienSmartControl.sendTrendYearRequest),
+        ]
+        fetched = []
+        for period, sendRequest in requests:
+            today = datetime.date.today()
+            if force or not self.isCurrent(device, period, today):
+                response = sendRequest(gatewayID, currentControlChannel, deviceNumber)
+                if response["controlType"] != PERIODS[period][0].value:
+                    raise Exception(
+                        "Error: Unexpected "
+                        + ControlType(response["controlType"]).name
+                        + " response to trend "
+                        + period
+                        + " request"
+                    )
+                self.merge(device, period, response, today)
+                fetched.append(response)
+        if fetched:
+            self.save()
+        return fetched
+
+    def periods(self, device, period):
+        """
+        Get the periods the kept records of a device belong to
+
+        :param device: The DeviceKey of the device
+        :param period: "month" or "year"
+        :return: Sorted list of the periods, as "YYYY-MM" for month records and "YYYY" for year records
+        """
+        with self.lock:
+            synced = self.devices.get(deviceDirectory(device), {}).get(period)
+            if synced is None:
+                return []
+            return sorted(synced["periods"])
+
+    def records(self, device, period, label=None):
+        """
+        Get the kept records of a device
+
+        :param device: The DeviceKey of the device
+        :param period: "month" or "year"
+        :param label: Only get the records of this period, e.g. "2022-03" for the days of March 2022 (None for all the kept records)
+        :return: Dictionary of (period, dMIndex) to trend data (empty if nothing was synced)
+        """
+        with self.lock:
+            synced = self.devices.get(deviceDirectory(device), {}).get(period)
+            if synced is None:
+                return {}
+            return dict(
+                ((key, int(dMIndex)), decodeValue(trendData))
+                for key, records in synced["periods"].items()
+                if label is None or key == label
+                for dMIndex, trendData in records.items()
+            )
+
+    def response(self, device, period, label=None):
+        """
+        Build a parsed trend response from the kept records, as accepted by printTrendMY
+
+        :param device: The DeviceKey of the device
+        :param period: "month" or "year"
+        :param label: Only include the records of this period (None for all the kept records, oldest first)
+        :return: The parsed trend response data, or None if nothing was synced
+        """
+        records = self.records(device, period, label)
+        with self.lock:
+            synced = self.devices.get(deviceDirectory(device), {}).get(period)
+            if synced is None:
+                return None
+            result = decodeValue(synced["response"])
+        trendSequences = AutoVivification()
+        for i, key in enumerate(sorted(records)):
+            trendSequences[i]["dMIndex"] = key[1]
+            trendSequences[i]["trendData"] = records[key]
+        result["totalDaySequence"] = len(records)
+        result["trendSequences"] = trendSequences
+        return result
+
+    def trendMonth(self, device, label=None):
+        """
+        Get the synced trend month data of a device
+
+        :param device: The DeviceKey of the device
+        :param label: Only include the days of this month, as "YYYY-MM" (None for all the kept days)
+        :return: The parsed trend month response data, or None if nothing was synced
+        """
+        return self.response(device, "month", label)
+
+    def trendYear(self, device, label=None):
+        """
+        Get the synced trend year data of a device
+
+        :param device: The DeviceKey of the device
+        :param label: Only include the months of this year, as "YYYY" (None for all the kept months)
+        :return: The parsed trend year response data, or None if nothing was synced
+        """
+        return self.response(device, "year", label)
+
+    def forget(self, device):
+        """
+        Drop the kept records of a device
+
+        :param device: The DeviceKey of the device
+        """
+        with self.lock:
+            self.devices.pop(deviceDirectory(device), None)
+        self.save()
+
+    def save(self):
+        """
+        Write the kept records to the JSON file
+        """
+        if self.path is None:
+            return
+        with self.lock:
+            data = json.dumps(self.devices)
+        with open(self.path + ".tmp", "w") as out_file:
+            out_file.write(data)
+        os.replace(self.path + ".tmp", self.path)
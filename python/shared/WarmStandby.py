@@ -0,0 +1,237 @@
+"""
+Warm standby connections for low latency on demand requests.
+
+Pressing the HotButton through a cold NavienSmartControl object pays for the
+login, DNS lookup, TCP connect and gateway handshake before the request goes
+out. WarmStandby keeps the connections of designated gateways open ahead of
+time: it sends a keepalive STATE request whenever a connection has been idle
+for the keepalive interval and reconnects before the session reaches the age
+at which the server drops it. An on demand request is then a single round trip,
+and its end-to-end latency is recorded.
+"""
+
+# We keep a bounded window of recent latencies.
+import collections
+
+# A socket timeout means the request may have reached the gateway.
+import socket
+
+# We can run the keepalive loop on a thread.
+import threading
+
+# We need clocks for the session ages and for measuring latency.
+import time
+
+from .NavienSmartControl import DeviceSorting, gatewayKey
+
+
+class _StandbySession:
+    """A gateway connection kept open in standby"""
+
+    def __init__(self, gatewayID):
+        self.gatewayID = gatewayID
+        self.channelInfo = None
+        self.connectedAt = None
+        self.lastUsed = None
+        self.lastError = None
+
+
+class WarmStandby:
+    """Keeps gateway connections open so that on demand requests need a single round trip"""
+
+    def __init__(
+        self,
+        navienSmartControl,
+        keepaliveInterval=60.0,
+        maxSessionAge=900.0,
+        latencyWindow=1000,
+    ):
+        """
+        Construct a new 'WarmStandby' object.
+
+        :param navienSmartControl: The logged in NavienSmartControl object used to connect and send the requests
+        :param keepaliveInterval: Seconds a connection may stay idle before a keepalive request is sent
+        :param maxSessionAge: Seconds after which a connection is replaced before the server drops it
+        :param latencyWindow: Number of recent on demand latencies kept for the statistics
+        :return: returns nothing
+        """
+        self.navienSmartControl = navienSmartControl
+        self.keepaliveInterval = keepaliveInterval
+        self.maxSessionAge = maxSessionAge
+        self.sessions = {}
+        self.latencies = collections.deque(maxlen=latencyWindow)
+        self.reconnectCount = 0
+        self.condition = threading.Condition()
+        self.running = False
+
+    def addGateway(self, gatewayID):
+        """
+        Open a connection to a gateway and keep it warm
+
+        :param gatewayID: The gatewayID as a hex string
+        :return: The channel information response
+        """
+        session = _StandbySession(gatewayID)
+        with self.condition:
+            self.sessions[gatewayKey(gatewayID)] = session
+        self.reconnect(session)
+        return session.channelInfo
+
+    def removeGateway(self, gatewayID):
+        """
+        Stop keeping a gateway's connection warm and close it
+
+        :param gatewayID: The gatewayID as a hex string
+        """
+        with self.condition:
+            self.sessions.pop(gatewayKey(gatewayID), None)
+        self.navienSmartControl.disconnect(gatewayID)
+
+    def reconnect(self, session):
+        """
+        (Re)open the connection of a session
+
+        :param session: The session
+        """
+        try:
+            session.channelInfo = self.navienSmartControl.connect(session.gatewayID)
+        except Exception as e:
+            session.connectedAt = None
+            session.lastError = e
+            raise
+        session.connectedAt = time.monotonic()
+        session.lastUsed = session.connectedAt
+        session.lastError = None
+        self.reconnectCount += 1
+
+    def keepalive(self, session):
+        """
+        Send a STATE request to the first device of a gateway to keep its connection open
+
+        :param session: The session
+        """
+        channelInfo = session.channelInfo
+        for chan in channelInfo["channel"]:
+            if (
+                channelInfo["channel"][chan]["deviceSorting"]
+                != DeviceSorting.NO_DEVICE.value
+            ):
+                self.navienSmartControl.sendStateRequest(
+                    bytes(bytearray.fromhex(session.gatewayID)), int(chan), 1
+                )
+                session.lastUsed = time.monotonic()
+                return
+        # No device to query, a fresh connection keeps the session alive instead
+        self.reconnect(session)
+
+    def maintain(self):
+        """
+        Refresh the sessions that are due for a keepalive or a reconnect
+
+        :return: Seconds until the next session is due
+        """
+        with self.condition:
+            sessions = list(self.sessions.values())
+        delay = self.keepaliveInterval
+        for session in sessions:
+            now = time.monotonic()
+            try:
+                if (session.connectedAt is None) or (
+                    now - session.connectedAt >= self.maxSessionAge
+                ):
+                    self.reconnect(session)
+                elif now - session.lastUsed >= self.keepaliveInterval:
+                    self.keepalive(session)
+            except Exception as e:
+                session.lastError = e
+                session.connectedAt = None
+                continue
+            delay = min(
+                delay,
+                session.lastUsed + self.keepaliveInterval - time.monotonic(),
+                session.connectedAt + self.maxSessionAge - time.monotonic(),
+            )
+        return max(0, delay)
+
+    def sendOnDemandControlRequest(
+        self, gatewayID, currentControlChannel, deviceNumber
+    ):
+        """
+        Send device on demand control request (the equivalent of pressing the HotButton) over the warm connection
+
+        If the warm connection has been dropped (the request fails with a connection level OSError, such as ConnectionError or a failed send), it is reopened and the request sent once more. A timeout is raised as is, as the gateway may have acted on the request and must not get it twice, and so is any other error, e.g. a rejected request or a CircuitOpenError.
+
+        :param gatewayID: The gatewayID (NaviLink) the device is connected to, as a hex string
+        :param currentControlChannel: The serial port channel on the Navilink that the device is connected to
+        :param deviceNumber: The device number on the serial bus corresponding with the device
+        :return: Parsed response data
+        """
+        with self.condition:
+            session = self.sessions.get(gatewayKey(gatewayID))
+        if session is None:
+            raise Exception(
+                "Error: Gateway " + gatewayKey(gatewayID) + " is not in standby."
+            )
+        started = time.perf_counter()
+        try:
+            if session.connectedAt is None:
+                self.reconnect(session)
+            response = self.navienSmartControl.sendOnDemandControlRequest(
+                bytes(bytearray.fromhex(session.gatewayID)),
+                currentControlChannel,
+                deviceNumber,
+                session.channelInfo,
+            )
+        except (TimeoutError, socket.timeout):
+            raise
+        except OSError:
+            self.reconnect(session)
+            response = self.navienSmartControl.sendOnDemandControlRequest(
+                bytes(bytearray.fromhex(session.gatewayID)),
+                currentControlChannel,
+                deviceNumber,
+                session.channelInfo,
+            )
+        session.lastUsed = time.monotonic()
+        with self.condition:
+            self.latencies.append(time.perf_counter() - started)
+        return response
+
+    def latencyStats(self):
+        """
+        Statistics of the recent on demand request latencies
+
+        :return: Dictionary of the count, minimum, mean, median, 95th percentile and maximum latency in seconds, and the number of reconnects
+        """
+        with self.condition:
+            latencies = sorted(self.latencies)
+        if not latencies:
+            return {"count": 0, "reconnectCount": self.reconnectCount}
+        return {
+            "count": len(latencies),
+            "min": latencies[0],
+            "mean": sum(latencies) / len(latencies),
+            "p50": latencies[len(latencies) // 2],
+            "p95": latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))],
+            "max": latencies[-1],
+            "reconnectCount": self.reconnectCount,
+        }
+
+    def run(self):
+        """
+        Keep the sessions warm until stop() is called
+        """
+        self.running = True
+        while self.running:
+            delay = self.maintain()
+            with self.condition:
+                if self.running:
+                    self.condition.wait(delay)
+
+    def stop(self):
+        """
+        Stop a running keepalive loop
+        """
+        with self.condition:
+            self.running = False
+            self.condition.notify()
@@ -16,10 +16,13 @@ setuptools.setup(
         "Bug Tracker": "https://github.com/rudybrian/PyNavienSmartControl/issues"
     },
     classifiers=[
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.6",
+        "Programming Language :: Python :: 3 :: Only",
         "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
         "License :: OSI Approved :: GNU General Public License v2 (GPLv2)",
         "Operating System :: OS Independent",
         "Topic :: Internet",
@@ -38,5 +41,6 @@ setuptools.setup(
         "json",
         "argparse",
     ],
-    python_requires=">=2.7",
+    extras_require={"numpy": ["numpy"]},
+    python_requires=">=3.7",
 )
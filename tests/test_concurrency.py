@@ -0,0 +1,198 @@
+"""
+Stress tests for sharing a NavienSmartControl object between threads.
+
+A local socketserver stands in for the Navien server. Each connection answers
+the handshake with a channel information frame and every state request with a
+STATE frame carrying the gatewayID of its handshake and the channel and device
+number of the request, after a random delay. Many
+threads then send requests for their own device across several gateways and
+check that every response is the one for their own request.
+"""
+
+# We locate the package relative to this file.
+import os
+
+# We shuffle the timing of the responses.
+import random
+
+# We need a stand-in for the Navien server.
+import socketserver
+
+# We need the sys module to find the package.
+import sys
+
+# We hammer the client from many threads.
+import threading
+
+# We pace the stand-in server.
+import time
+
+# We use the standard library test runner so no extra dependency is needed.
+import unittest
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "python")
+)
+
+from shared.NavienSmartControl import ControlType, NavienSmartControl
+
+GATEWAYS = [
+    "0011223344556601",
+    "0011223344556602",
+    "0011223344556603",
+    "0011223344556604",
+]
+CHANNELS = [1, 2, 3]
+DEVICES = [1, 2]
+REQUESTS_PER_THREAD = 40
+
+# The length of a request frame sent by NavienProtocol.encodeRequest
+REQUEST_LENGTH = 53
+
+
+def channelInformationFrame(gatewayID):
+    """
+    Build the channel information frame that completes the handshake
+
+    :param gatewayID: The gatewayID as raw bytes
+    :return: The frame
+    """
+    frame = bytearray(13 + 15 * 3)
+    frame[:8] = gatewayID
+    frame[9] = ControlType.CHANNEL_INFORMATION.value
+    frame[10] = 16
+    frame[11] = 0
+    frame[12] = len(CHANNELS)
+    for i in range(3):
+        frame[13 + 15 * i] = i + 1
+        frame[14 + 15 * i] = 1
+        frame[15 + 15 * i] = len(DEVICES)
+    return bytes(frame)
+
+
+def stateFrame(gatewayID, channel, deviceNumber):
+    """
+    Build a STATE frame (long form) for a device
+
+    :param gatewayID: The gatewayID as raw bytes
+    :param channel: The channel of the device
+    :param deviceNumber: The device number
+    :return: The frame
+    """
+    frame = bytearray(273)
+    frame[:8] = gatewayID
+    frame[9] = ControlType.STATE.value
+    frame[10] = 16
+    frame[11] = 0
+    frame[16] = 1
+    frame[17] = 1
+    frame[18] = channel
+    frame[19] = deviceNumber
+    return bytes(frame)
+
+
+class StandInHandler(socketserver.BaseRequestHandler):
+    """Answers the handshake and each state request of a single connection"""
+
+    def receiveExactly(self, length):
+        data = bytearray()
+        while len(data) < length:
+            chunk = self.request.recv(length - len(data))
+            if not chunk:
+                return None
+            data.extend(chunk)
+        return bytes(data)
+
+    def handle(self):
+        handshake = self.request.recv(1024)
+        if not handshake:
+            return
+        gatewayID = bytes.fromhex(handshake.decode().split("$")[-1])
+        self.request.sendall(channelInformationFrame(gatewayID))
+        while True:
+            request = self.receiveExactly(REQUEST_LENGTH)
+            if request is None:
+                return
+            channel = request[15]
+            deviceNumber = request[16]
+            time.sleep(random.random() * 0.002)
+            # Always answer with the gateway of the handshake, so a request sent on the wrong socket shows up
+            self.request.sendall(stateFrame(gatewayID, channel, deviceNumber))
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ConcurrencyTest(unittest.TestCase):
+    """Many threads sharing one client across several gateways"""
+
+    def setUp(self):
+        self.server = StandInServer(("127.0.0.1", 0), StandInHandler)
+        self.serverThread = threading.Thread(target=self.server.serve_forever)
+        self.serverThread.daemon = True
+        self.serverThread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def client(self, backgroundReader):
+        navienSmartControl = NavienSmartControl(
+            "user", "passwd", directConnect=True, backgroundReader=backgroundReader
+        )
+        for gatewayID in GATEWAYS:
+            navienSmartControl.gatewayEndpoints[gatewayID] = self.server.server_address
+            navienSmartControl.connect(gatewayID)
+        return navienSmartControl
+
+    def hammer(self, navienSmartControl):
+        mismatches = []
+        errors = []
+
+        def worker(gatewayID, channel, deviceNumber):
+            try:
+                for i in range(REQUESTS_PER_THREAD):
+                    response = navienSmartControl.sendStateRequest(
+                        bytes.fromhex(gatewayID), channel, deviceNumber
+                    )
+                    received = (
+                        response["deviceID"].hex(),
+                        response["currentChannel"],
+                        response["deviceNumber"],
+                    )
+                    if received != (gatewayID, channel, deviceNumber):
+                        mismatches.append(
+                            ((gatewayID, channel, deviceNumber), received)
+                        )
+            except Exception as e:
+                errors.append(e)
+
+        threads = [
+            threading.Thread(target=worker, args=(gatewayID, channel, deviceNumber))
+            for gatewayID in GATEWAYS
+            for channel in CHANNELS
+            for deviceNumber in DEVICES
+        ]
+        for thread in threads:
+            # A worker stuck in recv must not keep the interpreter alive
+            thread.daemon = True
+            thread.start()
+        deadline = time.monotonic() + 60
+        for thread in threads:
+            thread.join(max(0, deadline - time.monotonic()))
+            self.assertFalse(thread.is_alive(), "A worker thread hung")
+        navienSmartControl.disconnect()
+        self.assertEqual(errors, [])
+        self.assertEqual(mismatches, [])
+
+    def test_shared_client(self):
+        self.hammer(self.client(False))
+
+    def test_shared_client_with_background_reader(self):
+        self.hammer(self.client(True))
+
+
+if __name__ == "__main__":
+    unittest.main()